@@ -0,0 +1,372 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from database import Database, LRUCache
+from storage import Storage, notifies_subscriptions
+
+class AsyncDatabase(Storage):
+    """Неблокирующий доступ к Database из event loop aiogram.
+
+    Реализация Storage по умолчанию (SQLite).
+
+    Все записи проходят через одну задачу-писателя: она забирает операции из
+    asyncio.Queue пачками и выполняет их в отдельном потоке на единственном
+    пишущем соединении внутри Database.batch() - одна транзакция и один commit
+    на пачку (group commit), каждая операция в своем savepoint.
+    Чтения выполняются в небольшом пуле потоков, у каждого свое read-only
+    соединение (в WAL режиме читатели не блокируют писателя).
+    """
+
+    supports_file_backup = True
+
+    def __init__(self, db_file, profile: Optional[Dict] = None, readers: int = 4, max_batch: int = 64,
+                 cache: Optional[LRUCache] = None, archive_file: Optional[str] = None):
+        """Инициализация пишущего соединения (с проверкой схемы) и пула чтения
+
+        Кэш записей общий для писателя и всех читателей: писатель сбрасывает
+        записи после commit, читатели наполняют его при промахах.
+        """
+        self.db_file = db_file
+        self.profile = profile
+        self.archive_file = archive_file
+        self.cache = cache if cache is not None else LRUCache()
+        self.max_batch = max_batch
+        self._writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._reader_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._queue = None
+        self._writer_task = None
+        # Схема создается синхронно, чтобы читатели сразу видели таблицы
+        self._writer = self._writer_executor.submit(
+            Database, db_file, profile, False, self.cache, archive_file
+        ).result()
+
+    # --- Внутренняя механика ---
+
+    def _reader(self) -> Database:
+        """Read-only соединение текущего потока пула"""
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = Database(self.db_file, self.profile, read_only=True, cache=self.cache,
+                          archive_file=self.archive_file)
+            self._local.db = db
+            with self._readers_lock:
+                self._readers.append(db)
+        return db
+
+    def _call_reader(self, name, args, kwargs):
+        return getattr(self._reader(), name)(*args, **kwargs)
+
+    async def _read(self, name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._reader_executor, functools.partial(self._call_reader, name, args, kwargs)
+        )
+
+    def _ensure_writer_task(self):
+        if self._writer_task is None or self._writer_task.done():
+            self._queue = asyncio.Queue()
+            self._writer_task = asyncio.get_running_loop().create_task(self._writer_loop())
+
+    async def _write(self, name, *args, **kwargs):
+        self._ensure_writer_task()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((name, args, kwargs, future))
+        return await future
+
+    def _run_batch(self, batch):
+        """Выполнение пачки записей в потоке писателя одной транзакцией"""
+        outcomes = []
+        try:
+            with self._writer.batch():
+                for name, args, kwargs, future in batch:
+                    try:
+                        with self._writer.savepoint():
+                            outcomes.append((future, getattr(self._writer, name)(*args, **kwargs), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            logging.error(f"Database group commit failed: {e}")
+            outcomes = [(future, None, e) for _, _, _, future in batch]
+        return outcomes
+
+    def _run_unbatched(self, name, args, kwargs):
+        return getattr(self._writer, name)(*args, **kwargs)
+
+    async def _writer_loop(self):
+        """Единственный писатель: забирает операции из очереди пачками"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            outcomes = await loop.run_in_executor(self._writer_executor, self._run_batch, batch)
+            for future, result, error in outcomes:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            if len(batch) > 1:
+                logging.debug(f"Group commit of {len(batch)} writes")
+            if stop:
+                return
+
+    async def _exclusive(self, name, *args, **kwargs):
+        """Операция на пишущем соединении вне транзакции (например, checkpoint)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._writer_executor, functools.partial(self._run_unbatched, name, args, kwargs)
+        )
+
+    async def close(self):
+        """Дождаться записи очереди и закрыть все соединения"""
+        if self._writer_task is not None and not self._writer_task.done():
+            await self._queue.put(None)
+            await self._writer_task
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._writer_executor, self._writer.close)
+        # Ожидание завершения потоков чтения не должно блокировать event loop
+        await loop.run_in_executor(None, self._reader_executor.shutdown, True)
+        await loop.run_in_executor(None, self._writer_executor.shutdown, True)
+        with self._readers_lock:
+            for reader in self._readers:
+                reader.conn.close()
+            self._readers.clear()
+
+    def cache_stats(self) -> Dict:
+        """Метрики общего кэша записей"""
+        return self.cache.stats()
+
+    # --- Пользователи ---
+
+    async def add_user(self, user_id, username=None):
+        return await self._write('add_user', user_id, username)
+
+    async def get_user(self, user_id):
+        return await self._read('get_user', user_id)
+
+    # --- Платежи ---
+
+    async def create_payment(self, user_id, amount, status, duration_months=None, payment_method=None, screenshot_file_id=None):
+        return await self._write('create_payment', user_id, amount, status, duration_months, payment_method, screenshot_file_id)
+
+    async def verify_payment(self, payment_id, status):
+        return await self._write('verify_payment', payment_id, status)
+
+    async def add_payment(self, payment_id: str, user_id: int, amount: float, duration: int, status: str = 'pending'):
+        return await self._write('add_payment', payment_id, user_id, amount, duration, status)
+
+    async def update_payment_status(self, payment_id: str, status: str):
+        return await self._write('update_payment_status', payment_id, status)
+
+    async def get_payment(self, payment_id: str):
+        return await self._read('get_payment', payment_id)
+
+    async def get_user_payments(self, user_id):
+        return await self._read('get_user_payments', user_id)
+
+    # --- Подписки ---
+
+    @notifies_subscriptions('one')
+    async def add_subscription(self, user_id, duration_days):
+        return await self._write('add_subscription', user_id, duration_days)
+
+    @notifies_subscriptions('one')
+    async def create_subscription(self, user_id: int, expiration):
+        return await self._write('create_subscription', user_id, expiration)
+
+    @notifies_subscriptions('one')
+    async def deactivate_subscription(self, user_id: int) -> bool:
+        return await self._write('deactivate_subscription', user_id)
+
+    @notifies_subscriptions('many')
+    async def deactivate_subscriptions(self, user_ids, outbox=None) -> int:
+        return await self._write('deactivate_subscriptions', list(user_ids), list(outbox or ()))
+
+    async def expire_subscriptions(self, subscriptions, now: int, outbox=None) -> list:
+        subscriptions = list(subscriptions)
+        try:
+            return await self._write('expire_subscriptions', subscriptions, now, dict(outbox or {}))
+        finally:
+            self._subscriptions_changed([user_id for _, user_id in subscriptions])
+
+    @notifies_subscriptions('many')
+    async def extend_subscriptions(self, user_ids, days) -> int:
+        return await self._write('extend_subscriptions', list(user_ids), days)
+
+    async def get_subscription(self, user_id):
+        return await self._read('get_subscription', user_id)
+
+    async def check_subscription(self, user_id):
+        return await self._read('check_subscription', user_id)
+
+    async def get_subscription_end_date(self, user_id):
+        return await self._read('get_subscription_end_date', user_id)
+
+    async def get_expired_subscriptions(self):
+        return await self._read('get_expired_subscriptions')
+
+    async def get_active_subscriptions(self):
+        return await self._read('get_active_subscriptions')
+
+    async def get_expired_subscriptions_page(self, after=None, limit: int = 500, now=None):
+        return await self._read('get_expired_subscriptions_page', after, limit, now)
+
+    async def get_active_subscriptions_page(self, after=None, limit: int = 500, now=None):
+        return await self._read('get_active_subscriptions_page', after, limit, now)
+
+    async def get_warning_due_page(self, tier: str, window: int, floor: int = 0, after=None,
+                                   limit: int = 500, now=None):
+        return await self._read('get_warning_due_page', tier, window, floor, after, limit, now)
+
+    async def get_recent_subscriptions(self, limit: int = 5):
+        return await self._read('get_recent_subscriptions', limit)
+
+    # --- Конфигурации клиентов ---
+
+    async def save_client_config(self, user_id: int, client_data: Dict[str, str]):
+        return await self._write('save_client_config', user_id, client_data)
+
+    async def get_client_config(self, user_id: int):
+        return await self._read('get_client_config', user_id)
+
+    async def get_file_id(self, user_id: int, kind: str, content_hash: str):
+        return await self._read('get_file_id', user_id, kind, content_hash)
+
+    async def save_file_id(self, user_id: int, kind: str, content_hash: str, file_id: str):
+        return await self._write('save_file_id', user_id, kind, content_hash, file_id)
+
+    # --- Уведомления ---
+
+    async def add_notification(self, user_id, subscription_id, notification_type):
+        return await self._write('add_notification', user_id, subscription_id, notification_type)
+
+    async def add_notifications(self, rows) -> int:
+        return await self._write('add_notifications', list(rows))
+
+    async def claim_notification(self, user_id, subscription_id, notification_type) -> bool:
+        return await self._write('claim_notification', user_id, subscription_id, notification_type)
+
+    async def claim_notifications(self, rows) -> list:
+        return await self._write('claim_notifications', list(rows))
+
+    async def release_notification(self, subscription_id, notification_type):
+        return await self._write('release_notification', subscription_id, notification_type)
+
+    async def filter_unnotified(self, subscription_ids, notification_type) -> set:
+        return await self._read('filter_unnotified', list(subscription_ids), notification_type)
+
+    async def prune_notifications(self, older_than_days: int) -> int:
+        return await self._write('prune_notifications', older_than_days)
+
+    async def check_notification_sent(self, user_id, subscription_id, notification_type):
+        return await self._read('check_notification_sent', user_id, subscription_id, notification_type)
+
+    # --- Обслуживание ---
+
+    @notifies_subscriptions('all')
+    async def clear_all_data(self):
+        return await self._write('clear_all_data')
+
+    async def get_counters(self) -> Dict[str, int]:
+        return await self._read('get_counters')
+
+    async def check_counters(self) -> Dict[str, tuple]:
+        return await self._read('check_counters')
+
+    async def rebuild_counters(self) -> Dict[str, tuple]:
+        return await self._write('rebuild_counters')
+
+    async def archive_batch(self, table: str, cutoff: int, batch_size: int = 500, after=None):
+        return await self._write('archive_batch', table, cutoff, batch_size, after)
+
+    async def get_archive_stats(self) -> Dict[str, int]:
+        return await self._read('get_archive_stats')
+
+    async def get_job_runs(self) -> Dict[str, float]:
+        return await self._read('get_job_runs')
+
+    async def record_job_run(self, name: str, started_at: float, duration: float, error: Optional[str] = None):
+        return await self._write('record_job_run', name, started_at, duration, error)
+
+    async def enqueue_outbox(self, events) -> int:
+        return await self._write('enqueue_outbox', list(events))
+
+    async def claim_outbox(self, limit: int = 100, lease: float = 60.0):
+        return await self._write('claim_outbox', limit, lease)
+
+    async def complete_outbox(self, event_ids) -> int:
+        return await self._write('complete_outbox', list(event_ids))
+
+    async def retry_outbox(self, event_id: int, delay: Optional[float], error: str):
+        return await self._write('retry_outbox', event_id, delay, error)
+
+    async def get_outbox_stats(self) -> Dict:
+        return await self._read('get_outbox_stats')
+
+    async def count_broadcast_recipients(self, segment: str, now=None) -> int:
+        return await self._read('count_broadcast_recipients', segment, now)
+
+    async def get_broadcast_recipients_page(self, segment: str, after: int = 0, limit: int = 500, now=None) -> list:
+        return await self._read('get_broadcast_recipients_page', segment, after, limit, now)
+
+    async def create_broadcast(self, segment: str, text: str, total: int, chat_id=None, message_id=None) -> int:
+        return await self._write('create_broadcast', segment, text, total, chat_id, message_id)
+
+    async def get_broadcast(self, broadcast_id: int):
+        return await self._read('get_broadcast', broadcast_id)
+
+    async def get_running_broadcasts(self) -> list:
+        return await self._read('get_running_broadcasts')
+
+    async def update_broadcast(self, broadcast_id: int, cursor: int, sent: int, failed: int,
+                               status: Optional[str] = None) -> Optional[str]:
+        return await self._write('update_broadcast', broadcast_id, cursor, sent, failed, status)
+
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        return await self._write('cancel_broadcast', broadcast_id)
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        return await self._write('acquire_lease', name, holder, ttl)
+
+    async def release_lease(self, name: str, holder: str):
+        return await self._write('release_lease', name, holder)
+
+    async def check_lease(self, name: str, holder: str, token: int) -> bool:
+        return await self._read('check_lease', name, holder, token)
+
+    async def checkpoint(self, mode: str = 'PASSIVE'):
+        return await self._exclusive('checkpoint', mode)
+
+    async def get_file_stats(self) -> Dict:
+        return await self._read('get_file_stats')
+
+    async def enable_incremental_vacuum(self) -> bool:
+        return await self._exclusive('enable_incremental_vacuum')
+
+    async def incremental_vacuum(self, pages: int = 256) -> int:
+        return await self._exclusive('incremental_vacuum', pages)
+
+    async def optimize(self, analyze: bool = False):
+        return await self._exclusive('optimize', analyze)
+
+    async def backup(self, target: str, pages: int = 256, sleep: float = 0.005) -> int:
+        # Копия читается через read-only соединение пула: писатель не занят
+        return await self._read('backup', target, pages, sleep)
@@ -0,0 +1,61 @@
+"""Бенчмарк пропускной способности записи Database для разных профилей соединения.
+
+Сравнивает исходные настройки sqlite3 (LEGACY_CONNECTION_PROFILE) с профилем
+по умолчанию (WAL, synchronous=NORMAL и т.д.) на add_payment и add_subscription.
+
+    python bench_database.py --rows 2000
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from database import Database, DEFAULT_CONNECTION_PROFILE, LEGACY_CONNECTION_PROFILE
+
+
+def _measure(profile: dict, rows: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, "bench.db"), profile=profile)
+
+        started = time.perf_counter()
+        for i in range(rows):
+            db.add_payment(str(uuid.uuid4()), i, 199.0, 1)
+        payments = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for i in range(rows):
+            db.add_subscription(i, 30)
+        subscriptions = time.perf_counter() - started
+
+        db.close()
+
+    return {
+        'add_payment': rows / payments,
+        'add_subscription': rows / subscriptions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000)
+    args = parser.parse_args()
+
+    # Логи отдельных операций искажают замер
+    logging.disable(logging.INFO)
+
+    results = {
+        'legacy': _measure(LEGACY_CONNECTION_PROFILE, args.rows),
+        'default': _measure(DEFAULT_CONNECTION_PROFILE, args.rows),
+    }
+
+    print(f"{'operation':<18} {'legacy ops/s':>13} {'default ops/s':>14} {'speedup':>8}")
+    for operation in ('add_payment', 'add_subscription'):
+        before = results['legacy'][operation]
+        after = results['default'][operation]
+        print(f"{operation:<18} {before:>13.0f} {after:>14.0f} {after / before:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Бенчмарк выборок истекших и активных подписок на больших таблицах.
+
+Заполняет subscriptions N строками (сроки равномерно на год вперед плюс
+небольшое число уже истекших) и замеряет get_expired_subscriptions и
+get_active_subscriptions с частичным покрывающим индексом и без него.
+
+    python bench_expiry_scans.py --rows 100000 1000000
+"""
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+
+from database import Database
+
+EXPIRY_INDEX = 'idx_subscriptions_active_expiration'
+
+
+def _fill(db: Database, rows: int, expired: int):
+    now = int(time.time())
+    random.seed(rows)
+
+    def generate():
+        for user_id in range(rows):
+            if user_id < expired:
+                expiration = now - random.randint(1, 60)
+            else:
+                expiration = now + random.randint(3600, 365 * 86400)
+            # Примерно половина строк - старые деактивированные подписки
+            is_active = 1 if user_id < expired or user_id % 2 else 0
+            yield user_id, expiration, now, is_active
+
+    db.conn.executemany(
+        'INSERT INTO subscriptions (user_id, expiration, created_at, is_active) VALUES (?, ?, ?, ?)',
+        generate()
+    )
+    db.conn.commit()
+    db.conn.execute('ANALYZE')
+
+
+def _best_of(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run(rows: int, expired: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        _fill(db, rows, expired)
+
+        index_sql = db.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?", (EXPIRY_INDEX,)
+        ).fetchone()[0]
+
+        results = {}
+        for label in ('with index', 'without index'):
+            if label == 'without index':
+                db.conn.execute(f'DROP INDEX {EXPIRY_INDEX}')
+            results[label] = (
+                _best_of(db.get_expired_subscriptions, repeat),
+                _best_of(db.get_active_subscriptions, repeat),
+            )
+        db.conn.execute(index_sql)
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--expired', type=int, default=10, help='уже истекших активных подписок')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    print(f"{'rows':>8} {'variant':<14} {'expired sweep, ms':>18} {'active sweep, ms':>17}")
+    for rows in args.rows:
+        for label, (expired_time, active_time) in run(rows, args.expired, args.repeat).items():
+            print(f"{rows:>8} {label:<14} {expired_time * 1000:>18.3f} {active_time * 1000:>17.1f}")
+
+
+if __name__ == '__main__':
+    main()
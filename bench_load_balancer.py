@@ -0,0 +1,82 @@
+"""Бенчмарк конкурентного распределения клиентов через LoadBalancer.
+
+Несколько процессов одновременно вызывают acquire_server() на общей базе
+состояния. В конце сверяется сумма счетчиков: потерянных обновлений быть
+не должно.
+
+    python bench_load_balancer.py --processes 1 2 4 8 --placements 500
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from load_balancer import LoadBalancer
+
+
+def _worker(state_file, db_file, placements, start_event):
+    lb = LoadBalancer(state_file=state_file, db_file=db_file)
+    start_event.wait()
+    for _ in range(placements):
+        lb.acquire_server()
+    lb.close()
+
+
+def run(processes: int, placements: int, servers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, "servers_state.json")
+        db_file = os.path.join(tmp, "servers_state.db")
+        with open(state_file, "w") as f:
+            json.dump({f"server{i}": {"endpoint": f"10.0.0.{i}:51820"} for i in range(servers)}, f)
+
+        # Инициализируем схему до старта воркеров
+        LoadBalancer(state_file=state_file, db_file=db_file).close()
+
+        start_event = multiprocessing.Event()
+        workers = [
+            multiprocessing.Process(target=_worker, args=(state_file, db_file, placements, start_event))
+            for _ in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        started = time.perf_counter()
+        start_event.set()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        lb = LoadBalancer(state_file=state_file, db_file=db_file)
+        counts = [info['clients_count'] for info in lb.get_all_servers().values()]
+        lb.close()
+
+    expected = processes * placements
+    return {
+        'processes': processes,
+        'placements': expected,
+        'elapsed': elapsed,
+        'ops_per_sec': expected / elapsed if elapsed else 0.0,
+        'lost_updates': expected - sum(counts),
+        'spread': max(counts) - min(counts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--placements", type=int, default=500, help="вызовов acquire_server на процесс")
+    parser.add_argument("--servers", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'procs':>5} {'placements':>10} {'seconds':>8} {'ops/s':>9} {'lost':>5} {'spread':>6}")
+    for processes in args.processes:
+        result = run(processes, args.placements, args.servers)
+        print(
+            f"{result['processes']:>5} {result['placements']:>10} {result['elapsed']:>8.3f} "
+            f"{result['ops_per_sec']:>9.0f} {result['lost_updates']:>5} {result['spread']:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Бенчмарк представления строк подписок: словари против __slots__ записей.
+
+Заполняет subscriptions N строками и сравнивает полную выборку активных
+подписок тремя способами: sqlite3.Row, словарь на строку (как было раньше)
+и Subscription из records.py. Для каждого варианта измеряется время выборки
+и память на строку (tracemalloc, пока результат удерживается в списке).
+
+    python bench_records.py --rows 100000 1000000
+"""
+import argparse
+import gc
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+from database import Database
+from records import Subscription
+
+QUERY = '''
+    SELECT id, user_id, expiration, created_at, is_active
+    FROM subscriptions
+    WHERE is_active = 1
+    ORDER BY expiration, id
+'''
+
+
+def _fill(db: Database, rows: int):
+    now = int(time.time())
+    db.conn.executemany(
+        'INSERT INTO subscriptions (user_id, expiration, created_at, is_active) VALUES (?, ?, ?, 1)',
+        ((user_id, now + 3600 + user_id, now) for user_id in range(rows))
+    )
+    db.conn.commit()
+
+
+def _dict_factory(cursor, row):
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+VARIANTS = {
+    'sqlite3.Row': sqlite3.Row,
+    'dict': _dict_factory,
+    'Subscription': Subscription.row_factory,
+}
+
+
+def _measure(conn: sqlite3.Connection, row_factory, repeat: int):
+    best = float('inf')
+    # Сборщик мусора на миллионах объектов сильно шумит в замерах времени
+    gc.disable()
+    for _ in range(repeat):
+        cursor = conn.cursor()
+        cursor.row_factory = row_factory
+        started = time.perf_counter()
+        rows = cursor.execute(QUERY).fetchall()
+        best = min(best, time.perf_counter() - started)
+        del rows
+    gc.enable()
+
+    gc.collect()
+    tracemalloc.start()
+    cursor = conn.cursor()
+    cursor.row_factory = row_factory
+    rows = cursor.execute(QUERY).fetchall()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, size / max(len(rows), 1)
+
+
+def run(rows: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        db = Database(os.path.join(tmp, 'bench.db'))
+        _fill(db, rows)
+        results = {label: _measure(db.conn, factory, repeat) for label, factory in VARIANTS.items()}
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    print(f"{'rows':>8} {'variant':<13} {'fetch, ms':>10} {'bytes/row':>10}")
+    for rows in args.rows:
+        for label, (elapsed, per_row) in run(rows, args.repeat).items():
+            print(f"{rows:>8} {label:<13} {elapsed * 1000:>10.1f} {per_row:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Бенчмарк реализаций Storage: SQLite (AsyncDatabase) и PostgreSQL (PostgresStorage).
+
+Одни и те же операции выполняются конкурентно из нескольких корутин:
+регистрация пользователей с подпиской, чтение подписок, потоковый обход
+и пакетная деактивация. PostgreSQL берется по --dsn или запускается
+локально во временном каталоге (нужны initdb и pg_ctl в PATH).
+
+    python bench_storage.py --backends sqlite postgres --users 2000 --concurrency 16
+"""
+import argparse
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from async_database import AsyncDatabase
+
+
+@contextlib.contextmanager
+def local_postgres():
+    """Временный кластер PostgreSQL на unix-сокете; отдает DSN"""
+    initdb = shutil.which("initdb")
+    pg_ctl = shutil.which("pg_ctl")
+    if not initdb or not pg_ctl:
+        raise RuntimeError("initdb/pg_ctl not found in PATH")
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = os.path.join(tmp, "data")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        subprocess.run(
+            [initdb, "-D", data_dir, "-U", "postgres", "--auth=trust", "--no-sync"],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        subprocess.run(
+            [pg_ctl, "-D", data_dir, "-w", "-l", os.path.join(tmp, "postgres.log"),
+             "-o", f"-p {port} -k {tmp} -c listen_addresses='' -c fsync=off", "start"],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        try:
+            yield f"postgresql://postgres@/postgres?host={tmp}&port={port}"
+        finally:
+            subprocess.run([pg_ctl, "-D", data_dir, "-m", "fast", "-w", "stop"],
+                           check=False, stdout=subprocess.DEVNULL)
+
+
+async def _timed(label, results, coro_factories, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(factory):
+        async with semaphore:
+            await factory()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(guarded(factory) for factory in coro_factories))
+    elapsed = time.perf_counter() - started
+    results.append((label, len(coro_factories), elapsed))
+
+
+async def run(storage, users: int, concurrency: int) -> list:
+    await storage.connect()
+    await storage.clear_all_data()
+    results = []
+    user_ids = list(range(1, users + 1))
+
+    async def register(user_id):
+        await storage.add_user(user_id, f"user{user_id}")
+        await storage.add_subscription(user_id, 30 if user_id % 2 else -1)
+
+    await _timed("register", results, [lambda u=u: register(u) for u in user_ids], concurrency)
+    await _timed("get_subscription", results,
+                 [lambda u=u: storage.get_subscription(u) for u in user_ids], concurrency)
+
+    started = time.perf_counter()
+    expired = [row['user_id'] async for row in storage.iter_expired_subscriptions(500)]
+    results.append(("iter_expired", len(expired), time.perf_counter() - started))
+
+    started = time.perf_counter()
+    await storage.deactivate_subscriptions(expired)
+    results.append(("deactivate_batch", len(expired), time.perf_counter() - started))
+
+    await storage.close()
+    return results
+
+
+def _make_storage(backend: str, dsn: str, tmp: str):
+    if backend == "sqlite":
+        return AsyncDatabase(os.path.join(tmp, "bench_storage.db"))
+    from postgres_storage import PostgresStorage
+    return PostgresStorage(dsn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", nargs="+", default=["sqlite", "postgres"], choices=["sqlite", "postgres"])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--dsn", default=os.getenv("BENCH_POSTGRES_DSN"), help="существующая база PostgreSQL")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with contextlib.ExitStack() as stack:
+        dsn = args.dsn
+        if "postgres" in args.backends and not dsn:
+            dsn = stack.enter_context(local_postgres())
+        tmp = stack.enter_context(tempfile.TemporaryDirectory())
+
+        print(f"{'backend':>8} {'operation':>18} {'count':>7} {'seconds':>8} {'ops/s':>9}")
+        for backend in args.backends:
+            results = asyncio.run(run(_make_storage(backend, dsn, tmp), args.users, args.concurrency))
+            for label, count, elapsed in results:
+                rate = count / elapsed if elapsed else 0.0
+                print(f"{backend:>8} {label:>18} {count:>7} {elapsed:>8.3f} {rate:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
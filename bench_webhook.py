@@ -0,0 +1,188 @@
+"""Бенчмарк приема обновлений: long polling против webhook без Telegram.
+
+Поднимает локальный фейковый Bot API (getMe, getUpdates, deleteWebhook)
+и сервер WebhookServer, подает N синтетических сообщений и замеряет
+пропускную способность и задержку от отправки обновления до завершения
+хэндлера. Хэндлер имитирует работу asyncio.sleep(--handler-ms); --rate
+задает темп подачи (0 - максимальный, замер пропускной способности).
+
+    python bench_webhook.py --updates 5000 --concurrency 40 --workers 16
+    python bench_webhook.py --updates 2000 --rate 500
+"""
+import argparse
+import asyncio
+import logging
+import socket
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientSession, web
+
+from webhook import SECRET_HEADER, WebhookServer
+
+TOKEN = '123456:bench'
+SECRET = 'bench-secret'
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _update(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': update_id % 1000 + 1, 'type': 'private'},
+            'from': {'id': update_id % 1000 + 1, 'is_bot': False, 'first_name': 'bench'},
+            'text': str(update_id),
+        },
+    }
+
+
+class FakeBotAPI:
+    """Минимальный Bot API для long polling: обновления отдаются по offset"""
+
+    def __init__(self):
+        self.pending = []
+        self.available = asyncio.Event()
+
+    def push(self, update: dict):
+        self.pending.append(update)
+        self.available.set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        data = dict(await request.post())
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        elif method == 'getUpdates':
+            offset = int(data.get('offset') or 0)
+            self.pending = [update for update in self.pending if update['update_id'] >= offset]
+            if not self.pending:
+                self.available.clear()
+                try:
+                    await asyncio.wait_for(self.available.wait(), float(data.get('timeout') or 0))
+                except asyncio.TimeoutError:
+                    pass
+            result = self.pending[:int(data.get('limit') or 100)]
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+
+async def _pace(started: float, update_id: int, rate: float):
+    if rate:
+        delay = started + update_id / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _dispatcher(handler_ms: float, sent: dict, latencies: list, done: asyncio.Event, total: int) -> Dispatcher:
+    dp = Dispatcher()
+
+    @dp.message()
+    async def handle(message):
+        await asyncio.sleep(handler_ms / 1000)
+        latencies.append(time.perf_counter() - sent[int(message.text)])
+        if len(latencies) == total:
+            done.set()
+
+    return dp
+
+
+def _report(mode: str, latencies: list, elapsed: float):
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{mode:>8}: {len(latencies) / elapsed:8.0f} updates/s, "
+          f"latency p50 {p50:7.1f} ms, p95 {p95:7.1f} ms, max {latencies[-1] * 1000:7.1f} ms")
+
+
+async def bench_polling(updates: int, handler_ms: float, rate: float):
+    api = FakeBotAPI()
+    port = _free_port()
+    runner = await api.start(port)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{port}'))
+    bot = Bot(TOKEN, session=session)
+    sent, latencies, done = {}, [], asyncio.Event()
+    dp = _dispatcher(handler_ms, sent, latencies, done, updates)
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    await asyncio.sleep(0.5)
+
+    started = time.perf_counter()
+    for update_id in range(1, updates + 1):
+        await _pace(started, update_id, rate)
+        sent[update_id] = time.perf_counter()
+        api.push(_update(update_id))
+        if not rate and update_id % 100 == 0:
+            await asyncio.sleep(0)
+    await done.wait()
+    _report('polling', latencies, time.perf_counter() - started)
+
+    await dp.stop_polling()
+    await polling
+    await runner.cleanup()
+
+
+async def bench_webhook(updates: int, handler_ms: float, rate: float, concurrency: int, workers: int):
+    bot = Bot(TOKEN)
+    sent, latencies, done = {}, [], asyncio.Event()
+    dp = _dispatcher(handler_ms, sent, latencies, done, updates)
+    port = _free_port()
+    server = WebhookServer(dp, bot, path='/webhook', secret_token=SECRET, workers=workers)
+    await server.start('127.0.0.1', port)
+
+    url = f'http://127.0.0.1:{port}/webhook'
+    ids = iter(range(1, updates + 1))
+
+    async def client(http: ClientSession):
+        for update_id in ids:
+            await _pace(started, update_id, rate)
+            sent[update_id] = time.perf_counter()
+            async with http.post(url, json=_update(update_id), headers={SECRET_HEADER: SECRET}) as response:
+                assert response.status == 200, response.status
+
+    started = time.perf_counter()
+    async with ClientSession() as http:
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        await done.wait()
+    _report('webhook', latencies, time.perf_counter() - started)
+
+    await server.stop()
+    await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--handler-ms', type=float, default=5.0, help='время работы хэндлера')
+    parser.add_argument('--rate', type=float, default=0, help='обновлений в секунду, 0 - без ограничения')
+    parser.add_argument('--concurrency', type=int, default=40, help='одновременных запросов webhook (max_connections)')
+    parser.add_argument('--workers', type=int, default=16, help='задач-обработчиков webhook')
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'both'], default='both')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"{args.updates} updates, handler {args.handler_ms:g} ms")
+    if args.mode in ('polling', 'both'):
+        asyncio.run(bench_polling(args.updates, args.handler_ms, args.rate))
+    if args.mode in ('webhook', 'both'):
+        asyncio.run(bench_webhook(args.updates, args.handler_ms, args.rate, args.concurrency, args.workers))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,14 +15,26 @@ import uuid
 import json
 import qrcode
 import asyncio
-from datetime import datetime, timedelta
+import functools
+from datetime import datetime
+from urllib.parse import urlsplit
 from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.types import FSInputFile, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from dotenv import load_dotenv
-from database import Database
+from storage import create_storage
+from jobs import SubscriptionJobs
+from scheduler import Scheduler
+from leader import LeaderElector
+from send_queue import PRIORITY_CRITICAL, SendQueue
+from broadcast import BroadcastEngine
+from file_cache import FileIdCache
+from webhook import WebhookServer
+from storage import BROADCAST_SEGMENTS
+from maintenance import DatabaseMaintenance
 from wg_easy_api import WGEasyAPI
 from config_manager import ConfigManager, Config
 import fcntl
@@ -33,7 +45,32 @@ load_dotenv()
 
 # Инициализация бота и базы данных
 bot = Bot(token=os.getenv('BOT_TOKEN'))
-db = Database('vpn_bot.db')
+# Все исходящие сообщения идут через очередь с лимитами Telegram
+send_queue = SendQueue(bot, global_rate=float(os.getenv('TELEGRAM_GLOBAL_RATE', '30')))
+# DATABASE_URL: путь к файлу SQLite (по умолчанию) или postgresql://... для общей базы реплик
+DATABASE_URL = os.getenv('DATABASE_URL', 'vpn_bot.db')
+# Файл архива холодных строк для SQLite (PostgreSQL хранит архив в схеме archive)
+ARCHIVE_DATABASE = os.getenv('ARCHIVE_DATABASE', os.path.splitext(DATABASE_URL)[0] + '-archive.db')
+# Блокировка единственного экземпляра на хосте; для нескольких реплик SINGLE_INSTANCE=0
+# (тогда кэш записей SQLite отключается: его не сбрасывают записи других реплик)
+SINGLE_INSTANCE = os.getenv('SINGLE_INSTANCE', '1') == '1'
+db = create_storage(DATABASE_URL, archive_file=ARCHIVE_DATABASE, shared=not SINGLE_INSTANCE)
+# Фоновое обслуживание: incremental vacuum, статистика, резервные копии
+maintenance = DatabaseMaintenance.from_env(db, DATABASE_URL)
+# Фоновые задачи выполняет только реплика-лидер (аренда в базе)
+leader = LeaderElector(db, ttl=float(os.getenv('LEADER_LEASE_TTL', '10')))
+# Единый планировщик фоновых задач (истечение подписок, предупреждения, обслуживание)
+scheduler = Scheduler(db, leader)
+# Рассылки администратора; выполняет реплика-лидер через планировщик
+broadcasts = BroadcastEngine(db, send_queue)
+file_ids = FileIdCache(db)
+# Прием обновлений: polling (по умолчанию) или webhook на встроенном сервере aiohttp
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес webhook (путь в нем же), например https://bot.example.com/telegram
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token: A-Z, a-z, 0-9, _ и -
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+webhook = None
 wg_api = None
 
 # Инициализация конфигурации
@@ -60,9 +97,6 @@ class PaymentStates(StatesGroup):
 # Создаем диспетчер
 dp = Dispatcher()
 
-# Глобальная переменная для отслеживания отправленных уведомлений
-notification_sent = {}
-
 def ensure_single_instance():
     """Проверка на запуск единственного экземпляра бота"""
     try:
@@ -137,7 +171,7 @@ async def show_subscription_menu(callback_query: types.CallbackQuery):
 async def show_subscription_status(callback_query: types.CallbackQuery):
     """Показать статус подписки"""
     user_id = callback_query.from_user.id
-    subscription = db.get_subscription(user_id)
+    subscription = await db.get_subscription(user_id)
     
     if not subscription:
         keyboard = types.InlineKeyboardMarkup(
@@ -163,12 +197,11 @@ async def show_subscription_status(callback_query: types.CallbackQuery):
         )
         return
     
-    expiration_str = subscription['expiration']
-    expiration_time = datetime.strptime(expiration_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
+    expiration_time = subscription.expiration
     time_left = expiration_time - datetime.now()
     
     # Получаем конфигурацию клиента
-    client_config = db.get_client_config(user_id)
+    client_config = await db.get_client_config(user_id)
     if not client_config:
         await callback_query.message.edit_text(
             "❌ Ошибка: конфигурация клиента не найдена.\n"
@@ -185,8 +218,8 @@ async def show_subscription_status(callback_query: types.CallbackQuery):
         return
     
     # Проверяем статус подключения в WireGuard
-    client = await wg_api.get_client(client_config.get('config_name'))
-    subscription_status = "✅ Активна" if subscription['is_active'] else "❌ Не активна"
+    client = await wg_api.get_client(f"user_{user_id}")
+    subscription_status = "✅ Активна" if subscription.is_active else "❌ Не активна"
     
     # Создаем клавиатуру
     keyboard = types.InlineKeyboardMarkup(
@@ -212,7 +245,7 @@ async def show_subscription_status(callback_query: types.CallbackQuery):
     
     await callback_query.message.edit_text(
         f"📊 Статус вашей подписки:\n\n"
-        f"📅 Действует до: {expiration_str.split('.')[0]}\n"
+        f"📅 Действует до: {expiration_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
         f"🔐 Статус подписки: {subscription_status}\n"
         f"⏳ Осталось: {days} дней и {hours} часов",
         reply_markup=keyboard
@@ -272,7 +305,7 @@ async def handle_admin_command(message: types.Message):
         return
     
     try:
-        db.clear_all_data()
+        await db.clear_all_data()
         await message.answer("✅ База данных очищена")
     except Exception as e:
         logging.error(f"Error clearing database: {e}")
@@ -280,8 +313,8 @@ async def handle_admin_command(message: types.Message):
 
 @dp.callback_query(lambda c: c.data == "action_subscribe")
 async def process_subscribe_action(callback: types.CallbackQuery, state: FSMContext):
-    if db.check_subscription(callback.from_user.id):
-        end_date = db.get_subscription_end_date(callback.from_user.id)
+    if await db.check_subscription(callback.from_user.id):
+        end_date = await db.get_subscription_end_date(callback.from_user.id)
         await callback.message.edit_text(
             f"У вас уже есть активная подписка до {end_date.strftime('%d.%m.%Y')}.\n"
             "Хотите продлить подписку?",
@@ -298,13 +331,11 @@ async def process_subscribe_action(callback: types.CallbackQuery, state: FSMCont
 @dp.callback_query(lambda c: c.data == "action_status")
 async def process_status_action(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    subscription = db.get_subscription(user_id)
+    subscription = await db.get_subscription(user_id)
     
     if subscription:
         try:
-            # Обрезаем микросекунды из даты
-            end_date_str = subscription[4].split('.')[0]  # Используем индекс 4 для end_date
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S')
+            end_date = subscription.expiration
             
             now = datetime.now()
             remaining_time = end_date - now
@@ -327,7 +358,7 @@ async def process_status_action(callback: types.CallbackQuery, state: FSMContext
                     f"🔓 Ваша подписка активна\n\n"
                     f"📅 Осталось: {time_str}\n"
                     f"📆 Дата окончания: {end_date.strftime('%d.%m.%Y %H:%M')}\n"
-                    f"🔑 Конфигурация: {subscription[2]}"  # Используем индекс 2 для config_name
+                    f"🔑 Конфигурация: user_{user_id}"
                 )
             else:
                 await callback.message.answer(
@@ -500,7 +531,7 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
         duration_months = float(duration)  # Конвертируем в месяцы
         
         try:
-            if not db.add_payment(payment_id, message.from_user.id, float(amount), duration_months):
+            if not await db.add_payment(payment_id, message.from_user.id, float(amount), duration_months):
                 await message.answer(
                     "❌ Произошла ошибка при создании платежа.\n"
                     "Пожалуйста, попробуйте еще раз или обратитесь к администратору."
@@ -530,7 +561,7 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
         )
 
         # Отправляем скриншот и информацию админу
-        await bot.send_photo(
+        await send_queue.send_photo(
             ADMIN_USER_ID,
             message.photo[-1].file_id,
             caption=(
@@ -540,7 +571,8 @@ async def process_payment_screenshot(message: types.Message, state: FSMContext):
                 f"⏱ Длительность: {duration_text}\n"
                 f"🆔 ID платежа: {payment_id}"
             ),
-            reply_markup=keyboard
+            reply_markup=keyboard,
+            priority=PRIORITY_CRITICAL
         )
 
         # Отправляем подтверждение пользователю
@@ -571,32 +603,32 @@ async def process_payment_verification(callback_query: types.CallbackQuery):
     
     try:
         action, payment_id = callback_query.data.split(':')
-        payment_data = db.get_payment(payment_id)
+        payment_data = await db.get_payment(payment_id)
         
         if not payment_data:
             await callback_query.answer("❌ Платёж не найден")
             return
         
-        # Распаковываем данные платежа
-        payment_id, user_id, amount, duration, status, created_at = payment_data
+        user_id = payment_data.user_id
+        duration = payment_data.duration_months
         
         # Проверяем, не был ли платеж уже обработан
-        if status != 'pending':
+        if payment_data.status != 'pending':
             await callback_query.answer("❌ Этот платёж уже был обработан")
             return
             
         if action == "confirm":
             try:
                 # Обновляем статус платежа
-                db.update_payment_status(payment_id, "confirmed")
+                await db.update_payment_status(payment_id, "confirmed")
                 logging.info(f"Updated payment {payment_id} status to confirmed")
                 
                 # Получаем текущую подписку пользователя
-                current_subscription = db.get_subscription(user_id)
+                current_subscription = await db.get_subscription(user_id)
                 client_name = f"user_{user_id}"
                 
                 # Проверяем существующую конфигурацию клиента
-                client_config = db.get_client_config(user_id)
+                client_config = await db.get_client_config(user_id)
                 
                 # Если это новая подписка (нет конфигурации), создаем нового клиента
                 if not client_config:
@@ -613,7 +645,7 @@ async def process_payment_verification(callback_query: types.CallbackQuery):
                     logging.info("Generated client configuration")
                     
                     # Сохраняем конфигурацию
-                    db.save_client_config(user_id, {
+                    await db.save_client_config(user_id, {
                         'config_name': client_name,
                         'config': config['config'],
                         'qr_code': config.get('qr_code')  # qr_code может быть None
@@ -622,24 +654,25 @@ async def process_payment_verification(callback_query: types.CallbackQuery):
                 
                 # Добавляем или продлеваем подписку
                 duration_days = duration * 30 if duration > 0 else 1  # 1 день для тестового периода
-                if not db.add_subscription(user_id, duration_days):
+                if not await db.add_subscription(user_id, duration_days):
                     raise Exception("Failed to add subscription")
                 logging.info(f"Added/extended subscription for {duration_days} days")
                 
                 # Отправляем уведомление пользователю
-                subscription = db.get_subscription(user_id)
+                subscription = await db.get_subscription(user_id)
                 if subscription:
-                    expiration_date = datetime.strptime(subscription['expiration'].split('.')[0], '%Y-%m-%d %H:%M:%S')
+                    expiration_date = subscription.expiration
                     keyboard = types.InlineKeyboardMarkup(
                         inline_keyboard=[
                             [types.InlineKeyboardButton(text="🔑 Получить данные для подключения", callback_data="show_data")]
                         ]
                     )
-                    await bot.send_message(
+                    await send_queue.send_message(
                         user_id,
                         f"✅ Оплата подтверждена!\n\n"
                         f"Ваша подписка активна до: {expiration_date.strftime('%d.%m.%Y %H:%M')}",
-                        reply_markup=keyboard
+                        reply_markup=keyboard,
+                        priority=PRIORITY_CRITICAL
                     )
                     logging.info(f"Sent confirmation message to user {user_id}")
                 
@@ -657,13 +690,14 @@ async def process_payment_verification(callback_query: types.CallbackQuery):
                 
         elif action == "reject":
             # Обновляем статус платежа
-            db.update_payment_status(payment_id, "rejected")
+            await db.update_payment_status(payment_id, "rejected")
             
             # Отправляем уведомление пользователю
-            await bot.send_message(
+            await send_queue.send_message(
                 user_id,
                 "❌ Ваш платёж был отклонён.\n"
-                "Пожалуйста, проверьте правильность оплаты и попробуйте снова."
+                "Пожалуйста, проверьте правильность оплаты и попробуйте снова.",
+                priority=PRIORITY_CRITICAL
             )
             
             # Отвечаем админу
@@ -678,232 +712,10 @@ async def process_payment_verification(callback_query: types.CallbackQuery):
         logging.error(f"Error processing payment verification: {e}", exc_info=True)
         await callback_query.answer("❌ Произошла ошибка при обработке платежа")
 
-async def check_expired_subscriptions():
-    """Проверка и деактивация истекших подписок"""
-    while True:
-        try:
-            logging.info("Checking for expired subscriptions...")
-            
-            # Получаем истекшие подписки
-            expired_subscriptions = db.get_expired_subscriptions()
-            
-            for sub in expired_subscriptions:
-                try:
-                    client_name = f"user_{sub['user_id']}"
-                    
-                    # Добавляем повторные попытки отключения
-                    max_retries = 3
-                    for attempt in range(max_retries):
-                        try:
-                            # Получаем актуальный список клиентов
-                            clients = await wg_api.get_clients()
-                            existing_client = None
-                            for client in clients:
-                                if client['name'] == client_name:
-                                    existing_client = client
-                                    break
-                            
-                            if existing_client:
-                                client = existing_client
-                                logging.info(f"Using existing client: {json.dumps(client, indent=2)}")
-                            else:
-                                # Если клиент не найден (был удален), создаем нового
-                                client = await wg_api.create_client(client_name)
-                                logging.info(f"Created new client: {json.dumps(client, indent=2)}")
-                            
-                            # Проверяем текущий статус
-                            if client.get('enabled', False):
-                                # Отключаем клиента
-                                response = await wg_api.update_client(client_name, enable=False)
-                                logging.info(f"WireGuard API response: {response}")
-                                if response:  # проверяем успешность отключения
-                                    logging.info(f"Successfully disabled WireGuard client {client_name} on attempt {attempt + 1}")
-                                    break
-                            else:
-                                logging.info(f"Client {client_name} is already disabled")
-                                break
-                        
-                        except Exception as e:
-                            if attempt < max_retries - 1:
-                                logging.error(f"Error disabling client on attempt {attempt + 1}: {e}")
-                                await asyncio.sleep(1)  # пауза перед следующей попыткой
-                            else:
-                                logging.error(f"Failed to disable client after {max_retries} attempts: {e}")
-                    
-                    # Деактивируем подписку в базе
-                    db.deactivate_subscription(sub['user_id'])
-                    logging.info(f"Deactivated subscription in database for user {sub['user_id']}")
-                    
-                    # Удаляем файлы конфигурации
-                    config_manager.cleanup_old_configs(sub['user_id'])
-                    
-                    # Отправляем уведомление только если оно еще не было отправлено
-                    if not notification_sent.get(sub['user_id'], {}).get('expired'):
-                        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                            [types.InlineKeyboardButton(text="Продлить подписку", callback_data="buy")]
-                        ])
-                        
-                        await bot.send_message(
-                            sub['user_id'],
-                            "❌ Ваша подписка истекла!\n"
-                            "Для продолжения использования VPN необходимо продлить подписку.",
-                            reply_markup=keyboard
-                        )
-                        notification_sent[sub['user_id']] = {'expired': True}
-                        logging.info(f"- Отправлено уведомление об истечении подписки пользователю {sub['user_id']}")
-                    
-                except Exception as e:
-                    logging.error(f"Error processing expired subscription {sub['id']}: {e}")
-                    continue
-            
-        except Exception as e:
-            logging.error(f"Error checking expired subscriptions: {e}")
-        
-        await asyncio.sleep(60)  # проверяем каждую минуту
-
-async def check_subscriptions():
-    """Проверка подписок и отправка уведомлений"""
-    global notification_sent
-    
-    # Флаг для отслеживания запущенной задачи
-    if hasattr(check_subscriptions, 'is_running') and check_subscriptions.is_running:
-        logging.warning("check_subscriptions уже запущен, пропускаем новый запуск")
-        return
-        
-    check_subscriptions.is_running = True
-    logging.info("=== Запуск процесса проверки подписок ===")
-    
-    CHECK_INTERVAL = 3600  # Проверка каждый час
-    
-    while True:
-        try:
-            current_time = datetime.now()
-            logging.info(f"=== Новый цикл проверки подписок: {current_time} ===")
-            
-            # Получаем все активные подписки и клиентов WireGuard
-            active_subscriptions = db.get_active_subscriptions()
-            clients = await wg_api.get_clients()
-            logging.info(f"Найдено активных подписок: {len(active_subscriptions)}")
-            
-            for sub in active_subscriptions:
-                try:
-                    user_id = sub['user_id']
-                    expiration = datetime.strptime(str(sub['expiration']).split('.')[0], '%Y-%m-%d %H:%M:%S')
-                    time_left = expiration - current_time
-                    hours_left = time_left.total_seconds() / 3600
-                    
-                    # Если подписка истекла
-                    if time_left.total_seconds() <= 0:
-                        await handle_expired_subscription(user_id, sub, clients)
-                        continue
-                    
-                    # Отправляем уведомление только за 24 часа до истечения
-                    # и только если оно еще не было отправлено
-                    if 23 <= hours_left <= 24 and not notification_sent.get(user_id, {}).get('24h_warning'):
-                        await send_warning_notification(user_id, time_left, "24 часа")
-                        if user_id not in notification_sent:
-                            notification_sent[user_id] = {}
-                        notification_sent[user_id]['24h_warning'] = True
-                        logging.info(f"Отправлено уведомление за 24 часа пользователю {user_id}")
-                    
-                except Exception as e:
-                    logging.error(f"Ошибка при обработке подписки пользователя {user_id}: {e}")
-                    continue
-            
-            # Ждем следующей проверки
-            await asyncio.sleep(CHECK_INTERVAL)
-            
-        except Exception as e:
-            logging.error(f"Ошибка в check_subscriptions: {e}")
-            await asyncio.sleep(CHECK_INTERVAL)
-
-async def handle_expired_subscription(user_id: int, sub: dict, clients: list):
-    """Обработка истекшей подписки"""
-    try:
-        client_name = f"user_{user_id}"
-        logging.info(f">>> Обработка истекшей подписки для {user_id}")
-        
-        # Принудительное отключение с повторными попытками
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                client_found = False
-                for client in clients:
-                    if client['name'] == client_name:
-                        client_found = True
-                        if client.get('enabled', False):
-                            response = await wg_api.update_client(client_name, enable=False)
-                            logging.info(f"WireGuard API response: {response}")
-                            if response:
-                                logging.info(f"Successfully disabled WireGuard client {client_name}")
-                                break
-                        else:
-                            logging.info(f"Client {client_name} is already disabled")
-                            break
-                
-                if not client_found:
-                    logging.warning(f"Client {client_name} not found in WireGuard")
-                break
-                
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    logging.error(f"Error disabling client on attempt {attempt + 1}: {e}")
-                    await asyncio.sleep(1)
-                else:
-                    logging.error(f"Failed to disable client after {max_retries} attempts: {e}")
-        
-        # Деактивируем подписку в базе
-        db.deactivate_subscription(user_id)
-        logging.info(f"- Деактивирована подписка в базе для пользователя {user_id}")
-        
-        # Удаляем файлы конфигурации
-        config_manager.cleanup_old_configs(user_id)
-        
-        # Отправляем уведомление об отключении только если оно еще не было отправлено
-        if not notification_sent.get(user_id, {}).get('expired'):
-            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                [types.InlineKeyboardButton(text="Продлить подписку", callback_data="buy")]
-            ])
-            
-            await bot.send_message(
-                user_id,
-                "❌ Ваша подписка истекла!\n"
-                "Для продолжения использования VPN необходимо продлить подписку.",
-                reply_markup=keyboard
-            )
-            if user_id not in notification_sent:
-                notification_sent[user_id] = {}
-            notification_sent[user_id]['expired'] = True
-            logging.info(f"- Отправлено уведомление об истечении подписки пользователю {user_id}")
-            
-    except Exception as e:
-        logging.error(f"Ошибка при обработке истекшей подписки для {user_id}: {e}")
-
-async def send_warning_notification(user_id: int, time_left: timedelta, time_text: str):
-    """Отправка предупреждения о скором истечении подписки"""
-    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="Продлить подписку", callback_data="extend_subscription")]
-    ])
-    
-    await bot.send_message(
-        user_id,
-        f"⚠️ Внимание! Ваша подписка VPN истекает через {time_text}!\n\n"
-        "Рекомендуем продлить подписку заранее, чтобы избежать отключения.",
-        reply_markup=keyboard
-    )
-    logging.info(f"Отправлено предупреждение пользователю {user_id} об истечении через {time_text}")
-
-def update_notification_status(user_id: int, notification_key: str):
-    """Обновление статуса отправленных уведомлений"""
-    global notification_sent
-    if user_id not in notification_sent:
-        notification_sent[user_id] = {}
-    notification_sent[user_id][notification_key] = True
-
 async def process_subscription_extension(callback_query: types.CallbackQuery):
     """Обработка продления подписки"""
     # Получаем текущую подписку
-    subscription = db.get_subscription(callback_query.from_user.id)
+    subscription = await db.get_subscription(callback_query.from_user.id)
     
     if not subscription:
         await callback_query.message.answer(
@@ -938,7 +750,7 @@ async def process_subscription_extension(callback_query: types.CallbackQuery):
 async def status_command(message: types.Message):
     """Обработка команды /status"""
     user_id = message.from_user.id
-    subscription = db.get_subscription(user_id)
+    subscription = await db.get_subscription(user_id)
     
     if not subscription:
         await message.answer(
@@ -947,11 +759,10 @@ async def status_command(message: types.Message):
         )
         return
     
-    sub_id, user_id, config_name, expiration_str, created_at, is_active = subscription
-    expiration_time = datetime.strptime(expiration_str.split('.')[0], '%Y-%m-%d %H:%M:%S')
+    expiration_time = subscription.expiration
     
     # Проверяем статус подключения в WireGuard
-    client = await wg_api.get_client(config_name)
+    client = await wg_api.get_client(f"user_{user_id}")
     connection_status = "✅ Подключен" if client and client.get('enabled', False) else "❌ Отключен"
     
     # Создаем клавиатуру для продления
@@ -974,39 +785,57 @@ async def status_command(message: types.Message):
         reply_markup=keyboard
     )
 
+COUNTER_LABELS = {
+    'users': 'Пользователей',
+    'active_subscriptions': 'Активных подписок',
+    'pending_payments': 'Платежей на проверке',
+    'confirmed_payments': 'Подтвержденных платежей',
+    'client_configs': 'Конфигураций',
+    'notifications': 'Записей журнала уведомлений',
+}
+
 @dp.message(Command("check_db"))
 async def check_database(message: types.Message):
-    """Проверка состояния базы данных"""
+    """Проверка состояния базы данных: /check_db [verify|rebuild]
+
+    Без аргументов читает счетчики (без прохода по таблицам); verify сверяет
+    их с COUNT(*), rebuild пересчитывает.
+    """
     if message.from_user.id != ADMIN_USER_ID:
         return
         
     try:
-        cursor = db.conn.cursor()
+        action = (message.text.split()[1:] or [''])[0]
+        response = "📊 Состояние базы данных:\n\n"
         
-        # Проверяем таблицы
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = cursor.fetchall()
+        if action == 'rebuild':
+            mismatches = await db.rebuild_counters()
+            response += f"🔧 Счетчики пересчитаны, исправлено расхождений: {len(mismatches)}\n"
+        elif action == 'verify':
+            mismatches = await db.check_counters()
+            response += "✅ Счетчики совпадают с таблицами\n" if not mismatches else "⚠️ Расхождения счетчиков:\n"
+            archive = await db.get_archive_stats()
+            if archive:
+                response += "Архив: " + ', '.join(f"{table} {count}" for table, count in archive.items()) + "\n"
+        else:
+            mismatches = {}
+        for name, (stored, actual) in mismatches.items():
+            response += f"{COUNTER_LABELS.get(name, name)}: {stored} -> {actual}\n"
         
-        response = "📊 Состояние базы данных:\n\n"
+        for name, value in (await db.get_counters()).items():
+            response += f"{COUNTER_LABELS.get(name, name)}: {value}\n"
         
-        for table in tables:
-            table_name = table[0]
-            cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
-            count = cursor.fetchone()[0]
-            response += f"Таблица {table_name}: {count} записей\n"
-            
-            if table_name == 'subscriptions':
-                cursor.execute("""
-                    SELECT user_id, expiration, is_active 
-                    FROM subscriptions 
-                    ORDER BY created_at DESC 
-                    LIMIT 5
-                """)
-                subs = cursor.fetchall()
-                if subs:
-                    response += "\nПоследние подписки:\n"
-                    for sub in subs:
-                        response += f"User {sub[0]}: до {sub[1]} (active: {sub[2]})\n"
+        subs = await db.get_recent_subscriptions(5)
+        if subs:
+            response += "\nПоследние подписки:\n"
+            for sub in subs:
+                response += f"User {sub[0]}: до {sub[1]} (active: {sub[2]})\n"
+        
+        cache = db.cache_stats()
+        response += (
+            f"\nКэш записей: {cache['size']}/{cache['maxsize']}, "
+            f"hit rate {cache['hit_rate']:.1%} ({cache['hits']} hits, {cache['misses']} misses)\n"
+        )
         
         await message.answer(response)
         
@@ -1014,6 +843,149 @@ async def check_database(message: types.Message):
         logging.error(f"Error checking database: {e}")
         await message.answer(f"❌ Ошибка при проверке базы данных: {e}")
 
+async def maintenance_command(message: types.Message):
+    """Ручной запуск обслуживания базы: /maintenance [archive|vacuum|optimize|backup]"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    
+    tasks = message.text.split()[1:] or None
+    unknown = set(tasks or ()) - {'archive', 'vacuum', 'optimize', 'backup'}
+    if unknown:
+        await message.answer("Использование: /maintenance [archive|vacuum|optimize|backup]")
+        return
+    
+    try:
+        await message.answer("🔧 Обслуживание базы запущено...")
+        report = await maintenance.run_once(force=True, tasks=tasks)
+        
+        response = "✅ Обслуживание завершено:\n\n"
+        if 'archived' in report:
+            moved = ', '.join(f"{table} {count}" for table, count in report['archived'].items())
+            response += f"Перенесено в архив: {moved}\n"
+        if 'vacuum_freed_pages' in report:
+            response += f"Освобождено страниц: {report['vacuum_freed_pages']}\n"
+        if 'optimized' in report:
+            response += f"Статистика: {report['optimized']}\n"
+        if report.get('backup'):
+            response += f"Резервная копия: {report['backup']} ({report['backup_seconds']:.1f} с)\n"
+        file_stats = report.get('file') or {}
+        if file_stats:
+            response += (
+                f"\nРазмер базы: {file_stats['size_bytes'] / 1048576:.1f} MiB, "
+                f"свободных страниц: {file_stats['freelist_count']}, "
+                f"auto_vacuum: {file_stats['auto_vacuum']}\n"
+            )
+        await message.answer(response)
+        
+    except Exception as e:
+        logging.error(f"Error running maintenance: {e}")
+        await message.answer(f"❌ Ошибка обслуживания базы: {e}")
+
+async def jobs_command(message: types.Message):
+    """Состояние фоновых задач: /jobs [run <имя>]"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    
+    args = message.text.split()[1:]
+    if len(args) == 2 and args[0] == 'run':
+        if args[1] not in scheduler.jobs:
+            await message.answer(f"❌ Нет задачи {args[1]}")
+            return
+        try:
+            await scheduler.run_job(args[1])
+            await message.answer(f"✅ Задача {args[1]} выполнена")
+        except Exception as e:
+            await message.answer(f"❌ Ошибка задачи {args[1]}: {e}")
+        return
+    
+    role = leader.stats()
+    response = (
+        f"⏱ Фоновые задачи ({'лидер' if role['leader'] else 'резерв'}, {role['holder']}, "
+        f"токен {role['token']}):\n\n"
+    )
+    for name, stats in scheduler.stats().items():
+        next_run = datetime.fromtimestamp(stats['next_run']).strftime('%d.%m %H:%M:%S') if stats['next_run'] else '-'
+        response += (
+            f"{name} ({stats['trigger']}): запусков {stats['runs']}, ошибок {stats['failures']}, "
+            f"пропусков {stats['skipped']}, среднее {stats['avg_duration']:.2f} с, "
+            f"максимум {stats['max_duration']:.2f} с, следующий {next_run}\n"
+        )
+        if stats['last_error']:
+            response += f"  последняя ошибка: {stats['last_error']}\n"
+    outbox = await db.get_outbox_stats()
+    response += (
+        f"\n📤 Outbox: ожидают {outbox['pending']}, старейшее {outbox['oldest_age']:.0f} с, "
+        f"неудачных {outbox['dead']}"
+    )
+    sends = send_queue.stats()
+    depth = ', '.join(f"{lane} {count}" for lane, count in sends['depth'].items())
+    response += (
+        f"\n✉️ Отправка: {sends['sent']} доставлено, {sends['failed']} ошибок, "
+        f"{sends['per_second']:.1f} сообщ./с за минуту, очередь: {depth}, "
+        f"flood control {sends['retry_after']} раз, макс. ожидание {sends['max_wait']:.1f} с"
+    )
+    if webhook is not None:
+        updates = webhook.stats()
+        response += (
+            f"\n🌐 Webhook: принято {updates['received']}, отклонено {updates['rejected']}, "
+            f"ошибок {updates['failed']}, в очереди {updates['queued']}, "
+            f"задержка p50 {updates['p50'] * 1000:.0f} мс, макс. {updates['max'] * 1000:.0f} мс"
+        )
+    cached = file_ids.stats()
+    response += f"\n📎 Файлы конфигураций: {cached['hits']} по file_id, {cached['uploads']} загрузок"
+    await message.answer(response)
+
+def format_broadcast(broadcast) -> str:
+    """Текст прогресса рассылки для администратора"""
+    done = broadcast.sent + broadcast.failed
+    percent = done * 100 // broadcast.total if broadcast.total else 100
+    status = {'running': '⏳ выполняется', 'done': '✅ завершена', 'cancelled': '⛔️ отменена'}
+    return (
+        f"📣 Рассылка #{broadcast.id} ({broadcast.segment}): {status.get(broadcast.status, broadcast.status)}\n"
+        f"Обработано {done} из {broadcast.total} ({percent}%): доставлено {broadcast.sent}, "
+        f"ошибок {broadcast.failed}"
+    )
+
+async def report_broadcast_progress(broadcast):
+    """Обновление сообщения с прогрессом рассылки"""
+    if broadcast.chat_id is None or broadcast.message_id is None:
+        return
+    try:
+        await send_queue.submit(
+            'edit_message_text', broadcast.chat_id,
+            text=format_broadcast(broadcast), message_id=broadcast.message_id
+        )
+    except TelegramBadRequest as e:
+        # Текст не изменился с прошлого обновления
+        logging.debug(f"Broadcast progress not updated: {e}")
+
+async def broadcast_command(message: types.Message):
+    """Рассылка: /broadcast <сегмент> <текст>, /broadcast cancel <id>, /broadcast - текущие"""
+    if message.from_user.id != ADMIN_USER_ID:
+        return
+    
+    args = message.text.split(maxsplit=2)[1:]
+    if len(args) == 2 and args[0] == 'cancel' and args[1].isdigit():
+        if await broadcasts.cancel(int(args[1])):
+            await message.answer(f"⛔️ Рассылка #{args[1]} будет остановлена")
+        else:
+            await message.answer(f"❌ Нет выполняющейся рассылки #{args[1]}")
+        return
+    if len(args) < 2 or args[0] not in BROADCAST_SEGMENTS:
+        running = await db.get_running_broadcasts()
+        await message.answer(
+            "Использование: /broadcast <сегмент> <текст>\n"
+            f"Сегменты: {', '.join(BROADCAST_SEGMENTS)}\n"
+            "Отмена: /broadcast cancel <id>\n\n"
+            + ('\n\n'.join(format_broadcast(broadcast) for broadcast in running) or "Активных рассылок нет")
+        )
+        return
+    
+    segment, text = args
+    progress = await message.answer(f"📣 Подготовка рассылки ({segment})...")
+    broadcast_id = await broadcasts.start(segment, text, chat_id=progress.chat.id, message_id=progress.message_id)
+    await report_broadcast_progress(await db.get_broadcast(broadcast_id))
+
 async def init_wg_api():
     """Инициализация и проверка подключения к WireGuard API"""
     global wg_api
@@ -1042,13 +1014,39 @@ async def init_wg_api():
         logging.error(f"Exception during WireGuard API initialization: {str(e)}")
         return False
 
+async def run_webhook():
+    """Прием обновлений через webhook до SIGINT/SIGTERM"""
+    global webhook
+    webhook = WebhookServer(
+        dp, bot,
+        path=urlsplit(WEBHOOK_URL).path or '/',
+        secret_token=WEBHOOK_SECRET,
+        url=WEBHOOK_URL,
+        workers=int(os.getenv('WEBHOOK_WORKERS', '16')),
+    )
+    await dp.emit_startup(bot=bot)
+    try:
+        await webhook.serve(os.getenv('WEBHOOK_HOST', '0.0.0.0'), int(os.getenv('WEBHOOK_PORT', '8080')))
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
 async def main():
     """Запуск бота"""
-    if not ensure_single_instance():
+    if BOT_MODE not in ('polling', 'webhook'):
+        logging.error(f"Unknown BOT_MODE {BOT_MODE!r}, expected polling or webhook")
+        return
+    if BOT_MODE == 'webhook' and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        logging.error("BOT_MODE=webhook requires WEBHOOK_URL and WEBHOOK_SECRET")
+        return
+    if SINGLE_INSTANCE and not ensure_single_instance():
         logging.error("Выход: другой экземпляр бота уже запущен")
         return
 
     try:
+        # Пул соединений и схема хранилища
+        await db.connect()
+        
         # Инициализация WireGuard API
         if not await init_wg_api():
             logging.error("Failed to initialize WireGuard API. Exiting...")
@@ -1058,6 +1056,9 @@ async def main():
         dp.message.register(handle_start, Command("start"))
         dp.message.register(status_command, Command("status"))
         dp.message.register(check_database, Command("check_db"))
+        dp.message.register(maintenance_command, Command("maintenance"))
+        dp.message.register(jobs_command, Command("jobs"))
+        dp.message.register(broadcast_command, Command("broadcast"))
         
         # Регистрация хэндлеров состояний
         dp.message.register(process_payment_screenshot, PaymentStates.waiting_for_screenshot)
@@ -1074,11 +1075,33 @@ async def main():
         dp.callback_query.register(show_user_data, lambda c: c.data == "my_data")
         dp.callback_query.register(show_connection_data, lambda c: c.data == "show_connection_data")
         
-        # Запускаем бота
-        await dp.start_polling(bot)
+        # Фоновые задачи: истечение подписок, предупреждения, обслуживание базы
+        SubscriptionJobs(db, send_queue, wg_api, config_manager).register(scheduler)
+        maintenance.register_jobs(scheduler)
+        broadcasts.on_progress = report_broadcast_progress
+        broadcasts.register(scheduler)
+        send_task = asyncio.create_task(send_queue.run())
+        leader_task = asyncio.create_task(leader.run())
+        scheduler_task = asyncio.create_task(scheduler.run())
+        try:
+            if BOT_MODE == 'webhook':
+                await run_webhook()
+            else:
+                # Webhook от прошлого запуска мешает getUpdates; накопившиеся обновления сохраняются
+                await bot.delete_webhook(drop_pending_updates=False)
+                await dp.start_polling(bot)
+        finally:
+            scheduler_task.cancel()
+            leader_task.cancel()
+            send_task.cancel()
+            # Аренду освобождаем до закрытия базы, чтобы другая реплика подхватила ее сразу
+            await asyncio.gather(scheduler_task, leader_task, send_task, return_exceptions=True)
     except Exception as e:
         logging.error(f"Error starting bot: {e}")
         raise
+    finally:
+        # Дожидаемся записи очереди и закрываем соединения с базой
+        await db.close()
 
 @dp.callback_query(lambda c: c.data == "my_data")
 async def show_user_data(callback_query: types.CallbackQuery):
@@ -1086,7 +1109,7 @@ async def show_user_data(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
     # Получаем активную подписку пользователя
-    subscription = db.get_subscription(user_id)
+    subscription = await db.get_subscription(user_id)
     if not subscription:
         keyboard = types.InlineKeyboardMarkup(
             inline_keyboard=[
@@ -1102,7 +1125,7 @@ async def show_user_data(callback_query: types.CallbackQuery):
         return
 
     # Получаем конфигурацию из базы
-    config = db.get_client_config(user_id)
+    config = await db.get_client_config(user_id)
     if not config:
         await callback_query.message.edit_text(
             "⚠️ Ошибка: не удалось получить данные подключения.\n"
@@ -1136,15 +1159,16 @@ async def show_user_data(callback_query: types.CallbackQuery):
     )
 
     # Если есть QR-код, отправляем его
-    if config.get('qr_code'):
-        await callback_query.message.answer_photo(
-            photo=types.BufferedInputFile(
-                config['qr_code'].encode(),
-                filename="config.png"
-            ),
+    if config.qr_path and os.path.exists(config.qr_path):
+        await file_ids.send(
+            functools.partial(send_queue.send_photo, user_id),
+            user_id,
+            config,
+            'qr',
             caption=message_text,
             parse_mode="HTML",
-            reply_markup=keyboard
+            reply_markup=keyboard,
+            priority=PRIORITY_CRITICAL
         )
         await callback_query.message.delete()
     else:
@@ -1161,14 +1185,16 @@ async def show_config(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
     # Получаем конфигурацию из базы
-    config = db.get_client_config(user_id)
-    if not config or 'config' not in config:
+    config = await db.get_client_config(user_id)
+    if not config or not config.config_path or not os.path.exists(config.config_path):
         await callback_query.answer("⚠️ Ошибка: конфигурация не найдена")
         return
+    with open(config.config_path) as f:
+        config_text = f.read()
 
     # Отправляем конфигурацию в текстовом виде
     await callback_query.message.answer(
-        "<code>" + config['config'] + "</code>",
+        "<code>" + config_text + "</code>",
         parse_mode="HTML",
         reply_markup=types.InlineKeyboardMarkup(
             inline_keyboard=[[
@@ -1185,12 +1211,12 @@ async def show_connection_data(callback_query: types.CallbackQuery):
         user_id = callback_query.from_user.id
         
         # Проверяем активную подписку
-        subscription = db.get_subscription(user_id)
+        subscription = await db.get_subscription(user_id)
         if not subscription:
             await callback_query.answer("❌ У вас нет активной подписки")
             return
             
-        if not db.check_subscription(user_id):
+        if not await db.check_subscription(user_id):
             await callback_query.answer("❌ Ваша подписка истекла")
             return
         
@@ -1198,11 +1224,9 @@ async def show_connection_data(callback_query: types.CallbackQuery):
         client_name = f"user_{user_id}"
         try:
             # Сначала проверяем, есть ли сохраненная конфигурация
-            client_config = db.get_client_config(user_id)
-            if client_config and client_config['config_path'] and client_config['qr_path']:
+            client_config = await db.get_client_config(user_id)
+            if client_config and client_config.config_path and client_config.qr_path:
                 logging.info(f"Using saved configuration for user {user_id}")
-                config_path = client_config['config_path']
-                qr_path = client_config['qr_path']
             else:
                 # Если нет сохраненной конфигурации, создаем новую
                 clients = await wg_api.get_clients()
@@ -1228,25 +1252,32 @@ async def show_connection_data(callback_query: types.CallbackQuery):
                     raise Exception("Failed to save configuration files")
                 
                 # Сохраняем конфигурацию в базу данных
-                db.save_client_config(user_id, {
+                await db.save_client_config(user_id, {
                     'private_key': client['privateKey'],
                     'public_key': client['publicKey'],
                     'pre_shared_key': client['preSharedKey'],
                     'config_path': config_path,
                     'qr_path': qr_path
                 })
+                client_config = await db.get_client_config(user_id)
             
-            # Отправляем конфигурацию
-            await bot.send_document(
+            # Отправляем конфигурацию (повторно - по file_id, без загрузки)
+            await file_ids.send(
+                functools.partial(send_queue.send_document, user_id),
                 user_id,
-                FSInputFile(config_path),
-                caption="📝 Ваш файл конфигурации WireGuard"
+                client_config,
+                'config',
+                caption="📝 Ваш файл конфигурации WireGuard",
+                priority=PRIORITY_CRITICAL
             )
             
-            await bot.send_photo(
+            await file_ids.send(
+                functools.partial(send_queue.send_photo, user_id),
                 user_id,
-                FSInputFile(qr_path),
-                caption="🔐 Ваши данные для подключения"
+                client_config,
+                'qr',
+                caption="🔐 Ваши данные для подключения",
+                priority=PRIORITY_CRITICAL
             )
             
             await callback_query.answer("✅ Данные для подключения отправлены")
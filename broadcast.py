@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from records import Broadcast
+from scheduler import DynamicTrigger, Scheduler
+from send_queue import PRIORITY_BULK, SendQueue
+from storage import BROADCAST_SEGMENTS, Storage
+
+class BroadcastEngine:
+    """Рассылки администратора по сегментам пользователей (BROADCAST_SEGMENTS).
+
+    Рассылка сохраняется в таблице broadcasts и выполняется задачей
+    планировщика (то есть только на реплике-лидере). Получатели читаются
+    из базы страницами по user_id, страница целиком ставится в очередь
+    отправки с приоритетом bulk (темп задает SendQueue), после нее в базу
+    пишутся курсор и счетчики. После падения или смены лидера рассылка
+    продолжается с курсора; повторно могут уйти сообщения только
+    незавершенной страницы.
+
+    Прогресс передается в on_progress(broadcast) не чаще раза в
+    progress_interval секунд и по завершении.
+    """
+
+    def __init__(self, db: Storage, sender: SendQueue, page_size: int = 200,
+                 on_progress: Optional[Callable[[Broadcast], Awaitable]] = None,
+                 progress_interval: float = 5.0, poll_interval: float = 60.0):
+        self.db = db
+        self.sender = sender
+        self.page_size = page_size
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self.on_wakeup = None
+        self._pending = True
+        self._last_run = 0.0
+
+    def register(self, scheduler: Scheduler):
+        """Задача broadcasts: сразу после start(), иначе проверка раз в poll_interval"""
+        self.on_wakeup = scheduler.wake
+        scheduler.add_job('broadcasts', self.run_pending, DynamicTrigger(self.next_run_time))
+
+    def next_run_time(self, now: float) -> float:
+        return now if self._pending else self._last_run + self.poll_interval
+
+    async def start(self, segment: str, text: str, chat_id=None, message_id=None) -> int:
+        """Создание рассылки; выполнять ее начнет задача broadcasts"""
+        if segment not in BROADCAST_SEGMENTS:
+            raise ValueError(f"Unknown segment {segment!r}, expected one of: {', '.join(BROADCAST_SEGMENTS)}")
+        total = await self.db.count_broadcast_recipients(segment)
+        broadcast_id = await self.db.create_broadcast(segment, text, total, chat_id, message_id)
+        logging.info(f"Broadcast {broadcast_id} to {segment} created for {total} users")
+        self._pending = True
+        if self.on_wakeup is not None:
+            self.on_wakeup()
+        return broadcast_id
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """Отмена; выполняющаяся рассылка остановится после текущей страницы"""
+        return await self.db.cancel_broadcast(broadcast_id)
+
+    async def run_pending(self):
+        """Выполнение всех незавершенных рассылок по очереди"""
+        self._pending = False
+        try:
+            for broadcast in await self.db.get_running_broadcasts():
+                await self._run(broadcast)
+        finally:
+            self._last_run = time.time()
+
+    async def _send(self, user_id: int, text: str) -> bool:
+        try:
+            await self.sender.send_message(user_id, text, priority=PRIORITY_BULK)
+            return True
+        except Exception as e:
+            # Чаще всего пользователь заблокировал бота
+            logging.debug(f"Broadcast message to {user_id} failed: {e}")
+            return False
+
+    async def _report(self, broadcast_id: int):
+        if self.on_progress is None:
+            return
+        try:
+            await self.on_progress(await self.db.get_broadcast(broadcast_id))
+        except Exception as e:
+            logging.warning(f"Failed to report broadcast {broadcast_id} progress: {e}")
+
+    async def _run(self, broadcast: Broadcast):
+        logging.info(f"Broadcast {broadcast.id}: sending to {broadcast.segment} from user_id > {broadcast.cursor}")
+        cursor, sent, failed = broadcast.cursor, broadcast.sent, broadcast.failed
+        started = time.monotonic()
+        reported = started
+        status = broadcast.status
+        while status == 'running':
+            page = await self.db.get_broadcast_recipients_page(broadcast.segment, cursor, self.page_size)
+            if not page:
+                status = await self.db.update_broadcast(broadcast.id, cursor, sent, failed, 'done')
+                break
+            results = await asyncio.gather(*(self._send(user_id, broadcast.text) for user_id in page))
+            delivered = sum(results)
+            sent += delivered
+            failed += len(results) - delivered
+            cursor = page[-1]
+            status = await self.db.update_broadcast(broadcast.id, cursor, sent, failed)
+            if time.monotonic() - reported >= self.progress_interval:
+                reported = time.monotonic()
+                await self._report(broadcast.id)
+        elapsed = time.monotonic() - started
+        logging.info(f"Broadcast {broadcast.id} {status}: {sent} sent, {failed} failed in {elapsed:.0f}s")
+        await self._report(broadcast.id)
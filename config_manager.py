@@ -125,3 +125,20 @@ class ConfigManager:
             
         except Exception as e:
             logging.error(f"Error cleaning up old configs for user {user_id} on server {server_name}: {e}")
+
+    def remove_configs(self, user_id: int, client_name: str) -> int:
+        """Удаляет файлы конфигурации и QR код клиента (повторный вызов безопасен)
+
+        Returns:
+            int: Количество удаленных файлов
+        """
+        removed = 0
+        for path in (os.path.join(self.configs_dir, f"{client_name}.conf"),
+                     os.path.join(self.qr_codes_dir, f"{client_name}.png")):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        logging.info(f"Removed {removed} config files for user {user_id}")
+        return removed
@@ -0,0 +1,11 @@
+import logging
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def quiet_logs():
+    """Тесты намеренно вызывают ошибки и предупреждения - не засоряем вывод"""
+    logging.disable(logging.CRITICAL)
+    yield
+    logging.disable(logging.NOTSET)
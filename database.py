@@ -1,136 +1,387 @@
+import json
+import os
 import sqlite3
 import logging
-from datetime import datetime, timedelta
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Optional, Dict
 
+import migrations
+from records import Broadcast, ClientConfig, OutboxEvent, Payment, Subscription, User, from_epoch, to_epoch
+from storage import BROADCAST_SEGMENTS, warning_type
+
+# Профиль соединения по умолчанию: WAL не блокирует читателей на время записи,
+# а synchronous=NORMAL в WAL режиме делает fsync только при checkpoint.
+DEFAULT_CONNECTION_PROFILE = {
+    'auto_vacuum': 'INCREMENTAL',  # новая база; существующую переводит enable_incremental_vacuum()
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,         # мс ожидания блокировки вместо "database is locked"
+    'cache_size': -16000,         # отрицательное значение - размер в KiB
+    'mmap_size': 134217728,       # 128 MiB
+    'temp_store': 'MEMORY',
+    'wal_autocheckpoint': 1000,   # страниц WAL до автоматического PASSIVE checkpoint
+    'journal_size_limit': 67108864,  # WAL усекается до 64 MiB после checkpoint
+}
+
+# Исходные настройки sqlite3 (rollback journal + fsync на каждый commit)
+LEGACY_CONNECTION_PROFILE = {
+    'auto_vacuum': None,
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+    'busy_timeout': None,
+    'cache_size': None,
+    'mmap_size': None,
+    'temp_store': None,
+    'wal_autocheckpoint': None,
+    'journal_size_limit': None,
+}
+
+# Порядок применения важен: auto_vacuum действует только до создания первой
+# таблицы, journal_mode должен быть выставлен до остальных
+_PRAGMA_ORDER = (
+    'auto_vacuum', 'journal_mode', 'synchronous', 'busy_timeout', 'cache_size',
+    'mmap_size', 'temp_store', 'wal_autocheckpoint', 'journal_size_limit',
+)
+
+# PRAGMA, которые нельзя или не нужно менять на read-only соединении
+_WRITER_ONLY_PRAGMAS = ('auto_vacuum', 'journal_mode', 'wal_autocheckpoint', 'journal_size_limit')
+
+class LRUCache:
+    """Ограниченный потокобезопасный LRU кэш записей с метриками попаданий.
+
+    Один экземпляр может разделяться несколькими соединениями (писатель и
+    читатели AsyncDatabase). Счетчик поколений защищает от гонки, когда
+    читатель кладет в кэш значение, прочитанное до commit инвалидирующей
+    записи. ttl ограничивает устаревание, если пишут другие процессы.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: Optional[float] = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Возвращает (найдено, значение)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._data[key]
+            self.misses += 1
+            return False, None
+
+    def generation(self) -> int:
+        """Текущее поколение; снимается перед чтением из базы"""
+        return self._generation
+
+    def put(self, key, value, generation: int):
+        """Сохранить значение, если с начала чтения не было инвалидаций"""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            expires_at = time.monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+# Маркер инвалидации всего кэша (clear_all_data)
+_ALL_RECORDS = object()
+
+# Холодные данные: таблица -> (колонки, условие переноса в архив). :cutoff -
+# UTC epoch секунды; платежи на проверке и активные подписки не переносятся.
+# В notifications created_at - текст CURRENT_TIMESTAMP (UTC).
+ARCHIVE_TABLES = {
+    'payments': (
+        'payment_id, user_id, amount, duration_months, status, created_at',
+        "status <> 'pending' AND created_at < :cutoff",
+    ),
+    'subscriptions': (
+        'id, user_id, expiration, created_at, is_active',
+        'is_active = 0 AND expiration < :cutoff',
+    ),
+    'notifications': (
+        'id, user_id, subscription_id, notification_type, created_at',
+        "created_at < datetime(:cutoff, 'unixepoch')",
+    ),
+}
+
+ARCHIVE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS archive.payments (
+        payment_id TEXT,
+        user_id INTEGER,
+        amount REAL,
+        duration_months INTEGER,
+        status TEXT,
+        created_at INTEGER,
+        archived_at INTEGER,
+        -- payment_id может повториться после переноса (create_payment берет str(user_id))
+        PRIMARY KEY (payment_id, created_at)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_payments_user ON payments(user_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.subscriptions (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        expiration INTEGER,
+        created_at INTEGER,
+        is_active INTEGER,
+        archived_at INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_subscriptions_user ON subscriptions(user_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.notifications (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        subscription_id INTEGER,
+        notification_type TEXT,
+        created_at TIMESTAMP,
+        archived_at INTEGER
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_notifications_subscription ON notifications(subscription_id)',
+]
+
 class Database:
-    def __init__(self, db_file):
-        """Инициализация соединения с БД"""
-        self.db_file = db_file
-        self.conn = sqlite3.connect(db_file)
-        self.create_tables()
+    def __init__(self, db_file, profile: Optional[Dict] = None, read_only: bool = False,
+                 cache: Optional[LRUCache] = None, archive_file: Optional[str] = None):
+        """Инициализация соединения с БД
 
-    def create_tables(self):
-        """Создание необходимых таблиц"""
-        cursor = self.conn.cursor()
-        
-        try:
-            logging.info("Checking database structure...")
-            
-            # Проверяем существование таблиц
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            existing_tables = [table[0] for table in cursor.fetchall()]
-            logging.info(f"Existing tables: {existing_tables}")
-            
-            # Создаем таблицу пользователей если её нет
-            if 'users' not in existing_tables:
-                cursor.execute('''
-                CREATE TABLE users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                ''')
-                logging.info("Created users table")
-
-            # Пересоздаем таблицу подписок
-            cursor.execute("DROP TABLE IF EXISTS subscriptions")
-            cursor.execute('''
-            CREATE TABLE subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                expiration TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_active INTEGER DEFAULT 1,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
+        profile переопределяет значения DEFAULT_CONNECTION_PROFILE.
+        read_only открывает файл только на чтение и не трогает схему
+        (используется пулом читателей AsyncDatabase).
+        cache - общий кэш подписок и конфигураций по пользователю;
+        LRUCache(maxsize=0) отключает кэширование.
+        archive_file - файл архива холодных строк (ATTACH как archive);
+        без него архивирование отключено.
+        """
+        self.db_file = db_file
+        self.cache = cache if cache is not None else LRUCache()
+        self._pending_invalidations = set()
+        self.profile = {**DEFAULT_CONNECTION_PROFILE, **(profile or {})}
+        self.read_only = read_only
+        self._batch_depth = 0
+        self._savepoints = []
+        timeout = (self.profile.get('busy_timeout') or 5000) / 1000
+        if read_only:
+            self.conn = sqlite3.connect(
+                f"file:{db_file}?mode=ro", uri=True, timeout=timeout, check_same_thread=False
             )
-            ''')
-            logging.info("Recreated subscriptions table with new structure")
+        else:
+            self.conn = sqlite3.connect(db_file, timeout=timeout)
+        self.apply_profile()
+        if not read_only:
+            self.migrate()
+        self.archive_file = archive_file
+        if archive_file:
+            self.attach_archive(archive_file)
+        self._create_history_views()
 
-            # Пересоздаем таблицу платежей
-            cursor.execute("DROP TABLE IF EXISTS payments")
-            cursor.execute('''
-            CREATE TABLE payments (
-                payment_id TEXT PRIMARY KEY,
-                user_id INTEGER,
-                amount REAL,
-                duration_months INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-            ''')
-            logging.info("Recreated payments table with new structure")
+    def apply_profile(self):
+        """Применение PRAGMA из профиля соединения"""
+        unknown = set(self.profile) - set(_PRAGMA_ORDER)
+        if unknown:
+            raise ValueError(f"Unknown connection profile options: {sorted(unknown)}")
+        for name in _PRAGMA_ORDER:
+            if self.read_only and name in _WRITER_ONLY_PRAGMAS:
+                continue
+            if name in self.profile and self.profile[name] is not None:
+                value = self.conn.execute(f"PRAGMA {name}={self.profile[name]}").fetchone()
+                if name == 'journal_mode':
+                    logging.info(f"Database journal mode: {value[0] if value else None}")
 
-            # Пересоздаем таблицу конфигураций
-            cursor.execute("DROP TABLE IF EXISTS client_configs")
-            cursor.execute('''
-            CREATE TABLE client_configs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE,
-                private_key TEXT,
-                public_key TEXT,
-                pre_shared_key TEXT,
-                config_path TEXT,
-                qr_path TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
+    def attach_archive(self, archive_file: str):
+        """Подключение архива холодных строк (писатель создает его схему)"""
+        if self.read_only:
+            self.conn.execute("ATTACH DATABASE ? AS archive", (f"file:{archive_file}?mode=ro",))
+            return
+        self.conn.execute("ATTACH DATABASE ? AS archive", (archive_file,))
+        if self.profile.get('journal_mode'):
+            self.conn.execute(f"PRAGMA archive.journal_mode={self.profile['journal_mode']}")
+        for statement in ARCHIVE_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def _create_history_views(self):
+        """TEMP представления all_<таблица>: оперативные строки вместе с архивными
+
+        TEMP объекты живут в соединении, поэтому создаются на каждом, включая
+        read-only. Без архива представление совпадает с таблицей. Условие по
+        user_id SQLite переносит внутрь обеих частей UNION ALL и использует
+        индексы.
+        """
+        for table, (columns, _) in ARCHIVE_TABLES.items():
+            archived = f" UNION ALL SELECT {columns} FROM archive.{table}" if self.archive_file else ""
+            self.conn.execute(
+                f"CREATE TEMP VIEW IF NOT EXISTS all_{table} AS SELECT {columns} FROM main.{table}{archived}"
             )
-            ''')
-            logging.info("Recreated client_configs table with new structure")
 
-            # Создаем таблицу уведомлений если её нет
-            if 'notifications' not in existing_tables:
-                cursor.execute('''
-                CREATE TABLE notifications (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    subscription_id INTEGER,
-                    notification_type TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (subscription_id) REFERENCES subscriptions(id)
-                )
-                ''')
-                logging.info("Created notifications table")
-
-            # Создаем индексы
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active ON subscriptions(user_id, is_active)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)')
+    def checkpoint(self, mode: str = 'PASSIVE'):
+        """Принудительный checkpoint WAL (PASSIVE, FULL, RESTART или TRUNCATE)
 
+        Возвращает (busy, wal_frames, checkpointed_frames).
+        """
+        mode = mode.upper()
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError(f"Invalid checkpoint mode: {mode}")
+        result = self.conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+        logging.debug(f"WAL checkpoint {mode}: {result}")
+        return result
+
+    def _commit(self):
+        """Commit, отложенный до выхода из batch(), если он открыт"""
+        if self._batch_depth == 0:
             self.conn.commit()
-            logging.info("Database structure check completed")
-        except Exception as e:
+            self._flush_invalidations()
+
+    def _rollback(self):
+        """Откат текущей операции: внутри batch() - только до ее savepoint"""
+        if self._batch_depth == 0:
             self.conn.rollback()
-            logging.error(f"Error checking/creating database structure: {e}")
+            self._flush_invalidations()
+        elif self._savepoints:
+            self.conn.execute(f"ROLLBACK TO {self._savepoints[-1]}")
+        else:
+            raise sqlite3.OperationalError("Rollback inside batch() requires a savepoint")
+
+    @contextmanager
+    def batch(self):
+        """Групповой commit: все записи внутри блока фиксируются одним commit"""
+        if self._batch_depth == 0 and not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.conn.rollback()
+                self._flush_invalidations()
+            raise
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.conn.commit()
+            self._flush_invalidations()
+
+    @contextmanager
+    def savepoint(self):
+        """Savepoint для одной операции внутри batch()"""
+        name = f"op_{len(self._savepoints)}"
+        self.conn.execute(f"SAVEPOINT {name}")
+        self._savepoints.append(name)
+        try:
+            yield
+        except BaseException:
+            self.conn.execute(f"ROLLBACK TO {name}")
             raise
         finally:
-            cursor.close()
+            self._savepoints.pop()
+            self.conn.execute(f"RELEASE {name}")
+
+    def _invalidate(self, *keys):
+        """Пометить записи кэша устаревшими; сброс происходит после commit"""
+        self._pending_invalidations.update(keys)
+
+    def _flush_invalidations(self):
+        if self._pending_invalidations:
+            if _ALL_RECORDS in self._pending_invalidations:
+                self.cache.clear()
+            else:
+                self.cache.invalidate(self._pending_invalidations)
+            self._pending_invalidations = set()
+
+    def _cached(self, key, loader, *args):
+        """Read-through чтение через общий кэш"""
+        found, value = self.cache.get(key)
+        if found:
+            return value
+        generation = self.cache.generation()
+        value = loader(*args)
+        self.cache.put(key, value, generation)
+        return value
+
+    def cache_stats(self) -> Dict:
+        """Метрики кэша записей (размер, попадания, hit rate)"""
+        return self.cache.stats()
+
+    def migrate(self):
+        """Применение недостающих миграций схемы (см. migrations.py)"""
+        return migrations.migrate(self.conn)
 
     def add_user(self, user_id, username=None):
         """Добавление нового пользователя"""
         cursor = self.conn.cursor()
         cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, username)
+        INSERT INTO users (user_id, username)
         VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET username = excluded.username, created_at = excluded.created_at
         ''', (user_id, username))
-        self.conn.commit()
+        self._commit()
 
     def get_user(self, user_id):
         """Получение информации о пользователе"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        cursor.row_factory = User.row_factory
+        cursor.execute(f'''
+        SELECT user_id, username, {migrations.epoch_sql('created_at', local=False)}
+        FROM users WHERE user_id = ?
+        ''', (user_id,))
         return cursor.fetchone()
 
     def create_payment(self, user_id, amount, status, duration_months=None, payment_method=None, screenshot_file_id=None):
-        """Создание нового платежа"""
-        cursor = self.conn.cursor()
-        cursor.execute('''
+        """Создание нового платежа; возвращает его payment_id"""
+        row = self.conn.execute('''
         INSERT INTO payments (payment_id, user_id, amount, duration_months, status, created_at)
-        VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (str(user_id), user_id, amount, duration_months, status))
-        self.conn.commit()
-        return cursor.lastrowid
+        VALUES (?, ?, ?, ?, ?, ?)
+        RETURNING payment_id
+        ''', (str(user_id), user_id, amount, duration_months, status, int(time.time()))).fetchone()
+        self._commit()
+        return row[0]
 
     def verify_payment(self, payment_id, status):
         """Подтверждение или отклонение платежа"""
@@ -140,25 +391,34 @@ class Database:
         SET status = ?
         WHERE payment_id = ?
         ''', (status, payment_id))
-        self.conn.commit()
+        self._commit()
 
     def get_payment(self, payment_id):
         """Получение информации о платеже"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM payments WHERE payment_id = ?', (payment_id,))
+        cursor.row_factory = Payment.row_factory
+        cursor.execute('''
+        SELECT payment_id, user_id, amount, duration_months, status, created_at
+        FROM payments WHERE payment_id = ?
+        ''', (payment_id,))
         return cursor.fetchone()
 
     def get_user_payments(self, user_id):
         """Получение всех платежей пользователя"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM payments WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
+        cursor.row_factory = Payment.row_factory
+        cursor.execute('''
+        SELECT payment_id, user_id, amount, duration_months, status, created_at
+        FROM all_payments WHERE user_id = ? ORDER BY created_at DESC
+        ''', (user_id,))
         return cursor.fetchall()
 
     def add_subscription(self, user_id, duration_days):
         """Добавление новой подписки или продление существующей"""
         cursor = self.conn.cursor()
-        now = datetime.now().replace(microsecond=0)
-        logging.info(f"Adding subscription for user {user_id} at {now}, duration: {duration_days} days")
+        now = int(time.time())
+        duration = int(duration_days * 86400)
+        logging.info(f"Adding subscription for user {user_id} at {from_epoch(now)}, duration: {duration_days} days")
         
         # Проверяем, есть ли активная подписка
         cursor.execute("""
@@ -170,17 +430,17 @@ class Database:
         current_subscription = cursor.fetchone()
         
         if current_subscription:
-            current_expiration = datetime.strptime(str(current_subscription[0]).split('.')[0], '%Y-%m-%d %H:%M:%S')
-            logging.info(f"Found existing subscription for user {user_id}, expires at {current_expiration}")
+            current_expiration = current_subscription[0]
+            logging.info(f"Found existing subscription for user {user_id}, expires at {from_epoch(current_expiration)}")
             
             # Если подписка ещё активна, добавляем дни к текущей дате окончания
             if current_expiration > now:
-                end_date = current_expiration + timedelta(days=duration_days)
-                logging.info(f"Extending active subscription to {end_date}")
+                end_date = current_expiration + duration
+                logging.info(f"Extending active subscription to {from_epoch(end_date)}")
             else:
                 # Если подписка истекла, начинаем с текущей даты
-                end_date = now + timedelta(days=duration_days)
-                logging.info(f"Starting new subscription period from now until {end_date}")
+                end_date = now + duration
+                logging.info(f"Starting new subscription period from now until {from_epoch(end_date)}")
             
             # Обновляем существующую подписку
             cursor.execute("""
@@ -191,8 +451,8 @@ class Database:
             logging.info(f"Updated subscription for user {user_id}")
         else:
             # Создаем новую подписку
-            end_date = now + timedelta(days=duration_days)
-            logging.info(f"Creating new subscription for user {user_id} until {end_date}")
+            end_date = now + duration
+            logging.info(f"Creating new subscription for user {user_id} until {from_epoch(end_date)}")
             
             cursor.execute("""
                 INSERT INTO subscriptions (user_id, expiration, created_at)
@@ -200,12 +460,17 @@ class Database:
             """, (user_id, end_date, now))
             logging.info(f"Created new subscription for user {user_id}")
         
-        self.conn.commit()
+        self._invalidate(('subscription', user_id))
+        self._commit()
         return True
 
     def get_subscription(self, user_id):
-        """Получение информации о текущей подписке пользователя"""
+        """Получение информации о текущей подписке пользователя (через кэш)"""
+        return self._cached(('subscription', user_id), self._load_subscription, user_id)
+
+    def _load_subscription(self, user_id):
         cursor = self.conn.cursor()
+        cursor.row_factory = Subscription.row_factory
         cursor.execute('''
             SELECT 
                 id,
@@ -217,50 +482,29 @@ class Database:
             WHERE user_id = ? AND is_active = 1
             ORDER BY created_at DESC LIMIT 1
         ''', (user_id,))
-        subscription = cursor.fetchone()
-        if subscription:
-            return {
-                'id': subscription[0],
-                'user_id': subscription[1],
-                'expiration': subscription[2],
-                'created_at': subscription[3],
-                'is_active': subscription[4]
-            }
-        return None
+        return cursor.fetchone()
 
     def check_subscription(self, user_id):
         """Проверка активности подписки"""
         subscription = self.get_subscription(user_id)
         if not subscription:
             return False
-        try:
-            # Обрезаем микросекунды перед парсингом
-            end_date_str = subscription['expiration'].split('.')[0]
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S')
-            return end_date > datetime.now()
-        except Exception as e:
-            logging.error(f"Error checking subscription: {e}")
-            return False
+        return subscription.expiration_ts is not None and subscription.expiration_ts > time.time()
 
     def get_subscription_end_date(self, user_id):
         """Получение даты окончания подписки"""
         subscription = self.get_subscription(user_id)
         if not subscription:
             return None
-        try:
-            # Обрезаем микросекунды перед парсингом
-            end_date_str = subscription['expiration'].split('.')[0]
-            return datetime.strptime(end_date_str, '%Y-%m-%d %H:%M:%S')
-        except Exception as e:
-            logging.error(f"Error getting subscription end date: {e}")
-            return None
+        return subscription.expiration
 
     def get_expired_subscriptions(self):
         """Получение истекших подписок"""
         cursor = self.conn.cursor()
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor.row_factory = Subscription.row_factory
+        now = int(time.time())
         
-        logging.info(f"Checking for expired subscriptions at {now}")
+        logging.info(f"Checking for expired subscriptions at {from_epoch(now)}")
         
         query = '''
             SELECT 
@@ -276,72 +520,137 @@ class Database:
         
         cursor.execute(query, (now,))
         
-        raw_subscriptions = cursor.fetchall()
-        if raw_subscriptions:
-            logging.info(f"Raw expired subscriptions data: {raw_subscriptions}")
-        else:
-            logging.info("No expired subscriptions found")
-            return []
-            
-        result = []
-        for sub in raw_subscriptions:
-            try:
-                subscription_dict = {
-                    'id': sub[0],
-                    'user_id': sub[1],
-                    'expiration': sub[2],
-                    'created_at': sub[3],
-                    'is_active': sub[4]
-                }
-                result.append(subscription_dict)
-                logging.info(f"Processed expired subscription: {subscription_dict}")
-            except Exception as e:
-                logging.error(f"Error processing expired subscription row {sub}: {e}")
-                continue
-        
+        result = cursor.fetchall()
         logging.info(f"Total expired subscriptions found: {len(result)}")
         return result
 
     def deactivate_subscription(self, user_id: int) -> bool:
         """Деактивация подписки пользователя"""
         try:
-            with self.conn:
-                cursor = self.conn.cursor()
-                # Обновляем статус подписки
-                cursor.execute(
-                    """
-                    UPDATE subscriptions 
-                    SET is_active = 0 
-                    WHERE user_id = ? AND is_active = 1
-                    """,
-                    (user_id,)
-                )
-                self.conn.commit()
-                logging.info(f"Successfully deactivated subscription for user {user_id}")
-                return True
+            cursor = self.conn.cursor()
+            # Обновляем статус подписки
+            cursor.execute(
+                """
+                UPDATE subscriptions 
+                SET is_active = 0 
+                WHERE user_id = ? AND is_active = 1
+                """,
+                (user_id,)
+            )
+            self._invalidate(('subscription', user_id))
+            self._commit()
+            logging.info(f"Successfully deactivated subscription for user {user_id}")
+            return True
         except Exception as e:
+            self._rollback()
             logging.error(f"Error deactivating subscription for user {user_id}: {e}")
             return False
 
+    def deactivate_subscriptions(self, user_ids, outbox=None) -> int:
+        """Деактивация подписок нескольких пользователей одной транзакцией
+
+        outbox - события (kind, dedup_key, payload), которые записываются
+        в той же транзакции. Возвращает количество деактивированных строк.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return 0
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany("""
+                UPDATE subscriptions
+                SET is_active = 0
+                WHERE user_id = ? AND is_active = 1
+            """, [(user_id,) for user_id in user_ids])
+            affected = cursor.rowcount
+            if outbox:
+                self._insert_outbox(cursor, outbox)
+            self._invalidate(*[('subscription', user_id) for user_id in user_ids])
+            self._commit()
+            logging.info(f"Deactivated {affected} subscriptions for {len(user_ids)} users")
+            return affected
+        except Exception as e:
+            logging.error(f"Error deactivating subscriptions: {e}")
+            self._rollback()
+            raise
+
+    def expire_subscriptions(self, subscriptions, now: int, outbox=None) -> list:
+        """Деактивация истекших подписок по id, если их не продлили (см. Storage)"""
+        subscriptions = list(subscriptions)
+        if not subscriptions:
+            return []
+        outbox = outbox or {}
+        cursor = self.conn.cursor()
+        try:
+            expired = []
+            for subscription_id, user_id in subscriptions:
+                cursor.execute("""
+                    UPDATE subscriptions
+                    SET is_active = 0
+                    WHERE id = ? AND is_active = 1 AND expiration <= ?
+                """, (subscription_id, now))
+                if cursor.rowcount:
+                    expired.append(subscription_id)
+            events = [event for subscription_id in expired for event in outbox.get(subscription_id, ())]
+            if events:
+                self._insert_outbox(cursor, events)
+            self._invalidate(*[('subscription', user_id) for _, user_id in subscriptions])
+            self._commit()
+            logging.info(f"Expired {len(expired)} of {len(subscriptions)} subscriptions")
+            return expired
+        except Exception as e:
+            logging.error(f"Error expiring subscriptions: {e}")
+            self._rollback()
+            raise
+
+    def extend_subscriptions(self, user_ids, days) -> int:
+        """Продление активных подписок нескольких пользователей на days дней
+
+        Истекшие, но еще активные подписки продлеваются от текущего момента.
+        Возвращает количество продленных строк.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return 0
+        now = int(time.time())
+        duration = int(days * 86400)
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany("""
+                UPDATE subscriptions
+                SET expiration = MAX(expiration, ?) + ?
+                WHERE user_id = ? AND is_active = 1
+            """, [(now, duration, user_id) for user_id in user_ids])
+            affected = cursor.rowcount
+            self._invalidate(*[('subscription', user_id) for user_id in user_ids])
+            self._commit()
+            logging.info(f"Extended {affected} subscriptions by {days} days")
+            return affected
+        except Exception as e:
+            logging.error(f"Error extending subscriptions: {e}")
+            self._rollback()
+            raise
+
     def add_payment(self, payment_id: str, user_id: int, amount: float, duration: int, status: str = 'pending'):
         """Добавление нового платежа"""
         cursor = self.conn.cursor()
         try:
             cursor.execute('''
             INSERT INTO payments (payment_id, user_id, amount, duration_months, status, created_at)
-            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (payment_id, user_id, amount, duration, status))
-            self.conn.commit()
+            VALUES (?, ?, ?, ?, ?, ?)
+            ''', (payment_id, user_id, amount, duration, status, int(time.time())))
+            self._commit()
             logging.info(f"Added new payment: ID={payment_id}, user_id={user_id}, amount={amount}, duration={duration}")
             return True
         except Exception as e:
             logging.error(f"Error adding payment: {e}")
-            self.conn.rollback()
+            self._rollback()
             return False
 
     def get_payment(self, payment_id: str):
         """Получение информации о платеже"""
         cursor = self.conn.cursor()
+        cursor.row_factory = Payment.row_factory
         cursor.execute("""
             SELECT payment_id, user_id, amount, duration_months, status, created_at
             FROM payments
@@ -358,15 +667,15 @@ class Database:
                 SET status = ?
                 WHERE payment_id = ?
             """, (status, payment_id))
-            self.conn.commit()
+            self._commit()
             logging.info(f"Updated payment {payment_id} status to {status}")
         except Exception as e:
             logging.error(f"Error updating payment status: {e}")
-            self.conn.rollback()
+            self._rollback()
             raise
 
-    def create_subscription(self, user_id: int, expiration: str):
-        """Создание новой подписки"""
+    def create_subscription(self, user_id: int, expiration):
+        """Создание новой подписки (expiration - datetime, строка даты или epoch секунды)"""
         cursor = self.conn.cursor()
         try:
             # Деактивируем все текущие подписки пользователя
@@ -377,25 +686,26 @@ class Database:
             """, (user_id,))
             
             # Создаем новую подписку
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             cursor.execute("""
                 INSERT INTO subscriptions 
                 (user_id, expiration, created_at, is_active) 
                 VALUES (?, ?, ?, 1)
-            """, (user_id, expiration, now))
+            """, (user_id, to_epoch(expiration), int(time.time())))
             
-            self.conn.commit()
+            self._invalidate(('subscription', user_id))
+            self._commit()
             logging.info(f"Created new subscription for user {user_id} until {expiration}")
             return True
         except Exception as e:
             logging.error(f"Error creating subscription: {e}")
-            self.conn.rollback()
+            self._rollback()
             return False
 
     def get_active_subscriptions(self):
         """Получение активных подписок"""
         cursor = self.conn.cursor()
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        cursor.row_factory = Subscription.row_factory
+        now = int(time.time())
         cursor.execute('''
             SELECT 
                 id,
@@ -408,33 +718,105 @@ class Database:
             ORDER BY expiration DESC
         ''', (now,))
         
-        result = []
-        for sub in cursor.fetchall():
-            try:
-                subscription_dict = {
-                    'id': sub[0],
-                    'user_id': sub[1],
-                    'expiration': sub[2],
-                    'created_at': sub[3],
-                    'is_active': sub[4]
-                }
-                result.append(subscription_dict)
-                logging.info(f"Processed active subscription: {subscription_dict}")
-            except Exception as e:
-                logging.error(f"Error processing active subscription row {sub}: {e}")
-                continue
-        
+        result = cursor.fetchall()
         logging.info(f"Total active subscriptions found: {len(result)}")
         return result
 
+    # Начальный ключ keyset пагинации: меньше любого (expiration, id)
+    _FIRST_KEY = (-1, -1)
+
+    def _subscriptions_page(self, condition: str, now: int, after, limit: int):
+        cursor = self.conn.cursor()
+        cursor.row_factory = Subscription.row_factory
+        after = after or self._FIRST_KEY
+        cursor.execute(f'''
+            SELECT id, user_id, expiration, created_at, is_active
+            FROM subscriptions
+            WHERE is_active = 1 AND {condition}
+              AND (expiration, id) > (?, ?)
+            ORDER BY expiration, id
+            LIMIT ?
+        ''', (now, after[0], after[1], limit))
+        return cursor.fetchall()
+
+    def get_expired_subscriptions_page(self, after=None, limit: int = 500, now: Optional[int] = None):
+        """Страница истекших активных подписок после ключа after = (expiration, id)
+
+        Строки - записи Subscription, упорядоченные по (expiration, id);
+        ключ следующей страницы - page[-1].key.
+        """
+        now = int(time.time()) if now is None else now
+        return self._subscriptions_page('expiration <= ?', now, after, limit)
+
+    def get_active_subscriptions_page(self, after=None, limit: int = 500, now: Optional[int] = None):
+        """Страница действующих подписок после ключа after = (expiration, id)"""
+        now = int(time.time()) if now is None else now
+        return self._subscriptions_page('expiration > ?', now, after, limit)
+
+    def get_warning_due_page(self, tier: str, window: int, floor: int = 0, after=None,
+                             limit: int = 500, now: Optional[int] = None):
+        """Страница подписок, которым пора предупреждение уровня tier
+
+        Срок в (now + floor, now + window], подписка существовала уже за
+        window секунд до срока, и в журнале нет записи
+        warning_type(tier, expiration). Диапазон идет по индексу сроков,
+        проверка журнала - по уникальному индексу notifications.
+        """
+        now = int(time.time()) if now is None else now
+        after = after or self._FIRST_KEY
+        cursor = self.conn.cursor()
+        cursor.row_factory = Subscription.row_factory
+        cursor.execute('''
+            SELECT s.id, s.user_id, s.expiration, s.created_at, s.is_active
+            FROM subscriptions s
+            WHERE s.is_active = 1 AND s.expiration > ? AND s.expiration <= ?
+              AND s.created_at < s.expiration - ?
+              AND (s.expiration, s.id) > (?, ?)
+              AND NOT EXISTS (
+                  SELECT 1 FROM notifications n
+                  WHERE n.subscription_id = s.id AND n.notification_type = ? || s.expiration
+              )
+            ORDER BY s.expiration, s.id
+            LIMIT ?
+        ''', (now + floor, now + window, window, after[0], after[1], warning_type(tier, ''), limit))
+        return cursor.fetchall()
+
+    def _iter_pages(self, page_method, batch_size: int, after):
+        now = int(time.time())
+        while True:
+            page = page_method(after, batch_size, now)
+            yield from page
+            if len(page) < batch_size:
+                return
+            after = page[-1].key
+
+    def iter_expired_subscriptions(self, batch_size: int = 500, after=None):
+        """Потоковый обход истекших подписок страницами по batch_size строк
+
+        Память не зависит от размера таблицы. Обход можно прервать и
+        продолжить с ключа row.key последней строки.
+        """
+        return self._iter_pages(self.get_expired_subscriptions_page, batch_size, after)
+
+    def iter_active_subscriptions(self, batch_size: int = 500, after=None):
+        """Потоковый обход действующих подписок страницами по batch_size строк"""
+        return self._iter_pages(self.get_active_subscriptions_page, batch_size, after)
+
     def save_client_config(self, user_id: int, client_data: Dict[str, str]):
         """Сохранение конфигурации клиента"""
         cursor = self.conn.cursor()
         try:
             cursor.execute("""
-                INSERT OR REPLACE INTO client_configs 
+                INSERT INTO client_configs
                 (user_id, private_key, public_key, pre_shared_key, config_path, qr_path)
                 VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    private_key = excluded.private_key,
+                    public_key = excluded.public_key,
+                    pre_shared_key = excluded.pre_shared_key,
+                    config_path = excluded.config_path,
+                    qr_path = excluded.qr_path,
+                    created_at = excluded.created_at
             """, (
                 user_id,
                 client_data.get('private_key'),
@@ -443,40 +825,58 @@ class Database:
                 client_data.get('config_path'),
                 client_data.get('qr_path')
             ))
-            self.conn.commit()
+            # file_id прежних файлов больше не соответствуют конфигурации
+            cursor.execute("DELETE FROM file_ids WHERE user_id = ?", (user_id,))
+            self._invalidate(('config', user_id))
+            self._commit()
             logging.info(f"Saved client config for user {user_id}")
         except Exception as e:
-            self.conn.rollback()
+            self._rollback()
             logging.error(f"Error saving client config: {e}")
             raise
         finally:
             cursor.close()
 
-    def get_client_config(self, user_id: int) -> Optional[Dict[str, str]]:
-        """Получение конфигурации клиента"""
+    def get_client_config(self, user_id: int) -> Optional[ClientConfig]:
+        """Получение конфигурации клиента (через кэш)"""
+        return self._cached(('config', user_id), self._load_client_config, user_id)
+
+    def _load_client_config(self, user_id: int) -> Optional[ClientConfig]:
         cursor = self.conn.cursor()
+        cursor.row_factory = ClientConfig.row_factory
         try:
             cursor.execute("""
                 SELECT private_key, public_key, pre_shared_key, config_path, qr_path
                 FROM client_configs
                 WHERE user_id = ?
             """, (user_id,))
-            row = cursor.fetchone()
-            if row:
-                return {
-                    'private_key': row[0],
-                    'public_key': row[1],
-                    'pre_shared_key': row[2],
-                    'config_path': row[3],
-                    'qr_path': row[4]
-                }
-            return None
+            return cursor.fetchone()
         except Exception as e:
             logging.error(f"Error getting client config: {e}")
             raise
         finally:
             cursor.close()
 
+    def get_file_id(self, user_id: int, kind: str, content_hash: str) -> Optional[str]:
+        """file_id Telegram для версии файла content_hash; при несовпадении хэша - None"""
+        row = self.conn.execute(
+            "SELECT file_id FROM file_ids WHERE user_id = ? AND kind = ? AND content_hash = ?",
+            (user_id, kind, content_hash)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save_file_id(self, user_id: int, kind: str, content_hash: str, file_id: str):
+        """Сохранение file_id загруженного файла (заменяет запись прежней версии)"""
+        self.conn.execute('''
+        INSERT INTO file_ids (user_id, kind, content_hash, file_id, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, kind) DO UPDATE SET
+            content_hash = excluded.content_hash,
+            file_id = excluded.file_id,
+            created_at = excluded.created_at
+        ''', (user_id, kind, content_hash, file_id, time.time()))
+        self._commit()
+
     def clear_all_data(self):
         """Очистка всех данных из базы"""
         cursor = self.conn.cursor()
@@ -488,7 +888,15 @@ class Database:
             cursor.execute("DELETE FROM subscriptions")
             cursor.execute("DELETE FROM payments")
             cursor.execute("DELETE FROM client_configs")
+            cursor.execute("DELETE FROM file_ids")
+            # Журнал уведомлений ссылается на id подписок, которые начнутся заново
+            cursor.execute("DELETE FROM notifications")
+            # Ключи дедупликации outbox содержат те же id подписок
+            cursor.execute("DELETE FROM outbox")
             cursor.execute("DELETE FROM users")
+            if self.archive_file:
+                for table in ARCHIVE_TABLES:
+                    cursor.execute(f"DELETE FROM archive.{table}")
             
             # Сбрасываем автоинкремент
             cursor.execute("DELETE FROM sqlite_sequence")
@@ -496,32 +904,497 @@ class Database:
             # Включаем внешние ключи обратно
             cursor.execute("PRAGMA foreign_keys = ON")
             
-            self.conn.commit()
+            self._invalidate(_ALL_RECORDS)
+            self._commit()
             logging.info("All data cleared successfully")
         except Exception as e:
             logging.error(f"Error clearing data: {e}")
-            self.conn.rollback()
+            self._rollback()
             raise
 
+    def get_counters(self) -> Dict[str, int]:
+        """Количество пользователей, активных подписок, платежей и т.д.
+
+        Значения поддерживают триггеры (см. migrations.COUNTERS), поэтому
+        это чтение нескольких строк без прохода по таблицам.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name, value FROM counters ORDER BY name")
+        return dict(cursor.fetchall())
+
+    def check_counters(self) -> Dict[str, tuple]:
+        """Сверка счетчиков с COUNT(*): {имя: (сохранено, фактически)} для расхождений"""
+        cursor = self.conn.cursor()
+        cursor.execute(migrations.counters_check_sql())
+        return {name: (stored, actual) for name, stored, actual in cursor.fetchall() if stored != actual}
+
+    def rebuild_counters(self) -> Dict[str, tuple]:
+        """Пересчет счетчиков по таблицам; возвращает найденные расхождения"""
+        with self.batch():
+            mismatches = self.check_counters()
+            for name in migrations.COUNTERS:
+                self.conn.execute(migrations.counter_upsert_sql(name, update=True))
+        if mismatches:
+            logging.warning(f"Rebuilt database counters: {mismatches}")
+        return mismatches
+
+    def archive_batch(self, table: str, cutoff: int, batch_size: int = 500, after=None):
+        """Перенос до batch_size холодных строк таблицы в архив одной транзакцией
+
+        Строки выбираются по rowid после after, поэтому повторный вызов
+        продолжает с места остановки. Возвращает (перенесено, последний rowid).
+        Режим WAL не гарантирует атомарность транзакции между файлами при сбое:
+        строка может остаться и в оперативной таблице, тогда следующий проход
+        перенесет ее заново (INSERT OR REPLACE по первичному ключу).
+        """
+        if not self.archive_file:
+            return 0, None
+        columns, condition = ARCHIVE_TABLES[table]
+        with self.batch():
+            rowids = [row[0] for row in self.conn.execute(
+                f"SELECT rowid FROM main.{table} WHERE rowid > :after AND {condition} ORDER BY rowid LIMIT :limit",
+                {'after': after or 0, 'cutoff': cutoff, 'limit': batch_size},
+            )]
+            if not rowids:
+                return 0, after
+            placeholders = ','.join('?' * len(rowids))
+            self.conn.execute(f'''
+            INSERT OR REPLACE INTO archive.{table} ({columns}, archived_at)
+            SELECT {columns}, CAST(strftime('%s', 'now') AS INTEGER) FROM main.{table} WHERE rowid IN ({placeholders})
+            ''', rowids)
+            # Кэш не трогаем: в нем только активные подписки и конфигурации
+            self.conn.execute(f"DELETE FROM main.{table} WHERE rowid IN ({placeholders})", rowids)
+        return len(rowids), rowids[-1]
+
+    def get_archive_stats(self) -> Dict[str, int]:
+        """Количество строк в архиве по таблицам (полный проход, для админки)"""
+        if not self.archive_file:
+            return {}
+        return {
+            table: self.conn.execute(f"SELECT COUNT(*) FROM archive.{table}").fetchone()[0]
+            for table in ARCHIVE_TABLES
+        }
+
+    def get_job_runs(self) -> Dict[str, float]:
+        """Время последнего запуска задач планировщика (epoch)"""
+        return dict(self.conn.execute("SELECT name, last_run FROM job_runs").fetchall())
+
+    def record_job_run(self, name: str, started_at: float, duration: float, error: Optional[str] = None):
+        """Сохранение результата запуска задачи планировщика"""
+        self.conn.execute('''
+        INSERT INTO job_runs (name, last_run, duration, error) VALUES (?, ?, ?, ?)
+        ON CONFLICT (name) DO UPDATE SET
+            last_run = excluded.last_run, duration = excluded.duration, error = excluded.error
+        ''', (name, started_at, duration, error))
+        self._commit()
+
+    # --- Outbox ---
+
+    @staticmethod
+    def _insert_outbox(cursor, events) -> int:
+        now = time.time()
+        cursor.executemany('''
+        INSERT OR IGNORE INTO outbox (kind, dedup_key, payload, available_at, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [(kind, dedup_key, json.dumps(payload), now, now) for kind, dedup_key, payload in events])
+        return cursor.rowcount
+
+    def enqueue_outbox(self, events) -> int:
+        """Запись событий (kind, dedup_key, payload); повтор dedup_key пропускается"""
+        cursor = self.conn.cursor()
+        try:
+            added = self._insert_outbox(cursor, list(events))
+            self._commit()
+            return added
+        except Exception as e:
+            logging.error(f"Error enqueuing outbox events: {e}")
+            self._rollback()
+            raise
+
+    def claim_outbox(self, limit: int = 100, lease: float = 60.0):
+        """Захват готовых событий на lease секунд; список OutboxEvent
+
+        Захваченное, но не завершенное событие (воркер упал) снова станет
+        доступно по истечении lease.
+        """
+        now = time.time()
+        cursor = self.conn.cursor()
+        cursor.row_factory = OutboxEvent.row_factory
+        cursor.execute('''
+        UPDATE outbox SET locked_until = ?
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE available_at <= ? AND locked_until <= ?
+            ORDER BY available_at
+            LIMIT ?
+        )
+        RETURNING id, kind, payload, attempts
+        ''', (now + lease, now, now, limit))
+        events = cursor.fetchall()
+        self._commit()
+        return events
+
+    def complete_outbox(self, event_ids) -> int:
+        """Удаление выполненных событий"""
+        cursor = self.conn.cursor()
+        cursor.executemany("DELETE FROM outbox WHERE id = ?", [(event_id,) for event_id in event_ids])
+        self._commit()
+        return cursor.rowcount
+
+    def retry_outbox(self, event_id: int, delay: Optional[float], error: str):
+        """Отложить событие на delay секунд; delay None - попытки исчерпаны"""
+        self.conn.execute('''
+        UPDATE outbox
+        SET attempts = attempts + 1, available_at = ?, locked_until = 0, last_error = ?
+        WHERE id = ?
+        ''', (None if delay is None else time.time() + delay, error, event_id))
+        self._commit()
+
+    def get_outbox_stats(self) -> Dict:
+        """Ожидающие и окончательно неудавшиеся события, возраст самого старого"""
+        pending, dead, oldest = self.conn.execute('''
+        SELECT
+            COUNT(available_at),
+            COUNT(*) - COUNT(available_at),
+            MIN(CASE WHEN available_at IS NOT NULL THEN created_at END)
+        FROM outbox
+        ''').fetchone()
+        return {'pending': pending, 'dead': dead, 'oldest_age': time.time() - oldest if oldest else 0.0}
+
+    # --- Рассылки ---
+
+    def count_broadcast_recipients(self, segment: str, now: Optional[int] = None) -> int:
+        """Число пользователей сегмента BROADCAST_SEGMENTS"""
+        condition = BROADCAST_SEGMENTS[segment].format(now='?')
+        now = int(time.time()) if now is None else now
+        return self.conn.execute(
+            f"SELECT COUNT(*) FROM users u WHERE {condition}", (now,) * condition.count('?')
+        ).fetchone()[0]
+
+    def get_broadcast_recipients_page(self, segment: str, after: int = 0, limit: int = 500,
+                                      now: Optional[int] = None) -> list:
+        """user_id сегмента больше after по возрастанию (keyset пагинация по первичному ключу)"""
+        condition = BROADCAST_SEGMENTS[segment].format(now='?')
+        now = int(time.time()) if now is None else now
+        rows = self.conn.execute(f'''
+        SELECT u.user_id FROM users u
+        WHERE u.user_id > ? AND {condition}
+        ORDER BY u.user_id
+        LIMIT ?
+        ''', (after, *(now,) * condition.count('?'), limit)).fetchall()
+        return [row[0] for row in rows]
+
+    def create_broadcast(self, segment: str, text: str, total: int, chat_id=None, message_id=None) -> int:
+        """Новая рассылка в статусе running; ее id"""
+        if segment not in BROADCAST_SEGMENTS:
+            raise ValueError(f"Unknown broadcast segment {segment!r}")
+        now = time.time()
+        cursor = self.conn.execute('''
+        INSERT INTO broadcasts (segment, text, total, chat_id, message_id, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (segment, text, total, chat_id, message_id, now, now))
+        self._commit()
+        return cursor.lastrowid
+
+    _BROADCAST_COLUMNS = 'id, segment, text, status, cursor, total, sent, failed, chat_id, message_id'
+
+    def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        cursor = self.conn.cursor()
+        cursor.row_factory = Broadcast.row_factory
+        return cursor.execute(
+            f"SELECT {self._BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,)
+        ).fetchone()
+
+    def get_running_broadcasts(self) -> list:
+        cursor = self.conn.cursor()
+        cursor.row_factory = Broadcast.row_factory
+        return cursor.execute(
+            f"SELECT {self._BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id"
+        ).fetchall()
+
+    def update_broadcast(self, broadcast_id: int, cursor: int, sent: int, failed: int,
+                         status: Optional[str] = None) -> Optional[str]:
+        """Сохранение курсора и счетчиков; статус меняется, только если рассылку не отменили"""
+        row = self.conn.execute('''
+        UPDATE broadcasts
+        SET cursor = ?, sent = ?, failed = ?, updated_at = ?,
+            status = CASE WHEN status = 'running' THEN COALESCE(?, status) ELSE status END
+        WHERE id = ?
+        RETURNING status
+        ''', (cursor, sent, failed, time.time(), status, broadcast_id)).fetchone()
+        self._commit()
+        return row[0] if row else None
+
+    def cancel_broadcast(self, broadcast_id: int) -> bool:
+        cursor = self.conn.execute(
+            "UPDATE broadcasts SET status = 'cancelled', updated_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), broadcast_id)
+        )
+        self._commit()
+        return cursor.rowcount == 1
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        """Захват или продление аренды name на ttl секунд
+
+        Удается, если аренда свободна, истекла или уже принадлежит holder.
+        Возвращает fencing-токен (растет при смене владельца) или None.
+        """
+        now = time.time()
+        row = self.conn.execute('''
+        INSERT INTO leases (name, holder, token, expires_at) VALUES (?, ?, 1, ?)
+        ON CONFLICT (name) DO UPDATE SET
+            token = CASE WHEN leases.holder = excluded.holder THEN leases.token ELSE leases.token + 1 END,
+            holder = excluded.holder,
+            expires_at = excluded.expires_at
+        WHERE leases.holder = excluded.holder OR leases.expires_at <= ?
+        RETURNING token
+        ''', (name, holder, now + ttl, now)).fetchone()
+        self._commit()
+        return row[0] if row else None
+
+    def release_lease(self, name: str, holder: str):
+        """Досрочное освобождение аренды владельцем (токен сохраняется)"""
+        self.conn.execute(
+            "UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?", (name, holder)
+        )
+        self._commit()
+
+    def check_lease(self, name: str, holder: str, token: int) -> bool:
+        """Аренда все еще у holder с тем же токеном и не истекла"""
+        return self.conn.execute('''
+        SELECT 1 FROM leases WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?
+        ''', (name, holder, token, time.time())).fetchone() is not None
+
+    def get_recent_subscriptions(self, limit: int = 5):
+        """Последние созданные подписки (user_id, expiration, is_active)"""
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT user_id, expiration, is_active
+            FROM subscriptions
+            ORDER BY created_at DESC
+            LIMIT ?
+        """, (limit,))
+        return [(row[0], from_epoch(row[1]), row[2]) for row in cursor.fetchall()]
+
     def close(self):
         """Закрытие соединения с базой данных"""
+        if str(self.profile.get('journal_mode') or '').upper() == 'WAL':
+            try:
+                # Переносим WAL в основной файл и усекаем его перед закрытием
+                self.checkpoint('TRUNCATE')
+            except sqlite3.Error as e:
+                logging.warning(f"WAL checkpoint on close failed: {e}")
         self.conn.close()
 
+    # --- Обслуживание файла базы ---
+
+    def get_file_stats(self) -> Dict:
+        """Размер файла базы в страницах и число свободных страниц"""
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = self.conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        return {
+            'page_size': page_size,
+            'page_count': page_count,
+            'freelist_count': freelist,
+            'size_bytes': page_size * page_count,
+            'auto_vacuum': ('NONE', 'FULL', 'INCREMENTAL')[auto_vacuum],
+        }
+
+    def enable_incremental_vacuum(self) -> bool:
+        """Перевод существующей базы в auto_vacuum=INCREMENTAL
+
+        Для базы, созданной без этого режима, нужен разовый полный VACUUM
+        (блокирует запись на время перестройки файла). Возвращает True, если
+        режим пришлось менять.
+        """
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        if self.conn.in_transaction:
+            self.conn.commit()
+        started = time.perf_counter()
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("VACUUM")
+        logging.info(f"Switched database to incremental auto_vacuum in {time.perf_counter() - started:.2f}s")
+        return True
+
+    def incremental_vacuum(self, pages: int = 256) -> int:
+        """Возврат до pages свободных страниц файловой системе
+
+        Короткая операция: за один шаг блокировка записи держится только на
+        время переноса pages страниц. Возвращает число освобожденных страниц.
+        """
+        before = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if before == 0:
+            return 0
+        # Каждый шаг выполнения pragma освобождает одну страницу, а execute()
+        # делает только первый шаг; executescript выполняет ее до конца
+        self.conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return before - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def optimize(self, analyze: bool = False):
+        """Обновление статистики планировщика
+
+        PRAGMA optimize пересчитывает статистику только там, где она
+        устарела; analyze=True выполняет полный ANALYZE.
+        """
+        if analyze:
+            self.conn.execute("ANALYZE")
+        self.conn.execute("PRAGMA optimize")
+        self._commit()
+
+    def backup(self, target: str, pages: int = 256, sleep: float = 0.005) -> int:
+        """Горячая копия базы в файл target через sqlite3 backup API
+
+        Копирование идет шагами по pages страниц с паузой sleep между ними.
+        Все шаги выполняются в одной читающей транзакции: в WAL режиме это
+        согласованный снимок, который не блокирует писателя и не заставляет
+        копирование начинаться заново после чужих записей. Копия пишется во
+        временный файл и переименовывается только после успешного завершения.
+        Возвращает количество скопированных страниц.
+        """
+        tmp_target = f"{target}.tmp"
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+        dest = sqlite3.connect(tmp_target)
+        own_transaction = not self.conn.in_transaction
+        try:
+            if own_transaction:
+                self.conn.execute("BEGIN")
+                self.conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchall()
+            started = time.perf_counter()
+            self.conn.backup(dest, pages=pages, sleep=sleep)
+            copied = dest.execute("PRAGMA page_count").fetchone()[0]
+        except Exception:
+            dest.close()
+            os.remove(tmp_target)
+            raise
+        finally:
+            if own_transaction and self.conn.in_transaction:
+                self.conn.rollback()
+        dest.close()
+        os.replace(tmp_target, target)
+        logging.info(f"Backed up {copied} pages to {target} in {time.perf_counter() - started:.2f}s")
+        return copied
+
+    # --- Журнал уведомлений ---
+    # Уникальность (subscription_id, notification_type) гарантирует, что
+    # каждое уведомление по подписке отправляется один раз даже после
+    # перезапуска или при нескольких процессах.
+
     def add_notification(self, user_id, subscription_id, notification_type):
         """Добавление записи об отправленном уведомлении"""
         cursor = self.conn.cursor()
         cursor.execute('''
-        INSERT INTO notifications (user_id, subscription_id, notification_type)
+        INSERT OR IGNORE INTO notifications (user_id, subscription_id, notification_type)
         VALUES (?, ?, ?)
         ''', (user_id, subscription_id, notification_type))
-        self.conn.commit()
+        self._commit()
+
+    def add_notifications(self, rows) -> int:
+        """Добавление записей об уведомлениях пачкой
+
+        rows - итерируемое (user_id, subscription_id, notification_type).
+        Возвращает количество добавленных (ранее не записанных) строк.
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany('''
+            INSERT OR IGNORE INTO notifications (user_id, subscription_id, notification_type)
+            VALUES (?, ?, ?)
+            ''', rows)
+            affected = cursor.rowcount
+            self._commit()
+            return affected
+        except Exception as e:
+            logging.error(f"Error adding notifications: {e}")
+            self._rollback()
+            raise
+
+    def claim_notification(self, user_id, subscription_id, notification_type) -> bool:
+        """Атомарно занять отправку уведомления
+
+        True - уведомление еще не отправлялось и теперь закреплено за
+        вызывающим; False - его уже отправил кто-то другой.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        INSERT OR IGNORE INTO notifications (user_id, subscription_id, notification_type)
+        VALUES (?, ?, ?)
+        ''', (user_id, subscription_id, notification_type))
+        self._commit()
+        return cursor.rowcount == 1
+
+    def claim_notifications(self, rows) -> list:
+        """Занять отправку нескольких уведомлений одной транзакцией
+
+        rows - итерируемое (user_id, subscription_id, notification_type).
+        Возвращает список строк, которые удалось занять.
+        """
+        cursor = self.conn.cursor()
+        claimed = []
+        try:
+            for row in rows:
+                cursor.execute('''
+                INSERT OR IGNORE INTO notifications (user_id, subscription_id, notification_type)
+                VALUES (?, ?, ?)
+                ''', tuple(row))
+                if cursor.rowcount == 1:
+                    claimed.append(tuple(row))
+            self._commit()
+            return claimed
+        except Exception as e:
+            logging.error(f"Error claiming notifications: {e}")
+            self._rollback()
+            raise
+
+    def release_notification(self, subscription_id, notification_type):
+        """Снять отметку, если отправка занятого уведомления не удалась"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        DELETE FROM notifications
+        WHERE subscription_id = ? AND notification_type = ?
+        ''', (subscription_id, notification_type))
+        self._commit()
+
+    def filter_unnotified(self, subscription_ids, notification_type) -> set:
+        """Подписки из списка, по которым уведомление еще не отправлялось
+
+        Один запрос на каждые 500 идентификаторов вместо запроса на подписку.
+        """
+        pending = set(subscription_ids)
+        ids = list(pending)
+        cursor = self.conn.cursor()
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'''
+            SELECT subscription_id FROM notifications
+            WHERE notification_type = ? AND subscription_id IN ({placeholders})
+            ''', (notification_type, *chunk))
+            pending.difference_update(row[0] for row in cursor.fetchall())
+        return pending
+
+    def prune_notifications(self, older_than_days: int) -> int:
+        """Удаление записей журнала старше older_than_days дней"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        DELETE FROM notifications
+        WHERE created_at < datetime('now', ?)
+        ''', (f'-{int(older_than_days)} days',))
+        self._commit()
+        logging.info(f"Pruned {cursor.rowcount} notifications older than {older_than_days} days")
+        return cursor.rowcount
 
     def check_notification_sent(self, user_id, subscription_id, notification_type):
         """Проверка, было ли отправлено уведомление"""
         cursor = self.conn.cursor()
         cursor.execute('''
-        SELECT COUNT(*) FROM notifications 
-        WHERE user_id = ? AND subscription_id = ? AND notification_type = ?
-        ''', (user_id, subscription_id, notification_type))
-        count = cursor.fetchone()[0]
-        return count > 0
+        SELECT 1 FROM notifications 
+        WHERE subscription_id = ? AND notification_type = ? AND user_id = ?
+        ''', (subscription_id, notification_type, user_id))
+        return cursor.fetchone() is not None
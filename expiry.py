@@ -0,0 +1,231 @@
+import asyncio
+import heapq
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from records import Subscription
+from storage import Storage
+
+class ExpiryEngine:
+    """Отключение подписок точно в момент истечения вместо периодического опроса.
+
+    В памяти - min-heap ближайших сроков (expiration, id, user_id) в пределах
+    horizon секунд. Задача спит ровно до ближайшего срока (плюс coalesce, чтобы
+    близкие сроки обработать одной пачкой), затем забирает истекшие подписки
+    из базы страницами и передает их в on_expire. Сама куча решает только,
+    когда проснуться; что истекло, определяет база, поэтому устаревшая запись
+    в куче приводит лишь к лишнему пробуждению.
+
+    Куча обновляется:
+    - при каждой записи подписок этим процессом (слушатель Storage);
+    - полной перезагрузкой окна раз в resync_interval (новые сроки, попавшие
+      в горизонт, и записи других процессов).
+
+    При старте обрабатываются подписки, истекшие, пока бот не работал.
+    on_expire должен деактивировать подписки, иначе они вернутся в следующей
+    пачке.
+
+    Движок работает сам (run) или как задача Scheduler: run_once по
+    DynamicTrigger(next_run_time), on_wakeup=scheduler.wake.
+    """
+
+    def __init__(self, db: Storage, on_expire: Callable[[List[Subscription]], Awaitable],
+                 horizon: float = 2 * 3600, resync_interval: float = 3600, coalesce: float = 1.0,
+                 batch_size: int = 500, retry_delay: float = 30,
+                 on_wakeup: Optional[Callable[[], None]] = None):
+        self.db = db
+        self.on_expire = on_expire
+        self.horizon = horizon
+        self.resync_interval = resync_interval
+        self.coalesce = coalesce
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.on_wakeup = on_wakeup
+        self._heap = []
+        self._deadlines: Dict[int, tuple] = {}
+        self._dirty = set()
+        self._resync_due = 0.0
+        self._recovered = False
+        self._wakeup = asyncio.Event()
+        self.wakeups = 0
+        self.expired = 0
+        self.max_lateness = 0.0
+        db.add_subscription_listener(self.subscriptions_changed)
+
+    # --- Куча сроков ---
+
+    def schedule(self, subscription: Subscription):
+        """Добавление или перенос срока подписки"""
+        entry = (subscription.expiration_ts, subscription.id)
+        if self._deadlines.get(subscription.user_id) == entry:
+            return
+        if subscription.expiration_ts > time.time() + self.horizon:
+            # Дальше горизонта - подхватит следующая перезагрузка окна
+            self._deadlines.pop(subscription.user_id, None)
+            return
+        previous = self.next_deadline()
+        self._deadlines[subscription.user_id] = entry
+        heapq.heappush(self._heap, (*entry, subscription.user_id))
+        if previous is None or entry[0] < previous:
+            self._wake()
+
+    def unschedule(self, user_id: int):
+        """Снятие срока; запись в куче удаляется лениво"""
+        self._deadlines.pop(user_id, None)
+
+    def _is_current(self, item) -> bool:
+        expiration, subscription_id, user_id = item
+        return self._deadlines.get(user_id) == (expiration, subscription_id)
+
+    def next_deadline(self) -> Optional[int]:
+        """Ближайший действующий срок или None"""
+        while self._heap and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now: float) -> int:
+        """Удаление сроков не позже now; возвращает их количество"""
+        count = 0
+        while self.next_deadline() is not None and self._heap[0][0] <= now:
+            expiration, _, user_id = heapq.heappop(self._heap)
+            self._deadlines.pop(user_id, None)
+            self.max_lateness = max(self.max_lateness, now - expiration)
+            count += 1
+        return count
+
+    def subscriptions_changed(self, user_ids):
+        """Слушатель записей Storage: user_ids None - изменились все подписки"""
+        if user_ids is None:
+            self._resync_due = 0.0
+        else:
+            self._dirty.update(user_ids)
+        self._wake()
+
+    def _wake(self):
+        self._wakeup.set()
+        if self.on_wakeup is not None:
+            self.on_wakeup()
+
+    def reset(self):
+        """Забыть состояние: следующий проход начнется с восстановления и перезагрузки окна
+
+        Нужно, когда подписки какое-то время обрабатывал другой процесс
+        (например, реплика стала лидером).
+        """
+        self._recovered = False
+        self._resync_due = 0.0
+        self._wake()
+
+    # --- Синхронизация с базой ---
+
+    async def _refresh_dirty(self):
+        """Перечитывание подписок пользователей, записанных после прошлого прохода"""
+        while self._dirty:
+            user_id = self._dirty.pop()
+            subscription = await self.db.get_subscription(user_id)
+            if subscription is None:
+                self.unschedule(user_id)
+            else:
+                self.schedule(subscription)
+
+    async def resync(self):
+        """Перезагрузка окна: действующие подписки со сроком в пределах horizon"""
+        now = time.time()
+        limit = now + self.horizon
+        self._heap = []
+        self._deadlines = {}
+        self._dirty.clear()
+        after = None
+        while True:
+            page = await self.db.get_active_subscriptions_page(after, self.batch_size, int(now))
+            for subscription in page:
+                if subscription.expiration_ts > limit:
+                    break
+                self._deadlines[subscription.user_id] = (subscription.expiration_ts, subscription.id)
+                self._heap.append((subscription.expiration_ts, subscription.id, subscription.user_id))
+            else:
+                if len(page) == self.batch_size:
+                    after = page[-1].key
+                    continue
+            break
+        heapq.heapify(self._heap)
+        self._resync_due = now + self.resync_interval
+        logging.info(f"Expiry engine loaded {len(self._deadlines)} deadlines within {self.horizon:.0f}s")
+
+    async def process_expired(self) -> int:
+        """Обработка всех истекших к текущему моменту подписок пачками"""
+        now = int(time.time())
+        total = 0
+        after = None
+        while True:
+            page = await self.db.get_expired_subscriptions_page(after, self.batch_size, now)
+            if not page:
+                break
+            await self.on_expire(page)
+            total += len(page)
+            if len(page) < self.batch_size:
+                break
+            after = page[-1].key
+        self._pop_due(now)
+        self.expired += total
+        if total:
+            logging.info(f"Expiry engine processed {total} expired subscriptions")
+        return total
+
+    # --- Основной цикл ---
+
+    def next_run_time(self, now: float) -> float:
+        """Когда нужен следующий проход: ближайший срок + coalesce или перезагрузка окна"""
+        if self._dirty or not self._recovered:
+            return now
+        wake_at = self._resync_due
+        deadline = self.next_deadline()
+        if deadline is not None:
+            wake_at = min(wake_at, deadline + self.coalesce)
+        return wake_at
+
+    async def run_once(self):
+        """Один проход: восстановление после старта, перезагрузка окна и обработка истекших"""
+        if not self._recovered:
+            # Подписки, истекшие пока бот не работал
+            await self.process_expired()
+            self._recovered = True
+        if time.time() >= self._resync_due:
+            await self.resync()
+        await self._refresh_dirty()
+        deadline = self.next_deadline()
+        if deadline is not None and deadline <= time.time():
+            self.wakeups += 1
+            await self.process_expired()
+
+    async def run(self):
+        """Самостоятельная фоновая задача: сон до следующего срока"""
+        logging.info("Expiry engine started")
+        while True:
+            try:
+                await self.run_once()
+                timeout = max(0.0, self.next_run_time(time.time()) - time.time())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Expiry engine pass failed: {e}")
+                timeout = self.retry_delay
+            self._wakeup.clear()
+            if self._dirty:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict:
+        """Метрики для админки"""
+        deadline = self.next_deadline()
+        return {
+            'scheduled': len(self._deadlines),
+            'next_deadline': deadline,
+            'wakeups': self.wakeups,
+            'expired': self.expired,
+            'max_lateness': self.max_lateness,
+        }
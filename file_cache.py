@@ -0,0 +1,70 @@
+import hashlib
+import logging
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+from records import ClientConfig
+from storage import Storage
+
+# Файлы конфигурации: kind -> (поле ClientConfig с путем, имя файла для Telegram)
+FILE_KINDS = {
+    'config': ('config_path', None),
+    'qr': ('qr_path', "config.png"),
+}
+
+def config_hash(config: ClientConfig, kind: str) -> str:
+    """Версия файла kind: ключи и путь однозначно задают его содержимое
+
+    Считается по записи из базы, без чтения файла с диска.
+    """
+    path_field, _ = FILE_KINDS[kind]
+    source = '\0'.join((config.public_key or '', config.pre_shared_key or '', getattr(config, path_field) or ''))
+    return hashlib.sha256(source.encode()).hexdigest()[:32]
+
+def _sent_file_id(message) -> str:
+    if getattr(message, 'document', None):
+        return message.document.file_id
+    return message.photo[-1].file_id
+
+class FileIdCache:
+    """Повторная отправка файлов конфигурации по file_id Telegram.
+
+    После первой загрузки Telegram возвращает file_id, который хранится в
+    таблице file_ids по (user_id, kind) вместе с версией конфигурации
+    (config_hash). Следующие отправки той же версии идут по file_id - без
+    чтения файла и загрузки. save_client_config удаляет записи
+    пользователя, а смена ключей меняет хэш, так что новая конфигурация
+    загружается заново. Если Telegram не принял file_id (например, сменился
+    токен бота), файл загружается и запись обновляется.
+    """
+
+    def __init__(self, db: Storage):
+        self.db = db
+        self.hits = 0
+        self.uploads = 0
+
+    async def send(self, send: Callable[..., Awaitable], user_id: int, config: ClientConfig, kind: str, **kwargs):
+        """send(file, **kwargs) - например, partial(send_queue.send_photo, chat_id); возвращает Message"""
+        content_hash = config_hash(config, kind)
+        file_id = await self.db.get_file_id(user_id, kind, content_hash)
+        if file_id is not None:
+            try:
+                message = await send(file_id, **kwargs)
+                self.hits += 1
+                return message
+            except TelegramBadRequest as e:
+                logging.warning(f"Cached {kind} file_id for user {user_id} rejected, uploading again: {e}")
+        path_field, filename = FILE_KINDS[kind]
+        message = await send(FSInputFile(getattr(config, path_field), filename=filename), **kwargs)
+        self.uploads += 1
+        try:
+            await self.db.save_file_id(user_id, kind, content_hash, _sent_file_id(message))
+        except Exception as e:
+            logging.warning(f"Failed to cache {kind} file_id for user {user_id}: {e}")
+        return message
+
+    def stats(self) -> dict:
+        total = self.hits + self.uploads
+        return {'hits': self.hits, 'uploads': self.uploads, 'hit_rate': self.hits / total if total else 0.0}
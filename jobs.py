@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from typing import List
+
+from aiogram import types
+
+from expiry import ExpiryEngine
+from outbox import OutboxWorker
+from records import Subscription
+from scheduler import CronTrigger, DynamicTrigger, IntervalTrigger, Scheduler
+from send_queue import SendQueue
+from storage import Storage, warning_type
+
+# Размер страницы при потоковом обходе подписок
+EXPIRY_BATCH_SIZE = 500
+
+# Сколько дней хранить записи журнала уведомлений
+NOTIFICATION_TTL_DAYS = 90
+
+# Уровни предупреждений об истечении: (имя, за сколько секунд, текст),
+# от дальнего к ближнему
+WARNING_TIERS = (
+    ('7d', 7 * 86400, "7 дней"),
+    ('3d', 3 * 86400, "3 дня"),
+    ('24h', 86400, "24 часа"),
+    ('1h', 3600, "1 час"),
+)
+
+class SubscriptionJobs:
+    """Фоновые задачи подписок: отключение истекших, предупреждения, чистка журнала.
+
+    Все задачи регистрируются в одном Scheduler (register). Побочные
+    эффекты истечения выполняются через outbox. Повторная отправка
+    уведомлений исключается журналом notifications.
+    """
+
+    def __init__(self, db: Storage, sender: SendQueue, wg_api, config_manager,
+                 warning_interval: float = 900, batch_size: int = EXPIRY_BATCH_SIZE):
+        self.db = db
+        self.sender = sender
+        self.wg_api = wg_api
+        self.config_manager = config_manager
+        self.warning_interval = warning_interval
+        self.batch_size = batch_size
+        self.expiry = None
+        self.outbox = None
+
+    def register(self, scheduler: Scheduler):
+        """Регистрация задач: expiry (по сроку ближайшей подписки), warnings, prune_notifications"""
+        self.expiry = ExpiryEngine(self.db, self.process_expired, batch_size=self.batch_size,
+                                   on_wakeup=scheduler.wake)
+        self.outbox = OutboxWorker(self.db, on_wakeup=scheduler.wake)
+        self.outbox.register('disable_peer', self.disable_peers, batch=True)
+        self.outbox.register('notify_expired', self.notify_expired)
+        self.outbox.register('cleanup_configs', self.cleanup_configs)
+        scheduler.add_job('outbox', self.outbox.drain_once, DynamicTrigger(self.outbox.next_run_time))
+        scheduler.add_job('expiry', self.expiry.run_once, DynamicTrigger(self.expiry.next_run_time))
+        if scheduler.leader is not None:
+            scheduler.leader.add_listener(lambda leading: leading and self.expiry.reset())
+        scheduler.add_job('warnings', self.send_warnings, IntervalTrigger(self.warning_interval), jitter=30)
+        scheduler.add_job('prune_notifications', self.prune_notifications, CronTrigger('30 3 * * *'), jitter=300)
+
+    async def process_expired(self, expired_subscriptions: List[Subscription]):
+        """Деактивация страницы истекших подписок вместе с событиями outbox
+
+        Деактивация и события (отключить клиента, уведомить, удалить файлы)
+        записываются одной транзакцией; выполняет их OutboxWorker с
+        повторами, не задерживая обход.
+        """
+        events = {}
+        for sub in expired_subscriptions:
+            payload = {'user_id': sub.user_id, 'subscription_id': sub.id}
+            events[sub.id] = [(kind, f"{kind}:{sub.id}", payload)
+                              for kind in ('disable_peer', 'notify_expired', 'cleanup_configs')]
+        # Подписку, продленную после чтения страницы, деактивация не затронет:
+        # запись идет по id и сроку, события - только для деактивированных
+        deactivated = await self.db.expire_subscriptions(
+            [(sub.id, sub.user_id) for sub in expired_subscriptions], int(time.time()), outbox=events
+        )
+        logging.info(f"Deactivated {len(deactivated)} subscriptions in database")
+        self.outbox.notify()
+
+    # --- Обработчики outbox (идемпотентные) ---
+    # Событие могло пролежать в outbox (повторы, простой воркера), пока
+    # пользователь продлил подписку - такие события завершаются без действия
+
+    async def disable_peers(self, events) -> dict:
+        """Отключение клиентов пачки событий по одному снимку сервера"""
+        names = {}
+        for event in events:
+            user_id = event.payload['user_id']
+            if await self.db.check_subscription(user_id):
+                logging.info(f"Skipping peer disable for user {user_id}: subscription renewed")
+                continue
+            names[f"user_{user_id}"] = event.id
+        result = await self.wg_api.disable_clients(names)
+        return {names[name]: "client is still enabled" for name in result['failed']}
+
+    async def notify_expired(self, payload: dict):
+        """Уведомление об истечении; журнал исключает повторную отправку"""
+        if await self.db.check_subscription(payload['user_id']):
+            return
+        if await self.db.claim_notification(payload['user_id'], payload['subscription_id'], 'expired'):
+            await self.send_expired_notification(payload['user_id'], payload['subscription_id'])
+
+    async def cleanup_configs(self, payload: dict):
+        """Удаление файлов конфигурации истекшего клиента"""
+        user_id = payload['user_id']
+        if await self.db.check_subscription(user_id):
+            return
+        self.config_manager.remove_configs(user_id, f"user_{user_id}")
+
+    async def send_warnings(self):
+        """Многоуровневые предупреждения о скором истечении (WARNING_TIERS)
+
+        Для каждого уровня одним диапазонным запросом выбираются подписки,
+        срок которых наступит в пределах уровня, но позже следующего, более
+        близкого уровня, и по которым этот уровень еще не отправлялся. Так
+        приходит только самое близкое из пропущенных предупреждений, в том
+        числе после простоя бота, и каждое - один раз. Подписка, купленная
+        позже начала окна уровня, его предупреждение не получает.
+        Истекшие подписки здесь не обрабатываются - это делает задача expiry.
+        """
+        now = int(time.time())
+        sent = 0
+        for index, (tier, window, time_text) in enumerate(WARNING_TIERS):
+            floor = WARNING_TIERS[index + 1][1] if index + 1 < len(WARNING_TIERS) else 0
+            after = None
+            while True:
+                page = await self.db.get_warning_due_page(tier, window, floor, after, self.batch_size, now)
+                claimed = {row[1] for row in await self.db.claim_notifications(
+                    (sub.user_id, sub.id, warning_type(tier, sub.expiration_ts)) for sub in page
+                )}
+                # Темп отправки задает очередь сообщений, поэтому страница отправляется разом
+                results = await asyncio.gather(*(
+                    self._send_warning(sub, tier, time_text) for sub in page if sub.id in claimed
+                ))
+                sent += sum(results)
+                if len(page) < self.batch_size:
+                    break
+                after = page[-1].key
+        logging.info(f"Отправлено предупреждений: {sent}")
+
+    async def _send_warning(self, sub: Subscription, tier: str, time_text: str) -> bool:
+        try:
+            await self.send_warning_notification(sub.user_id, time_text)
+            return True
+        except Exception as e:
+            await self.db.release_notification(sub.id, warning_type(tier, sub.expiration_ts))
+            logging.error(f"Ошибка при обработке подписки пользователя {sub.user_id}: {e}")
+            return False
+
+    async def prune_notifications(self):
+        """Удаление старых записей журнала уведомлений"""
+        await self.db.prune_notifications(NOTIFICATION_TTL_DAYS)
+
+    async def send_warning_notification(self, user_id: int, time_text: str):
+        """Отправка предупреждения о скором истечении подписки"""
+        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="Продлить подписку", callback_data="extend_subscription")]
+        ])
+
+        await self.sender.send_message(
+            user_id,
+            f"⚠️ Внимание! Ваша подписка VPN истекает через {time_text}!\n\n"
+            "Рекомендуем продлить подписку заранее, чтобы избежать отключения.",
+            reply_markup=keyboard
+        )
+        logging.info(f"Отправлено предупреждение пользователю {user_id} об истечении через {time_text}")
+
+    async def send_expired_notification(self, user_id: int, subscription_id: int):
+        """Отправка уведомления об истечении уже занятого в журнале
+
+        Если отправить не удалось, отметка снимается, и outbox повторит
+        попытку.
+        """
+        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text="Продлить подписку", callback_data="buy")]
+        ])
+        try:
+            await self.sender.send_message(
+                user_id,
+                "❌ Ваша подписка истекла!\n"
+                "Для продолжения использования VPN необходимо продлить подписку.",
+                reply_markup=keyboard
+            )
+        except Exception:
+            await self.db.release_notification(subscription_id, 'expired')
+            raise
+        logging.info(f"- Отправлено уведомление об истечении подписки пользователю {user_id}")
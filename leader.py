@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Optional
+
+class LeaderElector:
+    """Выбор лидера среди реплик бота по аренде в общем хранилище.
+
+    Лидер раз в heartbeat секунд продлевает аренду name на ttl секунд;
+    остальные реплики с тем же интервалом пытаются ее захватить и
+    становятся лидером, как только аренда истекла или освобождена. При
+    штатной остановке аренда освобождается сразу, при падении лидера ее
+    подхватят не позже чем через ttl + heartbeat секунд.
+
+    Лидером реплика считает себя только до local_deadline - момента, когда
+    аренда гарантированно еще действует (время запроса + ttl - margin), так
+    что при зависшей базе лидер отступает сам, не дожидаясь ответа.
+    Каждый захват выдает новый fencing-токен: confirm() проверяет в
+    хранилище, что токен еще действующий, и отсекает устаревшего лидера,
+    очнувшегося после паузы.
+
+    Ограничение: токен проверяется только перед запуском задачи (Scheduler
+    вызывает confirm()), сами записи задачи его не несут. Лидер, зависший
+    посреди задачи дольше ttl, может доработать ее одновременно с новым
+    лидером, поэтому фоновые задачи должны быть идемпотентными: события
+    outbox с ключами дедупликации, журнал уведомлений, условные UPDATE.
+
+    Хранилище - любой объект с async методами acquire_lease, release_lease
+    и check_lease (Storage для SQLite и PostgreSQL).
+    """
+
+    def __init__(self, store, name: str = 'scheduler', holder: Optional[str] = None,
+                 ttl: float = 10.0, heartbeat: float = 3.0, margin: float = 1.0):
+        if heartbeat >= ttl - margin:
+            raise ValueError("Heartbeat must be shorter than lease ttl minus margin")
+        self.store = store
+        self.name = name
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.margin = margin
+        self.token: Optional[int] = None
+        self.local_deadline = 0.0
+        self.elections = 0
+        self._listeners = []
+
+    @property
+    def is_leader(self) -> bool:
+        return self.token is not None and time.monotonic() < self.local_deadline
+
+    def add_listener(self, callback: Callable[[bool], None]):
+        """Подписка на смену роли: callback(True) - стали лидером, callback(False) - перестали"""
+        self._listeners.append(callback)
+
+    def _notify(self, leading: bool):
+        for callback in self._listeners:
+            try:
+                callback(leading)
+            except Exception as e:
+                logging.error(f"Leadership listener failed: {e}")
+
+    def _step_down(self, reason: str):
+        if self.token is None:
+            return
+        logging.warning(f"Lost leadership of {self.name} (token {self.token}): {reason}")
+        self.token = None
+        self.local_deadline = 0.0
+        self._notify(False)
+
+    async def try_acquire(self) -> bool:
+        """Один такт: захват или продление аренды; True - реплика лидер"""
+        started = time.monotonic()
+        was_leading = self.is_leader
+        try:
+            token = await self.store.acquire_lease(self.name, self.holder, self.ttl)
+        except Exception as e:
+            logging.error(f"Lease heartbeat for {self.name} failed: {e}")
+            if self.token is not None and not self.is_leader:
+                self._step_down("lease expired without renewal")
+            return self.is_leader
+        if token is None:
+            self._step_down("lease is held by another replica")
+            return False
+        self.local_deadline = started + self.ttl - self.margin
+        if token != self.token:
+            if self.token is not None:
+                self._step_down("lease was taken over")
+            self.token = token
+            self.elections += 1
+            logging.info(f"Became leader of {self.name} as {self.holder} (token {token})")
+            self._notify(True)
+        elif not was_leading:
+            # Продление запоздало, но аренду никто не перехватил
+            logging.info(f"Leadership of {self.name} restored (token {token})")
+            self._notify(True)
+        return True
+
+    async def confirm(self) -> bool:
+        """Проверка по хранилищу, что fencing-токен еще действующий (на момент вызова)"""
+        token = self.token
+        if token is None or not self.is_leader:
+            return False
+        try:
+            if await self.store.check_lease(self.name, self.holder, token):
+                return True
+        except Exception as e:
+            logging.error(f"Lease check for {self.name} failed: {e}")
+            return False
+        self._step_down("fencing token is stale")
+        return False
+
+    async def release(self):
+        """Освобождение аренды при остановке: другая реплика подхватит ее сразу"""
+        if self.token is None:
+            return
+        self._step_down("released")
+        try:
+            await self.store.release_lease(self.name, self.holder)
+        except Exception as e:
+            logging.warning(f"Failed to release lease {self.name}: {e}")
+
+    async def run(self):
+        """Фоновая задача выборов; при отмене освобождает аренду"""
+        logging.info(f"Leader election for {self.name} started as {self.holder}")
+        try:
+            while True:
+                await self.try_acquire()
+                await asyncio.sleep(self.heartbeat)
+        finally:
+            await asyncio.shield(self.release())
+
+    def stats(self) -> dict:
+        return {
+            'holder': self.holder,
+            'leader': self.is_leader,
+            'token': self.token,
+            'elections': self.elections,
+        }
@@ -3,79 +3,183 @@ from typing import Dict, Optional
 from datetime import datetime
 import json
 import os
+import sqlite3
 
 class LoadBalancer:
-    def __init__(self, state_file="servers_state.json"):
+    """Балансировщик клиентов по серверам.
+
+    Состояние хранится в общей SQLite базе (db_file), поэтому несколько
+    процессов бота могут распределять клиентов одновременно: счетчики
+    меняются атомарными UPDATE внутри BEGIN IMMEDIATE, обновления не теряются.
+    JSON файл (state_file) используется только для первоначального импорта
+    и для выгрузки снимка через save_state().
+    """
+
+    def __init__(self, state_file="servers_state.json", db_file="servers_state.db", timeout: float = 30.0):
         self.state_file = state_file
-        self.servers = {}
+        self.db_file = db_file
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE)
+        self.conn = sqlite3.connect(db_file, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS servers (
+            server_id TEXT PRIMARY KEY,
+            info TEXT NOT NULL,
+            clients_count INTEGER NOT NULL DEFAULT 0,
+            added_at TEXT
+        )
+        ''')
         self.load_state()
 
+    @property
+    def servers(self) -> Dict[str, dict]:
+        """Актуальный снимок состояния всех серверов"""
+        cursor = self.conn.execute('SELECT server_id, info, clients_count, added_at FROM servers ORDER BY server_id')
+        return {row[0]: self._row_to_info(row) for row in cursor.fetchall()}
+
+    @staticmethod
+    def _row_to_info(row) -> dict:
+        info = json.loads(row[1])
+        info['clients_count'] = row[2]
+        if row[3] is not None:
+            info['added_at'] = row[3]
+        return info
+
+    def _insert_server(self, server_id: str, server_info: dict) -> bool:
+        info = {k: v for k, v in server_info.items() if k not in ('clients_count', 'added_at')}
+        cursor = self.conn.execute('''
+        INSERT OR IGNORE INTO servers (server_id, info, clients_count, added_at)
+        VALUES (?, ?, ?, ?)
+        ''', (
+            server_id,
+            json.dumps(info),
+            int(server_info.get('clients_count', 0)),
+            server_info.get('added_at', str(datetime.now()))
+        ))
+        return cursor.rowcount == 1
+
     def add_server(self, server_id: str, server_info: dict):
         """Добавить новый сервер"""
-        if server_id in self.servers:
-            logging.warning(f"Server {server_id} already exists")
-            return
-        
+        server_info = dict(server_info)
         server_info['clients_count'] = server_info.get('clients_count', 0)
         server_info['added_at'] = str(datetime.now())
-        self.servers[server_id] = server_info
-        self.save_state()
+        if not self._insert_server(server_id, server_info):
+            logging.warning(f"Server {server_id} already exists")
+            return
         logging.info(f"Added server {server_id}: {server_info}")
 
     def get_server_info(self, server_id: str) -> Optional[dict]:
         """Получить информацию о сервере"""
-        return self.servers.get(server_id)
+        cursor = self.conn.execute(
+            'SELECT server_id, info, clients_count, added_at FROM servers WHERE server_id = ?',
+            (server_id,)
+        )
+        row = cursor.fetchone()
+        return self._row_to_info(row) if row else None
 
     def select_server(self) -> str:
         """Выбрать сервер с наименьшей нагрузкой"""
-        if not self.servers:
+        cursor = self.conn.execute(
+            'SELECT server_id, clients_count FROM servers ORDER BY clients_count, server_id LIMIT 1'
+        )
+        row = cursor.fetchone()
+        if not row:
             raise Exception("No servers available")
 
-        # Сортируем серверы по количеству клиентов
-        sorted_servers = sorted(
-            self.servers.items(),
-            key=lambda x: x[1].get('clients_count', 0)
-        )
+        logging.info(f"Selected server {row[0]} with {row[1]} clients")
+        return row[0]
+
+    def acquire_server(self) -> str:
+        """Выбрать наименее загруженный сервер и сразу занять на нем место.
+
+        Выбор и увеличение счетчика выполняются в одной транзакции, поэтому
+        параллельные процессы не выберут один и тот же "свободный" слот.
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                'SELECT server_id FROM servers ORDER BY clients_count, server_id LIMIT 1'
+            ).fetchone()
+            if not row:
+                raise Exception("No servers available")
+            self.conn.execute(
+                'UPDATE servers SET clients_count = clients_count + 1 WHERE server_id = ?',
+                (row[0],)
+            )
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
 
-        # Возвращаем ID сервера с наименьшим количеством клиентов
-        selected_server_id = sorted_servers[0][0]
-        logging.info(f"Selected server {selected_server_id} with {self.servers[selected_server_id].get('clients_count', 0)} clients")
-        return selected_server_id
+        logging.info(f"Acquired slot on server {row[0]}")
+        return row[0]
 
     def update_server_clients_count(self, server_id: str, count: Optional[int] = None):
         """Обновить количество клиентов на сервере"""
-        if server_id not in self.servers:
-            logging.error(f"Server {server_id} not found")
-            return
-
-        if count is None:
-            # Если количество не указано, увеличиваем на 1
-            self.servers[server_id]['clients_count'] = self.servers[server_id].get('clients_count', 0) + 1
-        else:
-            self.servers[server_id]['clients_count'] = count
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            if count is None:
+                # Если количество не указано, атомарно увеличиваем на 1
+                cursor = self.conn.execute(
+                    'UPDATE servers SET clients_count = clients_count + 1 WHERE server_id = ?',
+                    (server_id,)
+                )
+            else:
+                cursor = self.conn.execute(
+                    'UPDATE servers SET clients_count = ? WHERE server_id = ?',
+                    (count, server_id)
+                )
+            if cursor.rowcount == 0:
+                self.conn.execute('ROLLBACK')
+                logging.error(f"Server {server_id} not found")
+                return
+            new_count = self.conn.execute(
+                'SELECT clients_count FROM servers WHERE server_id = ?', (server_id,)
+            ).fetchone()[0]
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
 
-        self.save_state()
-        logging.info(f"Updated server {server_id} clients count to {self.servers[server_id]['clients_count']}")
+        logging.info(f"Updated server {server_id} clients count to {new_count}")
 
     def load_state(self):
-        """Загрузить состояние из файла"""
+        """Импортировать состояние из JSON файла, если общая база еще пуста"""
         try:
-            if os.path.exists(self.state_file):
-                with open(self.state_file, 'r') as f:
-                    self.servers = json.load(f)
-                logging.info(f"Loaded {len(self.servers)} servers from state")
+            if not os.path.exists(self.state_file):
+                return
+            if self.conn.execute('SELECT 1 FROM servers LIMIT 1').fetchone():
+                return
+            with open(self.state_file, 'r') as f:
+                servers = json.load(f)
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for server_id, server_info in servers.items():
+                    self._insert_server(server_id, server_info)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            logging.info(f"Loaded {len(servers)} servers from state")
         except Exception as e:
             logging.error(f"Error loading state: {e}")
-            self.servers = {}
 
     def save_state(self):
-        """Сохранить состояние в файл"""
+        """Выгрузить снимок состояния в JSON файл"""
         try:
-            with open(self.state_file, 'w') as f:
+            tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as f:
                 json.dump(self.servers, f, indent=2)
+            os.replace(tmp_file, self.state_file)
         except Exception as e:
             logging.error(f"Error saving state: {e}")
 
     def get_all_servers(self) -> dict:
         """Получить информацию о всех серверах"""
         return self.servers
+
+    def close(self):
+        """Закрытие соединения с базой состояния"""
+        self.conn.close()
@@ -0,0 +1,171 @@
+import asyncio
+import functools
+import glob
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from scheduler import IntervalTrigger, Scheduler
+from storage import Storage
+
+class DatabaseMaintenance:
+    """Фоновое обслуживание базы бота.
+
+    - incremental_vacuum небольшими шагами возвращает свободные страницы,
+      между шагами успевают выполниться ожидающие записи;
+    - PRAGMA optimize (и периодически полный ANALYZE) поддерживает
+      статистику планировщика актуальной;
+    - горячая резервная копия через backup API из read-only соединения,
+      с ротацией старых копий;
+    - перенос холодных строк (старые платежи, уведомления, неактивные
+      подписки) в архив пачками, оперативные таблицы остаются маленькими.
+
+    Тяжелая работа выполняется в потоках AsyncDatabase, event loop и
+    обработчики сообщений не блокируются. Сроки задач ведет Scheduler
+    (register_jobs), сами задачи сериализуются общей блокировкой.
+    """
+
+    def __init__(self, db: Storage, db_file: str, backup_dir: str = 'backups',
+                 backup_interval: float = 86400, backups_keep: int = 7,
+                 vacuum_interval: float = 3600, vacuum_pages: int = 256, vacuum_max_steps: int = 64,
+                 optimize_interval: float = 3600, analyze_interval: float = 7 * 86400,
+                 backup_pages: int = 256, backup_sleep: float = 0.005,
+                 archive_interval: float = 86400, archive_after_days: float = 30, archive_batch: int = 500):
+        self.db = db
+        self.db_file = db_file
+        self.backup_dir = backup_dir
+        self.backup_interval = backup_interval
+        self.backups_keep = backups_keep
+        self.vacuum_interval = vacuum_interval
+        self.vacuum_pages = vacuum_pages
+        self.vacuum_max_steps = vacuum_max_steps
+        self.optimize_interval = optimize_interval
+        self.analyze_interval = analyze_interval
+        self.backup_pages = backup_pages
+        self.backup_sleep = backup_sleep
+        self.archive_interval = archive_interval
+        self.archive_after_days = archive_after_days
+        self.archive_batch = archive_batch
+        self.last_run: Dict[str, float] = {}
+        self.last_report: Dict = {}
+        self._lock = asyncio.Lock()
+        self._prepared = False
+
+    @classmethod
+    def from_env(cls, db: Storage, db_file: str) -> 'DatabaseMaintenance':
+        """Настройки из переменных окружения (интервалы в часах)"""
+        return cls(
+            db, db_file,
+            backup_dir=os.getenv('BACKUP_DIR', 'backups'),
+            backup_interval=float(os.getenv('BACKUP_INTERVAL_HOURS', '24')) * 3600,
+            backups_keep=int(os.getenv('BACKUP_KEEP', '7')),
+            vacuum_interval=float(os.getenv('VACUUM_INTERVAL_HOURS', '1')) * 3600,
+            archive_after_days=float(os.getenv('ARCHIVE_AFTER_DAYS', '30')),
+        )
+
+    def _due(self, task: str, interval: float, now: float) -> bool:
+        return interval > 0 and now - self.last_run.get(task, 0) >= interval
+
+    async def vacuum(self) -> int:
+        """Шаги incremental_vacuum, пока есть свободные страницы"""
+        freed = 0
+        for _ in range(self.vacuum_max_steps):
+            step = await self.db.incremental_vacuum(self.vacuum_pages)
+            freed += step
+            if step < self.vacuum_pages:
+                break
+            # Даем очереди записей выполниться между шагами
+            await asyncio.sleep(0)
+        return freed
+
+    async def backup(self) -> Optional[str]:
+        """Резервная копия с именем по времени и ротация старых копий"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(self.db_file))[0]
+        target = os.path.join(self.backup_dir, f"{name}-{datetime.now():%Y%m%d-%H%M%S-%f}.db")
+        await self.db.backup(target, self.backup_pages, self.backup_sleep)
+        self.prune_backups()
+        return target
+
+    def prune_backups(self) -> list:
+        """Удаление копий сверх backups_keep, начиная с самых старых"""
+        name = os.path.splitext(os.path.basename(self.db_file))[0]
+        backups = sorted(glob.glob(os.path.join(self.backup_dir, f"{name}-*.db")))
+        removed = backups[:-self.backups_keep] if self.backups_keep > 0 else []
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"Failed to remove old backup {path}: {e}")
+        if removed:
+            logging.info(f"Removed {len(removed)} old backups")
+        return removed
+
+    async def run_once(self, force: bool = False, tasks=None) -> Dict:
+        """Выполнение задач, срок которых подошел (force - всех сразу)
+
+        tasks ограничивает набор: 'archive', 'vacuum', 'optimize', 'backup'.
+        Возвращает отчет о выполненных задачах.
+        """
+        tasks = set(tasks or ('archive', 'vacuum', 'optimize', 'backup'))
+        async with self._lock:
+            now = time.time()
+            report = {}
+            if not self._prepared:
+                report['auto_vacuum_enabled'] = await self.db.enable_incremental_vacuum()
+                self._prepared = True
+
+            # Архив перед vacuum: освободившиеся страницы вернутся в том же проходе
+            if ('archive' in tasks and self.archive_after_days > 0
+                    and (force or self._due('archive', self.archive_interval, now))):
+                started = time.perf_counter()
+                report['archived'] = await self.db.archive_old_rows(self.archive_after_days, self.archive_batch)
+                report['archive_seconds'] = time.perf_counter() - started
+                self.last_run['archive'] = now
+
+            if 'vacuum' in tasks and (force or self._due('vacuum', self.vacuum_interval, now)):
+                started = time.perf_counter()
+                report['vacuum_freed_pages'] = await self.vacuum()
+                report['vacuum_seconds'] = time.perf_counter() - started
+                self.last_run['vacuum'] = now
+
+            if 'optimize' in tasks and (force or self._due('optimize', self.optimize_interval, now)):
+                analyze = self._due('analyze', self.analyze_interval, now)
+                await self.db.optimize(analyze=analyze)
+                report['optimized'] = 'ANALYZE' if analyze else 'optimize'
+                self.last_run['optimize'] = now
+                if analyze:
+                    self.last_run['analyze'] = now
+
+            if 'backup' in tasks and (force or self._due('backup', self.backup_interval, now)):
+                if self.db.supports_file_backup:
+                    started = time.perf_counter()
+                    report['backup'] = await self.backup()
+                    report['backup_seconds'] = time.perf_counter() - started
+                else:
+                    report['backup'] = None
+                    logging.info(f"Skipping backup: {type(self.db).__name__} does not support file backups")
+                self.last_run['backup'] = now
+
+            report['file'] = await self.db.get_file_stats()
+            self.last_report = report
+            return report
+
+    def register_jobs(self, scheduler: Scheduler):
+        """Задачи обслуживания в планировщике; интервал 0 отключает задачу"""
+        intervals = {
+            'archive': self.archive_interval if self.archive_after_days > 0 else 0,
+            'vacuum': self.vacuum_interval,
+            'optimize': self.optimize_interval,
+            'backup': self.backup_interval if self.db.supports_file_backup else 0,
+        }
+        for task, interval in intervals.items():
+            if interval > 0:
+                scheduler.add_job(f'maintenance_{task}', functools.partial(self._run_task, task),
+                                  IntervalTrigger(interval), jitter=min(interval * 0.05, 300))
+
+    async def _run_task(self, task: str):
+        report = await self.run_once(force=True, tasks=[task])
+        logging.info(f"Database maintenance ({task}): {report}")
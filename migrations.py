@@ -0,0 +1,359 @@
+import logging
+import sqlite3
+
+def epoch_sql(column: str, local: bool) -> str:
+    """SQL выражение, переводящее текстовую дату колонки в UTC epoch секунды
+
+    local=True - текст записан в локальном времени хоста (datetime.now()),
+    local=False - уже в UTC (CURRENT_TIMESTAMP). Локальное время читается в
+    часовом поясе процесса, выполняющего миграцию, поэтому мигрировать нужно
+    на том же хосте (с тем же TZ), где работал бот; записи, попавшие в
+    переход на летнее время, неоднозначны.
+    """
+    modifier = ", 'utc'" if local else ""
+    return (
+        f"CASE WHEN typeof({column}) IN ('integer', 'real') THEN CAST({column} AS INTEGER) "
+        f"ELSE CAST(strftime('%s', substr({column}, 1, 19){modifier}) AS INTEGER) END"
+    )
+
+# Счетчики строк, которые поддерживают триггеры: имя -> (таблица, условие,
+# колонки условия). {row} в условии заменяется на NEW/OLD или имя таблицы.
+# /check_db читает их одной выборкой вместо COUNT(*) по каждой таблице.
+COUNTERS = {
+    'users': ('users', None, ()),
+    'active_subscriptions': ('subscriptions', '{row}.is_active = 1', ('is_active',)),
+    'pending_payments': ('payments', "{row}.status = 'pending'", ('status',)),
+    'confirmed_payments': ('payments', "{row}.status = 'confirmed'", ('status',)),
+    'client_configs': ('client_configs', None, ()),
+    'notifications': ('notifications', None, ()),
+}
+
+def counter_delta_sql(name: str, row: str) -> str:
+    """1, если строка row (NEW/OLD) учитывается счетчиком, иначе 0"""
+    condition = COUNTERS[name][1]
+    if condition is None:
+        return '1'
+    return f"(CASE WHEN {condition.format(row=row)} THEN 1 ELSE 0 END)"
+
+def counter_count_sql(name: str) -> str:
+    """Подзапрос с фактическим числом строк счетчика (полный проход)"""
+    table, condition, _ = COUNTERS[name]
+    where = f" WHERE {condition.format(row=table)}" if condition else ""
+    return f"(SELECT COUNT(*) FROM {table}{where})"
+
+def counters_check_sql() -> str:
+    """Сохраненные и фактические значения всех счетчиков одним запросом
+
+    Один SELECT видит согласованный снимок, поэтому расхождение не может
+    появиться из-за параллельной записи.
+    """
+    actual = ' '.join(f"WHEN '{name}' THEN {counter_count_sql(name)}" for name in COUNTERS)
+    return f"SELECT name, value, CASE name {actual} END FROM counters ORDER BY name"
+
+def counter_upsert_sql(name: str, update: bool) -> str:
+    """Запись фактического значения счетчика (update=False - только если его еще нет)"""
+    action = 'DO UPDATE SET value = excluded.value' if update else 'DO NOTHING'
+    return (
+        f"INSERT INTO counters (name, value) VALUES ('{name}', {counter_count_sql(name)}) "
+        f"ON CONFLICT (name) {action}"
+    )
+
+def _counter_triggers(name: str) -> list:
+    """Триггеры SQLite, поддерживающие счетчик"""
+    table, condition, columns = COUNTERS[name]
+    bump = "UPDATE counters SET value = value {delta} WHERE name = '" + name + "';"
+    when = (lambda row: f" WHEN {condition.format(row=row)}") if condition else (lambda row: "")
+    triggers = [
+        f"CREATE TRIGGER IF NOT EXISTS counter_{name}_insert AFTER INSERT ON {table}{when('NEW')} "
+        f"BEGIN {bump.format(delta='+ 1')} END",
+        f"CREATE TRIGGER IF NOT EXISTS counter_{name}_delete AFTER DELETE ON {table}{when('OLD')} "
+        f"BEGIN {bump.format(delta='- 1')} END",
+    ]
+    if columns:
+        new, old = counter_delta_sql(name, 'NEW'), counter_delta_sql(name, 'OLD')
+        triggers.append(
+            f"CREATE TRIGGER IF NOT EXISTS counter_{name}_update AFTER UPDATE OF {', '.join(columns)} ON {table} "
+            f"WHEN {new} <> {old} BEGIN {bump.format(delta=f'+ {new} - {old}')} END"
+        )
+    return triggers
+
+def _create_counters(cursor: sqlite3.Cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    for name in COUNTERS:
+        for trigger in _counter_triggers(name):
+            cursor.execute(trigger)
+        cursor.execute(counter_upsert_sql(name, update=False))
+
+# Версионированные миграции схемы. Номер применённой версии хранится в
+# PRAGMA user_version. Каждая миграция - (версия, описание, шаги), где шаг -
+# SQL строка или функция, принимающая курсор. Шаги должны быть идемпотентными:
+# база, созданная до появления миграций, имеет user_version = 0, но уже
+# содержит часть таблиц.
+MIGRATIONS = [
+    (1, "initial schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            expiration TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active INTEGER DEFAULT 1,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            amount REAL,
+            duration_months INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS client_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            private_key TEXT,
+            public_key TEXT,
+            pre_shared_key TEXT,
+            config_path TEXT,
+            qr_path TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            subscription_id INTEGER,
+            notification_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id),
+            FOREIGN KEY (subscription_id) REFERENCES subscriptions(id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active ON subscriptions(user_id, is_active)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)',
+    ]),
+    (2, "partial covering index for expiry scans", [
+        # Частичный индекс содержит только активные подписки и все колонки,
+        # которые читают get_expired_subscriptions/get_active_subscriptions,
+        # поэтому обе выборки - поиск по диапазону expiration без обращения
+        # к таблице. Порядок (expiration, id) годится для keyset пагинации.
+        '''
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_active_expiration
+        ON subscriptions(expiration, id, user_id, created_at, is_active)
+        WHERE is_active = 1
+        ''',
+    ]),
+    (3, "integer UTC epoch timestamps for subscriptions and payments", [
+        # Подписки хранили локальное время хоста datetime.now() ('utc'
+        # переводит его в UTC по TZ процесса миграции), платежи -
+        # CURRENT_TIMESTAMP, который уже в UTC. records.to_epoch/from_epoch
+        # делают то же для datetime: наивное значение - локальное время
+        '''
+        CREATE TABLE subscriptions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            expiration INTEGER,
+            created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            is_active INTEGER DEFAULT 1,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        f'''
+        INSERT INTO subscriptions_new (id, user_id, expiration, created_at, is_active)
+        SELECT id, user_id, {epoch_sql('expiration', local=True)}, {epoch_sql('created_at', local=True)}, is_active
+        FROM subscriptions
+        ''',
+        'DROP TABLE subscriptions',
+        'ALTER TABLE subscriptions_new RENAME TO subscriptions',
+        'CREATE INDEX idx_subscriptions_user_active ON subscriptions(user_id, is_active)',
+        '''
+        CREATE INDEX idx_subscriptions_active_expiration
+        ON subscriptions(expiration, id, user_id, created_at, is_active)
+        WHERE is_active = 1
+        ''',
+        '''
+        CREATE TABLE payments_new (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            amount REAL,
+            duration_months INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+        ''',
+        f'''
+        INSERT INTO payments_new (payment_id, user_id, amount, duration_months, status, created_at)
+        SELECT payment_id, user_id, amount, duration_months, status, {epoch_sql('created_at', local=False)}
+        FROM payments
+        ''',
+        'DROP TABLE payments',
+        'ALTER TABLE payments_new RENAME TO payments',
+        'CREATE INDEX idx_payments_user ON payments(user_id)',
+    ]),
+    (4, "deduplicated notification ledger", [
+        # Оставляем первую запись каждого (subscription_id, notification_type)
+        '''
+        DELETE FROM notifications
+        WHERE subscription_id IS NOT NULL
+          AND id NOT IN (
+            SELECT MIN(id) FROM notifications
+            WHERE subscription_id IS NOT NULL
+            GROUP BY subscription_id, notification_type
+          )
+        ''',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_subscription_type
+        ON notifications(subscription_id, notification_type)
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at)',
+    ]),
+    (5, "trigger-maintained row counters", [
+        _create_counters,
+    ]),
+    (6, "scheduler job history", [
+        # Последний запуск каждой задачи планировщика: по нему после
+        # перезапуска догоняются пропущенные запуски
+        '''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            name TEXT PRIMARY KEY,
+            last_run REAL NOT NULL,
+            duration REAL,
+            error TEXT
+        )
+        ''',
+    ]),
+    (7, "leader election leases", [
+        # Аренда лидерства между репликами: token растет при каждой смене
+        # владельца и служит fencing-токеном
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (8, "transactional outbox", [
+        # Побочные эффекты изменений базы (отключение клиента, уведомление,
+        # удаление файлов) записываются в той же транзакции и выполняются
+        # воркером outbox.py. available_at NULL - попытки исчерпаны
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            dedup_key TEXT NOT NULL UNIQUE,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL,
+            locked_until REAL NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_available ON outbox(available_at) WHERE available_at IS NOT NULL',
+    ]),
+    (9, "broadcasts", [
+        # cursor - user_id последнего обработанного получателя (обход по
+        # возрастанию user_id); chat_id/message_id - сообщение администратора
+        # с прогрессом
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            segment TEXT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            chat_id INTEGER,
+            message_id INTEGER,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (10, "telegram file_id cache", [
+        # file_id, который Telegram вернул после загрузки файла конфигурации
+        # (kind = 'config') или QR-кода ('qr'); действителен, пока
+        # content_hash совпадает с версией конфигурации
+        '''
+        CREATE TABLE IF NOT EXISTS file_ids (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (user_id, kind)
+        )
+        ''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_version(conn: sqlite3.Connection) -> int:
+    """Текущая версия схемы"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(conn: sqlite3.Connection, migrations=MIGRATIONS) -> int:
+    """Применение недостающих миграций одной транзакцией
+
+    На актуальной базе это одно чтение PRAGMA user_version.
+    Возвращает версию схемы после применения.
+    """
+    latest = migrations[-1][0]
+    version = get_version(conn)
+    if version >= latest:
+        return version
+
+    if conn.in_transaction:
+        conn.commit()
+    # IMMEDIATE берет блокировку записи сразу: параллельно стартующий процесс
+    # дождется окончания и увидит уже обновленную версию
+    conn.execute("BEGIN IMMEDIATE")
+    cursor = conn.cursor()
+    try:
+        version = get_version(conn)
+        for number, description, steps in migrations:
+            if number <= version:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+            logging.info(f"Applied database migration {number}: {description}")
+        if version < latest:
+            cursor.execute(f"PRAGMA user_version = {int(latest)}")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Database migration failed: {e}")
+        raise
+    finally:
+        cursor.close()
+
+    logging.info(f"Database schema is at version {latest}")
+    return latest
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, Optional
+
+from storage import Storage
+
+class OutboxWorker:
+    """Исполнитель побочных эффектов из таблицы outbox.
+
+    Изменение базы и события о нужных действиях записываются одной
+    транзакцией (например, Storage.deactivate_subscriptions(..., outbox=...)),
+    а воркер захватывает готовые события пачками и выполняет их
+    обработчиками параллельно, не больше concurrency одновременно.
+    Выполненное событие удаляется; неудавшееся повторяется с
+    экспоненциальной задержкой base_delay * 2^attempts (не больше
+    max_delay, со случайным разбросом), после max_attempts остается в
+    таблице с available_at NULL для разбора.
+
+    Событие может выполниться повторно (воркер упал до отметки о
+    выполнении), поэтому обработчики должны быть идемпотентными.
+
+    Обработчик - async handler(payload) или, с batch=True,
+    async handler(events) -> {event_id: ошибка} для событий, которые
+    выгоднее выполнять пачкой (например, отключение клиентов по одному
+    снимку сервера).
+    """
+
+    def __init__(self, db: Storage, concurrency: int = 8, batch_size: int = 100, lease: float = 60.0,
+                 max_attempts: int = 8, base_delay: float = 5.0, max_delay: float = 3600.0,
+                 poll_interval: float = 30.0, on_wakeup: Optional[Callable[[], None]] = None):
+        self.db = db
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.on_wakeup = on_wakeup
+        self.handlers: Dict[str, tuple] = {}
+        self._pending = True
+        self._last_drain = 0.0
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+
+    def register(self, kind: str, handler: Callable[..., Awaitable], batch: bool = False):
+        self.handlers[kind] = (handler, batch)
+
+    def notify(self):
+        """Появились новые события: выполнить их, не дожидаясь опроса"""
+        self._pending = True
+        if self.on_wakeup is not None:
+            self.on_wakeup()
+
+    def next_run_time(self, now: float) -> float:
+        """Для DynamicTrigger: сразу после notify, иначе через poll_interval (события с задержкой)"""
+        if self._pending:
+            return now
+        return self._last_drain + self.poll_interval
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _finish(self, event, error: Optional[str]):
+        if error is None:
+            return event.id
+        attempts = event.attempts + 1
+        if attempts >= self.max_attempts:
+            self.dead += 1
+            logging.error(f"Outbox event {event.id} ({event.kind}) failed {attempts} times, giving up: {error}")
+            await self.db.retry_outbox(event.id, None, error)
+        else:
+            self.retried += 1
+            delay = self._backoff(event.attempts)
+            logging.warning(f"Outbox event {event.id} ({event.kind}) failed, retry in {delay:.0f}s: {error}")
+            await self.db.retry_outbox(event.id, delay, error)
+        return None
+
+    async def _run_batch(self, handler, events, semaphore) -> list:
+        async with semaphore:
+            try:
+                errors = await handler(events) or {}
+            except Exception as e:
+                errors = {event.id: str(e) or type(e).__name__ for event in events}
+        return [await self._finish(event, errors.get(event.id)) for event in events]
+
+    async def _run_one(self, handler, event, semaphore):
+        async with semaphore:
+            try:
+                await handler(event.payload)
+                error = None
+            except Exception as e:
+                error = str(e) or type(e).__name__
+        return [await self._finish(event, error)]
+
+    async def drain_once(self) -> int:
+        """Выполнение всех готовых событий пачками; возвращает число выполненных"""
+        self._pending = False
+        done_total = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            events = await self.db.claim_outbox(self.batch_size, self.lease)
+            if not events:
+                break
+            by_kind = defaultdict(list)
+            for event in events:
+                by_kind[event.kind].append(event)
+            runs = []
+            for kind, group in by_kind.items():
+                if kind not in self.handlers:
+                    runs.extend(self._finish(event, f"no handler for {kind}") for event in group)
+                    continue
+                handler, batch = self.handlers[kind]
+                if batch:
+                    runs.append(self._run_batch(handler, group, semaphore))
+                else:
+                    runs.extend(self._run_one(handler, event, semaphore) for event in group)
+            done = []
+            for result in await asyncio.gather(*runs):
+                done.extend(result if isinstance(result, list) else [result])
+            done = [event_id for event_id in done if event_id is not None]
+            if done:
+                await self.db.complete_outbox(done)
+            done_total += len(done)
+            if len(events) < self.batch_size:
+                break
+        self._last_drain = time.time()
+        self.completed += done_total
+        if done_total:
+            logging.info(f"Outbox: completed {done_total} events")
+        return done_total
+
+    def stats(self) -> Dict:
+        return {'completed': self.completed, 'retried': self.retried, 'dead': self.dead}
@@ -0,0 +1,947 @@
+import json
+import logging
+import time
+from typing import Dict, Optional
+
+import migrations
+from database import LRUCache, _ALL_RECORDS
+from records import Broadcast, ClientConfig, OutboxEvent, Payment, Subscription, User, from_epoch, to_epoch
+from storage import BROADCAST_SEGMENTS, Storage, notifies_subscriptions, warning_type
+
+try:
+    import asyncpg
+except ImportError:  # asyncpg нужен только для PostgreSQL
+    asyncpg = None
+
+# Время хранится так же, как в SQLite - UTC epoch секунды (BIGINT), поэтому
+# форма результатов совпадает. Внешние ключи не объявлены: SQLite их тоже
+# не проверяет (PRAGMA foreign_keys выключен), и поведение должно совпадать.
+_EPOCH_NOW = "(EXTRACT(EPOCH FROM now())::BIGINT)"
+
+SCHEMA = [
+    f'''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        created_at BIGINT DEFAULT {_EPOCH_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        expiration BIGINT,
+        created_at BIGINT DEFAULT {_EPOCH_NOW},
+        is_active INTEGER DEFAULT 1
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS payments (
+        payment_id TEXT PRIMARY KEY,
+        user_id BIGINT,
+        amount DOUBLE PRECISION,
+        duration_months INTEGER,
+        status TEXT DEFAULT 'pending',
+        created_at BIGINT DEFAULT {_EPOCH_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS client_configs (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT UNIQUE,
+        private_key TEXT,
+        public_key TEXT,
+        pre_shared_key TEXT,
+        config_path TEXT,
+        qr_path TEXT,
+        created_at BIGINT DEFAULT {_EPOCH_NOW}
+    )
+    ''',
+    f'''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        subscription_id BIGINT,
+        notification_type TEXT,
+        created_at BIGINT DEFAULT {_EPOCH_NOW}
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active ON subscriptions(user_id, is_active)',
+    # Не больше одной активной подписки на пользователя: FOR UPDATE в
+    # add_subscription не блокирует еще не существующую строку, и две
+    # параллельные первые покупки вставили бы две подписки. Прежние
+    # дубликаты (оставляем самую позднюю) гасятся до создания индекса
+    '''
+    UPDATE subscriptions s SET is_active = 0
+    WHERE s.is_active = 1 AND NOT EXISTS (
+        SELECT 1 FROM pg_indexes WHERE indexname = 'idx_subscriptions_one_active'
+    ) AND EXISTS (
+        SELECT 1 FROM subscriptions t
+        WHERE t.user_id = s.user_id AND t.is_active = 1 AND (t.expiration, t.id) > (s.expiration, s.id)
+    )
+    ''',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_subscriptions_one_active ON subscriptions(user_id) WHERE is_active = 1',
+    '''
+    CREATE INDEX IF NOT EXISTS idx_subscriptions_active_expiration
+    ON subscriptions(expiration, id) INCLUDE (user_id, created_at, is_active)
+    WHERE is_active = 1
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)',
+    '''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_subscription_type
+    ON notifications(subscription_id, notification_type)
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_notifications_created ON notifications(created_at)',
+    '''
+    CREATE TABLE IF NOT EXISTS job_runs (
+        name TEXT PRIMARY KEY,
+        last_run DOUBLE PRECISION NOT NULL,
+        duration DOUBLE PRECISION,
+        error TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        dedup_key TEXT NOT NULL UNIQUE,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available_at DOUBLE PRECISION,
+        locked_until DOUBLE PRECISION NOT NULL DEFAULT 0,
+        last_error TEXT,
+        created_at DOUBLE PRECISION NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_outbox_available ON outbox(available_at) WHERE available_at IS NOT NULL',
+    '''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGSERIAL PRIMARY KEY,
+        segment TEXT NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        cursor BIGINT NOT NULL DEFAULT 0,
+        total INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        chat_id BIGINT,
+        message_id BIGINT,
+        created_at DOUBLE PRECISION NOT NULL,
+        updated_at DOUBLE PRECISION NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS file_ids (
+        user_id BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        created_at DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (user_id, kind)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        holder TEXT NOT NULL,
+        token BIGINT NOT NULL,
+        expires_at DOUBLE PRECISION NOT NULL
+    )
+    ''',
+    'CREATE SCHEMA IF NOT EXISTS archive',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.payments (
+        payment_id TEXT,
+        user_id BIGINT,
+        amount DOUBLE PRECISION,
+        duration_months INTEGER,
+        status TEXT,
+        created_at BIGINT,
+        archived_at BIGINT,
+        PRIMARY KEY (payment_id, created_at)
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_archive_payments_user ON archive.payments(user_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.subscriptions (
+        id BIGINT PRIMARY KEY,
+        user_id BIGINT,
+        expiration BIGINT,
+        created_at BIGINT,
+        is_active INTEGER,
+        archived_at BIGINT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_archive_subscriptions_user ON archive.subscriptions(user_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS archive.notifications (
+        id BIGINT PRIMARY KEY,
+        user_id BIGINT,
+        subscription_id BIGINT,
+        notification_type TEXT,
+        created_at BIGINT,
+        archived_at BIGINT
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_archive_notifications_subscription ON archive.notifications(subscription_id)',
+    '''
+    CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    )
+    ''',
+]
+
+def _counter_schema(name: str) -> list:
+    """Функция и триггер, поддерживающие счетчик (аналог триггеров SQLite из migrations.py)"""
+    table, _, columns = migrations.COUNTERS[name]
+    events = 'INSERT OR DELETE' + (f" OR UPDATE OF {', '.join(columns)}" if columns else '')
+    return [
+        f'''
+        CREATE OR REPLACE FUNCTION counter_{name}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE counters SET value = value
+                + (CASE WHEN TG_OP <> 'DELETE' THEN {migrations.counter_delta_sql(name, 'NEW')} ELSE 0 END)
+                - (CASE WHEN TG_OP <> 'INSERT' THEN {migrations.counter_delta_sql(name, 'OLD')} ELSE 0 END)
+            WHERE name = '{name}';
+            RETURN NULL;
+        END $$
+        ''',
+        f'DROP TRIGGER IF EXISTS counter_{name} ON {table}',
+        f'''
+        CREATE TRIGGER counter_{name} AFTER {events} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION counter_{name}()
+        ''',
+        migrations.counter_upsert_sql(name, update=False),
+    ]
+
+for _name in migrations.COUNTERS:
+    SCHEMA.extend(_counter_schema(_name))
+
+# Холодные строки: таблица -> (ключ, колонки, условие переноса; $1 - epoch cutoff)
+ARCHIVE_TABLES = {
+    'payments': (
+        'payment_id',
+        'payment_id, user_id, amount, duration_months, status, created_at',
+        "status <> 'pending' AND created_at < $1",
+    ),
+    'subscriptions': (
+        'id',
+        'id, user_id, expiration, created_at, is_active',
+        'is_active = 0 AND expiration < $1',
+    ),
+    'notifications': (
+        'id',
+        'id, user_id, subscription_id, notification_type, created_at',
+        'created_at < $1',
+    ),
+}
+
+# Представления all_<таблица> с оперативными и архивными строками
+for _table, (_, _columns, _) in ARCHIVE_TABLES.items():
+    SCHEMA.append(
+        f'CREATE OR REPLACE VIEW all_{_table} AS '
+        f'SELECT {_columns} FROM {_table} UNION ALL SELECT {_columns} FROM archive.{_table}'
+    )
+
+# Ключ advisory lock, под которым реплики по очереди создают схему
+_SCHEMA_LOCK = 0x76706e5f626f74
+
+_SUBSCRIPTION_COLUMNS = 'id, user_id, expiration, created_at, is_active'
+
+def _affected(status: str) -> int:
+    """Количество строк из статуса команды ('UPDATE 3' -> 3)"""
+    try:
+        return int(status.rsplit(' ', 1)[-1])
+    except (ValueError, AttributeError):
+        return 0
+
+class PostgresStorage(Storage):
+    """Реализация Storage на PostgreSQL через asyncpg.
+
+    Несколько реплик бота работают с одной базой. Соединения берутся из
+    пула asyncpg; каждое соединение кэширует подготовленные выражения
+    (statement_cache_size), поэтому повторяющиеся запросы разбираются
+    сервером один раз. Пакетные операции выполняются одним запросом над
+    массивами (ANY/unnest) вместо цикла по строкам.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10,
+                 statement_cache_size: int = 256, cache: Optional[LRUCache] = None):
+        """cache по умолчанию отключен: запись другой реплики его не сбросит"""
+        if asyncpg is None:
+            raise RuntimeError("PostgresStorage requires the asyncpg package")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.cache = cache if cache is not None else LRUCache(maxsize=0)
+        self.pool = None
+
+    async def connect(self):
+        """Создание пула и схемы (идемпотентно)"""
+        if self.pool is not None:
+            return
+        pool = await asyncpg.create_pool(
+            self.dsn,
+            min_size=self.min_size,
+            max_size=self.max_size,
+            statement_cache_size=self.statement_cache_size,
+        )
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', _SCHEMA_LOCK)
+                for statement in SCHEMA:
+                    await conn.execute(statement)
+        self.pool = pool
+        logging.info(f"Connected to PostgreSQL storage (pool {self.min_size}-{self.max_size})")
+
+    async def _pool(self):
+        if self.pool is None:
+            await self.connect()
+        return self.pool
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    def cache_stats(self) -> Dict:
+        return self.cache.stats()
+
+    async def _execute(self, query, *args) -> str:
+        pool = await self._pool()
+        return await pool.execute(query, *args)
+
+    async def _fetch(self, query, *args):
+        pool = await self._pool()
+        return await pool.fetch(query, *args)
+
+    async def _fetchrow(self, query, *args):
+        pool = await self._pool()
+        return await pool.fetchrow(query, *args)
+
+    async def _cached(self, key, loader, *args):
+        found, value = self.cache.get(key)
+        if found:
+            return value
+        generation = self.cache.generation()
+        value = await loader(*args)
+        self.cache.put(key, value, generation)
+        return value
+
+    def _invalidate(self, *keys):
+        if _ALL_RECORDS in keys:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(keys)
+
+    # --- Пользователи ---
+
+    async def add_user(self, user_id, username=None):
+        await self._execute('''
+        INSERT INTO users (user_id, username) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, created_at = EXCLUDED.created_at
+        ''', user_id, username)
+
+    async def get_user(self, user_id):
+        row = await self._fetchrow('SELECT user_id, username, created_at FROM users WHERE user_id = $1', user_id)
+        return User._make(row) if row else None
+
+    # --- Платежи ---
+
+    async def create_payment(self, user_id, amount, status, duration_months=None, payment_method=None, screenshot_file_id=None):
+        row = await self._fetchrow('''
+        INSERT INTO payments (payment_id, user_id, amount, duration_months, status, created_at)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        RETURNING payment_id
+        ''', str(user_id), user_id, amount, duration_months, status, int(time.time()))
+        return row[0]
+
+    async def verify_payment(self, payment_id, status):
+        await self._execute('UPDATE payments SET status = $1 WHERE payment_id = $2', status, payment_id)
+
+    async def add_payment(self, payment_id: str, user_id: int, amount: float, duration: int, status: str = 'pending'):
+        try:
+            await self._execute('''
+            INSERT INTO payments (payment_id, user_id, amount, duration_months, status, created_at)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ''', payment_id, user_id, amount, duration, status, int(time.time()))
+            logging.info(f"Added new payment: ID={payment_id}, user_id={user_id}, amount={amount}, duration={duration}")
+            return True
+        except Exception as e:
+            logging.error(f"Error adding payment: {e}")
+            return False
+
+    async def update_payment_status(self, payment_id: str, status: str):
+        await self._execute('UPDATE payments SET status = $1 WHERE payment_id = $2', status, payment_id)
+        logging.info(f"Updated payment {payment_id} status to {status}")
+
+    async def get_payment(self, payment_id: str):
+        row = await self._fetchrow('''
+        SELECT payment_id, user_id, amount, duration_months, status, created_at
+        FROM payments WHERE payment_id = $1
+        ''', payment_id)
+        return Payment._make(row) if row else None
+
+    async def get_user_payments(self, user_id):
+        rows = await self._fetch('''
+        SELECT payment_id, user_id, amount, duration_months, status, created_at
+        FROM all_payments WHERE user_id = $1 ORDER BY created_at DESC
+        ''', user_id)
+        return [Payment._make(row) for row in rows]
+
+    # --- Подписки ---
+
+    @notifies_subscriptions('one')
+    async def add_subscription(self, user_id, duration_days):
+        now = int(time.time())
+        duration = int(duration_days * 86400)
+        pool = await self._pool()
+        for attempt in range(2):
+            try:
+                async with pool.acquire() as conn:
+                    async with conn.transaction():
+                        current = await conn.fetchrow('''
+                        SELECT expiration, id FROM subscriptions
+                        WHERE user_id = $1 AND is_active = 1
+                        ORDER BY expiration DESC LIMIT 1
+                        FOR UPDATE
+                        ''', user_id)
+                        if current:
+                            # Активную подписку продлеваем от даты окончания, истекшую - от текущего момента
+                            end_date = max(current['expiration'], now) + duration
+                            await conn.execute('''
+                            UPDATE subscriptions SET expiration = $1, is_active = 1
+                            WHERE user_id = $2 AND is_active = 1
+                            ''', end_date, user_id)
+                        else:
+                            end_date = now + duration
+                            await conn.execute('''
+                            INSERT INTO subscriptions (user_id, expiration, created_at) VALUES ($1, $2, $3)
+                            ''', user_id, end_date, now)
+                break
+            except asyncpg.UniqueViolationError:
+                # Параллельная первая покупка успела вставить подписку - продлеваем ее
+                if attempt:
+                    raise
+        self._invalidate(('subscription', user_id))
+        logging.info(f"Subscription for user {user_id} is valid until {from_epoch(end_date)}")
+        return True
+
+    @notifies_subscriptions('one')
+    async def create_subscription(self, user_id: int, expiration):
+        try:
+            pool = await self._pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        'UPDATE subscriptions SET is_active = 0 WHERE user_id = $1 AND is_active = 1', user_id
+                    )
+                    await conn.execute('''
+                    INSERT INTO subscriptions (user_id, expiration, created_at, is_active) VALUES ($1, $2, $3, 1)
+                    ''', user_id, to_epoch(expiration), int(time.time()))
+            self._invalidate(('subscription', user_id))
+            logging.info(f"Created new subscription for user {user_id} until {expiration}")
+            return True
+        except Exception as e:
+            logging.error(f"Error creating subscription: {e}")
+            return False
+
+    @notifies_subscriptions('one')
+    async def deactivate_subscription(self, user_id: int) -> bool:
+        try:
+            await self._execute(
+                'UPDATE subscriptions SET is_active = 0 WHERE user_id = $1 AND is_active = 1', user_id
+            )
+            self._invalidate(('subscription', user_id))
+            logging.info(f"Successfully deactivated subscription for user {user_id}")
+            return True
+        except Exception as e:
+            logging.error(f"Error deactivating subscription for user {user_id}: {e}")
+            return False
+
+    @notifies_subscriptions('many')
+    async def deactivate_subscriptions(self, user_ids, outbox=None) -> int:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return 0
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                status = await conn.execute('''
+                UPDATE subscriptions SET is_active = 0
+                WHERE user_id = ANY($1::BIGINT[]) AND is_active = 1
+                ''', user_ids)
+                if outbox:
+                    await self._insert_outbox(conn, outbox)
+        self._invalidate(*[('subscription', user_id) for user_id in user_ids])
+        affected = _affected(status)
+        logging.info(f"Deactivated {affected} subscriptions for {len(user_ids)} users")
+        return affected
+
+    async def expire_subscriptions(self, subscriptions, now: int, outbox=None) -> list:
+        subscriptions = list(subscriptions)
+        if not subscriptions:
+            return []
+        outbox = outbox or {}
+        try:
+            pool = await self._pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    rows = await conn.fetch('''
+                    UPDATE subscriptions SET is_active = 0
+                    WHERE id = ANY($1::BIGINT[]) AND is_active = 1 AND expiration <= $2
+                    RETURNING id
+                    ''', [subscription_id for subscription_id, _ in subscriptions], now)
+                    expired = [row['id'] for row in rows]
+                    events = [event for subscription_id in expired for event in outbox.get(subscription_id, ())]
+                    if events:
+                        await self._insert_outbox(conn, events)
+            self._invalidate(*[('subscription', user_id) for _, user_id in subscriptions])
+        finally:
+            self._subscriptions_changed([user_id for _, user_id in subscriptions])
+        logging.info(f"Expired {len(expired)} of {len(subscriptions)} subscriptions")
+        return expired
+
+    @notifies_subscriptions('many')
+    async def extend_subscriptions(self, user_ids, days) -> int:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return 0
+        status = await self._execute('''
+        UPDATE subscriptions SET expiration = GREATEST(expiration, $1) + $2
+        WHERE user_id = ANY($3::BIGINT[]) AND is_active = 1
+        ''', int(time.time()), int(days * 86400), user_ids)
+        self._invalidate(*[('subscription', user_id) for user_id in user_ids])
+        affected = _affected(status)
+        logging.info(f"Extended {affected} subscriptions by {days} days")
+        return affected
+
+    async def get_subscription(self, user_id):
+        return await self._cached(('subscription', user_id), self._load_subscription, user_id)
+
+    async def _load_subscription(self, user_id):
+        row = await self._fetchrow(f'''
+        SELECT {_SUBSCRIPTION_COLUMNS} FROM subscriptions
+        WHERE user_id = $1 AND is_active = 1
+        ORDER BY created_at DESC LIMIT 1
+        ''', user_id)
+        return Subscription._make(row) if row else None
+
+    async def get_expired_subscriptions(self):
+        rows = await self._fetch(f'''
+        SELECT {_SUBSCRIPTION_COLUMNS} FROM subscriptions
+        WHERE expiration <= $1 AND is_active = 1
+        ORDER BY expiration DESC
+        ''', int(time.time()))
+        logging.info(f"Total expired subscriptions found: {len(rows)}")
+        return [Subscription._make(row) for row in rows]
+
+    async def get_active_subscriptions(self):
+        rows = await self._fetch(f'''
+        SELECT {_SUBSCRIPTION_COLUMNS} FROM subscriptions
+        WHERE is_active = 1 AND expiration > $1
+        ORDER BY expiration DESC
+        ''', int(time.time()))
+        logging.info(f"Total active subscriptions found: {len(rows)}")
+        return [Subscription._make(row) for row in rows]
+
+    async def _subscriptions_page(self, condition: str, now: int, after, limit: int):
+        after = after or (-1, -1)
+        rows = await self._fetch(f'''
+        SELECT {_SUBSCRIPTION_COLUMNS} FROM subscriptions
+        WHERE is_active = 1 AND {condition}
+          AND (expiration, id) > ($2, $3)
+        ORDER BY expiration, id
+        LIMIT $4
+        ''', now, after[0], after[1], limit)
+        return [Subscription._make(row) for row in rows]
+
+    async def get_expired_subscriptions_page(self, after=None, limit: int = 500, now: Optional[int] = None):
+        now = int(time.time()) if now is None else now
+        return await self._subscriptions_page('expiration <= $1', now, after, limit)
+
+    async def get_active_subscriptions_page(self, after=None, limit: int = 500, now: Optional[int] = None):
+        now = int(time.time()) if now is None else now
+        return await self._subscriptions_page('expiration > $1', now, after, limit)
+
+    async def get_warning_due_page(self, tier: str, window: int, floor: int = 0, after=None,
+                                   limit: int = 500, now: Optional[int] = None):
+        now = int(time.time()) if now is None else now
+        after = after or (-1, -1)
+        rows = await self._fetch('''
+        SELECT s.id, s.user_id, s.expiration, s.created_at, s.is_active
+        FROM subscriptions s
+        WHERE s.is_active = 1 AND s.expiration > $1 AND s.expiration <= $2
+          AND s.created_at < s.expiration - $3
+          AND (s.expiration, s.id) > ($4, $5)
+          AND NOT EXISTS (
+              SELECT 1 FROM notifications n
+              WHERE n.subscription_id = s.id AND n.notification_type = $6::TEXT || s.expiration::TEXT
+          )
+        ORDER BY s.expiration, s.id
+        LIMIT $7
+        ''', now + floor, now + window, window, after[0], after[1], warning_type(tier, ''), limit)
+        return [Subscription._make(row) for row in rows]
+
+    async def get_recent_subscriptions(self, limit: int = 5):
+        rows = await self._fetch('''
+        SELECT user_id, expiration, is_active FROM subscriptions
+        ORDER BY created_at DESC LIMIT $1
+        ''', limit)
+        return [(row[0], from_epoch(row[1]), row[2]) for row in rows]
+
+    # --- Конфигурации клиентов ---
+
+    async def save_client_config(self, user_id: int, client_data: Dict[str, str]):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                INSERT INTO client_configs (user_id, private_key, public_key, pre_shared_key, config_path, qr_path)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    private_key = EXCLUDED.private_key,
+                    public_key = EXCLUDED.public_key,
+                    pre_shared_key = EXCLUDED.pre_shared_key,
+                    config_path = EXCLUDED.config_path,
+                    qr_path = EXCLUDED.qr_path,
+                    created_at = EXCLUDED.created_at
+                ''', user_id, client_data.get('private_key'), client_data.get('public_key'),
+                    client_data.get('pre_shared_key'), client_data.get('config_path'), client_data.get('qr_path'))
+                # file_id прежних файлов больше не соответствуют конфигурации
+                await conn.execute("DELETE FROM file_ids WHERE user_id = $1", user_id)
+        self._invalidate(('config', user_id))
+        logging.info(f"Saved client config for user {user_id}")
+
+    async def get_client_config(self, user_id: int):
+        return await self._cached(('config', user_id), self._load_client_config, user_id)
+
+    async def _load_client_config(self, user_id: int):
+        row = await self._fetchrow('''
+        SELECT private_key, public_key, pre_shared_key, config_path, qr_path
+        FROM client_configs WHERE user_id = $1
+        ''', user_id)
+        return ClientConfig._make(row) if row else None
+
+    async def get_file_id(self, user_id: int, kind: str, content_hash: str) -> Optional[str]:
+        row = await self._fetchrow(
+            "SELECT file_id FROM file_ids WHERE user_id = $1 AND kind = $2 AND content_hash = $3",
+            user_id, kind, content_hash
+        )
+        return row[0] if row else None
+
+    async def save_file_id(self, user_id: int, kind: str, content_hash: str, file_id: str):
+        await self._execute('''
+        INSERT INTO file_ids (user_id, kind, content_hash, file_id, created_at)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id, kind) DO UPDATE SET
+            content_hash = EXCLUDED.content_hash,
+            file_id = EXCLUDED.file_id,
+            created_at = EXCLUDED.created_at
+        ''', user_id, kind, content_hash, file_id, time.time())
+
+    # --- Уведомления ---
+
+    async def add_notification(self, user_id, subscription_id, notification_type):
+        await self.claim_notification(user_id, subscription_id, notification_type)
+
+    async def add_notifications(self, rows) -> int:
+        return len(await self.claim_notifications(rows))
+
+    async def claim_notification(self, user_id, subscription_id, notification_type) -> bool:
+        status = await self._execute('''
+        INSERT INTO notifications (user_id, subscription_id, notification_type)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (subscription_id, notification_type) DO NOTHING
+        ''', user_id, subscription_id, notification_type)
+        return _affected(status) == 1
+
+    async def claim_notifications(self, rows) -> list:
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return []
+        user_ids, subscription_ids, types = (list(column) for column in zip(*rows))
+        claimed = await self._fetch('''
+        INSERT INTO notifications (user_id, subscription_id, notification_type)
+        SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TEXT[])
+        ON CONFLICT (subscription_id, notification_type) DO NOTHING
+        RETURNING user_id, subscription_id, notification_type
+        ''', user_ids, subscription_ids, types)
+        claimed_keys = {(row['subscription_id'], row['notification_type']) for row in claimed}
+        result = []
+        for row in rows:
+            # Повтор внутри одной пачки занят только первым вхождением
+            if (row[1], row[2]) in claimed_keys:
+                claimed_keys.discard((row[1], row[2]))
+                result.append(row)
+        return result
+
+    async def release_notification(self, subscription_id, notification_type):
+        await self._execute('''
+        DELETE FROM notifications WHERE subscription_id = $1 AND notification_type = $2
+        ''', subscription_id, notification_type)
+
+    async def filter_unnotified(self, subscription_ids, notification_type) -> set:
+        pending = set(subscription_ids)
+        if not pending:
+            return pending
+        rows = await self._fetch('''
+        SELECT subscription_id FROM notifications
+        WHERE notification_type = $1 AND subscription_id = ANY($2::BIGINT[])
+        ''', notification_type, list(pending))
+        return pending - {row[0] for row in rows}
+
+    async def prune_notifications(self, older_than_days: int) -> int:
+        status = await self._execute(
+            'DELETE FROM notifications WHERE created_at < $1',
+            int(time.time()) - int(older_than_days) * 86400
+        )
+        affected = _affected(status)
+        logging.info(f"Pruned {affected} notifications older than {older_than_days} days")
+        return affected
+
+    async def check_notification_sent(self, user_id, subscription_id, notification_type):
+        row = await self._fetchrow('''
+        SELECT 1 FROM notifications
+        WHERE subscription_id = $1 AND notification_type = $2 AND user_id = $3
+        ''', subscription_id, notification_type, user_id)
+        return row is not None
+
+    # --- Обслуживание ---
+
+    @notifies_subscriptions('all')
+    async def clear_all_data(self):
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                TRUNCATE subscriptions, payments, client_configs, file_ids, notifications, outbox, users,
+                    archive.payments, archive.subscriptions, archive.notifications
+                RESTART IDENTITY
+                ''')
+                # TRUNCATE не вызывает строковые триггеры
+                for name in migrations.COUNTERS:
+                    await conn.execute(migrations.counter_upsert_sql(name, update=True))
+        self._invalidate(_ALL_RECORDS)
+        logging.info("All data cleared successfully")
+
+    async def get_counters(self) -> Dict[str, int]:
+        return dict(await self._fetch('SELECT name, value FROM counters ORDER BY name'))
+
+    async def check_counters(self) -> Dict[str, tuple]:
+        rows = await self._fetch(migrations.counters_check_sql())
+        return {name: (stored, actual) for name, stored, actual in rows if stored != actual}
+
+    async def rebuild_counters(self) -> Dict[str, tuple]:
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # SHARE блокирует запись других реплик на время пересчета,
+                # иначе их триггеры изменят счетчик поверх устаревшего COUNT(*)
+                tables = sorted({table for table, _, _ in migrations.COUNTERS.values()})
+                await conn.execute(f"LOCK TABLE {', '.join(tables)} IN SHARE MODE")
+                rows = await conn.fetch(migrations.counters_check_sql())
+                for name in migrations.COUNTERS:
+                    await conn.execute(migrations.counter_upsert_sql(name, update=True))
+        mismatches = {name: (stored, actual) for name, stored, actual in rows if stored != actual}
+        if mismatches:
+            logging.warning(f"Rebuilt database counters: {mismatches}")
+        return mismatches
+
+    async def archive_batch(self, table: str, cutoff: int, batch_size: int = 500, after=None):
+        # Перенос атомарен (одна транзакция), поэтому продолжать с after не нужно:
+        # перенесенных строк в таблице уже нет. SKIP LOCKED не ждет строки,
+        # которые сейчас изменяет другая реплика.
+        key, columns, condition = ARCHIVE_TABLES[table]
+        row = await self._fetchrow(f'''
+        WITH batch AS (
+            SELECT {key} FROM {table} WHERE {condition}
+            ORDER BY {key} LIMIT $2 FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            DELETE FROM {table} t USING batch WHERE t.{key} = batch.{key}
+            RETURNING t.*
+        ), archived AS (
+            INSERT INTO archive.{table} ({columns}, archived_at)
+            SELECT {columns}, {_EPOCH_NOW} FROM moved
+            ON CONFLICT DO NOTHING
+        )
+        SELECT COUNT(*) FROM moved
+        ''', cutoff, batch_size)
+        return row[0], None
+
+    async def get_archive_stats(self) -> Dict[str, int]:
+        stats = {}
+        for table in ARCHIVE_TABLES:
+            row = await self._fetchrow(f'SELECT COUNT(*) FROM archive.{table}')
+            stats[table] = row[0]
+        return stats
+
+    async def get_job_runs(self) -> Dict[str, float]:
+        return dict(await self._fetch('SELECT name, last_run FROM job_runs'))
+
+    async def record_job_run(self, name: str, started_at: float, duration: float, error: Optional[str] = None):
+        await self._execute('''
+        INSERT INTO job_runs (name, last_run, duration, error) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (name) DO UPDATE SET
+            last_run = EXCLUDED.last_run, duration = EXCLUDED.duration, error = EXCLUDED.error
+        ''', name, started_at, duration, error)
+
+    # --- Outbox ---
+
+    @staticmethod
+    async def _insert_outbox(conn, events) -> int:
+        events = list(events)
+        now = time.time()
+        status = await conn.execute('''
+        INSERT INTO outbox (kind, dedup_key, payload, available_at, created_at)
+        SELECT kind, dedup_key, payload, $4, $4
+        FROM UNNEST($1::TEXT[], $2::TEXT[], $3::TEXT[]) AS e(kind, dedup_key, payload)
+        ON CONFLICT (dedup_key) DO NOTHING
+        ''', [e[0] for e in events], [e[1] for e in events], [json.dumps(e[2]) for e in events], now)
+        return _affected(status)
+
+    async def enqueue_outbox(self, events) -> int:
+        events = list(events)
+        if not events:
+            return 0
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            return await self._insert_outbox(conn, events)
+
+    async def claim_outbox(self, limit: int = 100, lease: float = 60.0):
+        now = time.time()
+        rows = await self._fetch('''
+        WITH due AS (
+            SELECT id FROM outbox
+            WHERE available_at <= $1 AND locked_until <= $1
+            ORDER BY available_at
+            LIMIT $2
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE outbox SET locked_until = $3
+        FROM due WHERE outbox.id = due.id
+        RETURNING outbox.id, outbox.kind, outbox.payload, outbox.attempts
+        ''', now, limit, now + lease)
+        return [OutboxEvent._make(row) for row in rows]
+
+    async def complete_outbox(self, event_ids) -> int:
+        status = await self._execute('DELETE FROM outbox WHERE id = ANY($1::BIGINT[])', list(event_ids))
+        return _affected(status)
+
+    async def retry_outbox(self, event_id: int, delay: Optional[float], error: str):
+        await self._execute('''
+        UPDATE outbox
+        SET attempts = attempts + 1, available_at = $1, locked_until = 0, last_error = $2
+        WHERE id = $3
+        ''', None if delay is None else time.time() + delay, error, event_id)
+
+    async def get_outbox_stats(self) -> Dict:
+        pending, dead, oldest = await self._fetchrow('''
+        SELECT
+            COUNT(available_at),
+            COUNT(*) - COUNT(available_at),
+            MIN(CASE WHEN available_at IS NOT NULL THEN created_at END)
+        FROM outbox
+        ''')
+        return {'pending': pending, 'dead': dead, 'oldest_age': time.time() - oldest if oldest else 0.0}
+
+    # --- Рассылки ---
+
+    @staticmethod
+    def _segment(segment: str, position: int, now: Optional[int]):
+        """Условие сегмента с параметром now под номером position и его аргументы"""
+        template = BROADCAST_SEGMENTS[segment]
+        if '{now}' not in template:
+            return template, ()
+        return template.format(now=f'${position}'), (int(time.time()) if now is None else now,)
+
+    async def count_broadcast_recipients(self, segment: str, now: Optional[int] = None) -> int:
+        condition, args = self._segment(segment, 1, now)
+        row = await self._fetchrow(f"SELECT COUNT(*) FROM users u WHERE {condition}", *args)
+        return row[0]
+
+    async def get_broadcast_recipients_page(self, segment: str, after: int = 0, limit: int = 500,
+                                            now: Optional[int] = None) -> list:
+        condition, args = self._segment(segment, 3, now)
+        rows = await self._fetch(f'''
+        SELECT u.user_id FROM users u
+        WHERE u.user_id > $1 AND {condition}
+        ORDER BY u.user_id
+        LIMIT $2
+        ''', after, limit, *args)
+        return [row[0] for row in rows]
+
+    async def create_broadcast(self, segment: str, text: str, total: int, chat_id=None, message_id=None) -> int:
+        if segment not in BROADCAST_SEGMENTS:
+            raise ValueError(f"Unknown broadcast segment {segment!r}")
+        now = time.time()
+        row = await self._fetchrow('''
+        INSERT INTO broadcasts (segment, text, total, chat_id, message_id, created_at, updated_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $6)
+        RETURNING id
+        ''', segment, text, total, chat_id, message_id, now)
+        return row[0]
+
+    _BROADCAST_COLUMNS = 'id, segment, text, status, cursor, total, sent, failed, chat_id, message_id'
+
+    async def get_broadcast(self, broadcast_id: int):
+        row = await self._fetchrow(
+            f"SELECT {self._BROADCAST_COLUMNS} FROM broadcasts WHERE id = $1", broadcast_id
+        )
+        return Broadcast._make(row) if row else None
+
+    async def get_running_broadcasts(self) -> list:
+        rows = await self._fetch(
+            f"SELECT {self._BROADCAST_COLUMNS} FROM broadcasts WHERE status = 'running' ORDER BY id"
+        )
+        return [Broadcast._make(row) for row in rows]
+
+    async def update_broadcast(self, broadcast_id: int, cursor: int, sent: int, failed: int,
+                               status: Optional[str] = None) -> Optional[str]:
+        row = await self._fetchrow('''
+        UPDATE broadcasts
+        SET cursor = $1, sent = $2, failed = $3, updated_at = $4,
+            status = CASE WHEN status = 'running' THEN COALESCE($5, status) ELSE status END
+        WHERE id = $6
+        RETURNING status
+        ''', cursor, sent, failed, time.time(), status, broadcast_id)
+        return row[0] if row else None
+
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        status = await self._execute(
+            "UPDATE broadcasts SET status = 'cancelled', updated_at = $1 WHERE id = $2 AND status = 'running'",
+            time.time(), broadcast_id
+        )
+        return _affected(status) == 1
+
+    # Сроки аренды считаются по часам сервера базы, общим для всех реплик
+
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        row = await self._fetchrow('''
+        INSERT INTO leases (name, holder, token, expires_at)
+        VALUES ($1, $2, 1, EXTRACT(EPOCH FROM clock_timestamp()) + $3)
+        ON CONFLICT (name) DO UPDATE SET
+            token = CASE WHEN leases.holder = EXCLUDED.holder THEN leases.token ELSE leases.token + 1 END,
+            holder = EXCLUDED.holder,
+            expires_at = EXCLUDED.expires_at
+        WHERE leases.holder = EXCLUDED.holder OR leases.expires_at <= EXTRACT(EPOCH FROM clock_timestamp())
+        RETURNING token
+        ''', name, holder, ttl)
+        return row[0] if row else None
+
+    async def release_lease(self, name: str, holder: str):
+        await self._execute(
+            'UPDATE leases SET expires_at = 0 WHERE name = $1 AND holder = $2', name, holder
+        )
+
+    async def check_lease(self, name: str, holder: str, token: int) -> bool:
+        return await self._fetchrow('''
+        SELECT TRUE FROM leases
+        WHERE name = $1 AND holder = $2 AND token = $3
+          AND expires_at > EXTRACT(EPOCH FROM clock_timestamp())
+        ''', name, holder, token) is not None
+
+    async def optimize(self, analyze: bool = False):
+        await self._execute('ANALYZE')
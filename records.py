@@ -0,0 +1,172 @@
+import json
+from datetime import datetime
+from typing import Optional
+
+def to_epoch(value) -> Optional[int]:
+    """Перевод datetime (локальное время), строки 'YYYY-MM-DD HH:MM:SS' или числа в UTC epoch секунды"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.strptime(value.split('.')[0], '%Y-%m-%d %H:%M:%S')
+    return int(value.timestamp())
+
+def from_epoch(value) -> Optional[datetime]:
+    """Перевод UTC epoch секунд в локальный datetime"""
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value)
+
+_new = object.__new__
+
+class Record:
+    """Неизменяемая запись с __slots__ вместо словаря на каждую строку.
+
+    __slots__ - колонки в порядке SELECT, _fields - публичные имена полей
+    в том же порядке (время хранится epoch числом, а поле с datetime
+    вычисляется при обращении). Для совместимости со старым кодом запись
+    распаковывается как кортеж и поддерживает record['field'] и record[i].
+    Записи можно без копирования держать в общем кэше.
+    """
+
+    __slots__ = ()
+    _fields = ()
+    _setters = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._setters = tuple(cls.__dict__[name].__set__ for name in cls.__slots__)
+        # Как namedtuple, генерируем развернутые конструкторы под набор полей:
+        # это заметно быстрее цикла по сеттерам и сопоставимо с dict(zip(...))
+        values = ', '.join(f'v{i}' for i in range(len(cls.__slots__)))
+        body = ''.join(f'    s{i}(record, v{i})\n' for i in range(len(cls.__slots__)))
+        namespace = {'new': _new, 'cls': cls}
+        namespace.update((f's{i}', setter) for i, setter in enumerate(cls._setters))
+        for signature in ('_make(row)', 'row_factory(cursor, row)'):
+            exec(f'def {signature}:\n    {values}, = row\n    record = new(cls)\n{body}    return record\n',
+                 namespace)
+        cls._make = staticmethod(namespace['_make'])
+        cls.row_factory = staticmethod(namespace['row_factory'])
+
+    def __init__(self, *values):
+        if len(values) != len(self.__slots__):
+            raise TypeError(f"{type(self).__name__} expects {len(self.__slots__)} values, got {len(values)}")
+        for setter, value in zip(self._setters, values):
+            setter(self, value)
+
+    @classmethod
+    def _make(cls, row):
+        """Создание записи из строки результата без проверок"""
+        record = _new(cls)
+        for setter, value in zip(cls._setters, row):
+            setter(record, value)
+        return record
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        """row_factory для sqlite3: cursor.row_factory = Subscription.row_factory"""
+        return cls._make(row)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in self._fields:
+                raise KeyError(key)
+            return getattr(self, key)
+        if isinstance(key, slice):
+            return tuple(self)[key]
+        return getattr(self, self._fields[key])
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def _raw(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._raw() == other._raw()
+
+    def __hash__(self):
+        return hash(self._raw())
+
+    def __reduce__(self):
+        return (type(self), self._raw())
+
+    def _asdict(self) -> dict:
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __repr__(self):
+        values = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({values})"
+
+class Subscription(Record):
+    """Подписка: id, user_id, expiration, created_at, is_active"""
+
+    __slots__ = ('id', 'user_id', 'expiration_ts', 'created_ts', 'is_active')
+    _fields = ('id', 'user_id', 'expiration', 'created_at', 'is_active')
+
+    @property
+    def expiration(self) -> Optional[datetime]:
+        return from_epoch(self.expiration_ts)
+
+    @property
+    def created_at(self) -> Optional[datetime]:
+        return from_epoch(self.created_ts)
+
+    @property
+    def key(self):
+        """Ключ keyset пагинации (expiration, id)"""
+        return (self.expiration_ts, self.id)
+
+class Payment(Record):
+    """Платеж: payment_id, user_id, amount, duration_months, status, created_at"""
+
+    __slots__ = ('payment_id', 'user_id', 'amount', 'duration_months', 'status', 'created_ts')
+    _fields = ('payment_id', 'user_id', 'amount', 'duration_months', 'status', 'created_at')
+
+    @property
+    def created_at(self) -> Optional[datetime]:
+        return from_epoch(self.created_ts)
+
+class User(Record):
+    """Пользователь: user_id, username, created_at"""
+
+    __slots__ = ('user_id', 'username', 'created_ts')
+    _fields = ('user_id', 'username', 'created_at')
+
+    @property
+    def created_at(self) -> Optional[datetime]:
+        return from_epoch(self.created_ts)
+
+class OutboxEvent(Record):
+    """Событие outbox: id, kind, payload (словарь из JSON), attempts"""
+
+    __slots__ = ('id', 'kind', 'payload_json', 'attempts')
+    _fields = ('id', 'kind', 'payload', 'attempts')
+
+    @property
+    def payload(self) -> dict:
+        return json.loads(self.payload_json)
+
+class Broadcast(Record):
+    """Рассылка: id, segment, text, status, cursor, total, sent, failed, chat_id, message_id"""
+
+    __slots__ = ('id', 'segment', 'text', 'status', 'cursor', 'total', 'sent', 'failed', 'chat_id', 'message_id')
+    _fields = __slots__
+
+class ClientConfig(Record):
+    """Конфигурация клиента WireGuard"""
+
+    __slots__ = ('private_key', 'public_key', 'pre_shared_key', 'config_path', 'qr_path')
+    _fields = __slots__
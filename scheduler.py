@@ -1,138 +1,336 @@
 import asyncio
 import logging
-from datetime import datetime, timedelta, time
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from storage import Storage
+
+class IntervalTrigger:
+    """Запуск каждые seconds секунд"""
+
+    dynamic = False
+
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError("Interval must be positive")
+        self.seconds = seconds
+
+    def next_after(self, ts: float) -> float:
+        return ts + self.seconds
+
+    def __repr__(self):
+        return f"every {self.seconds:g}s"
+
+class CronTrigger:
+    """Запуск по расписанию cron: 'минута час день месяц день_недели' (локальное время)
+
+    Поддерживаются *, числа, диапазоны a-b, шаг */n или a-b/n и списки через
+    запятую. День недели 0-6 (0 и 7 - воскресенье). Если ограничены и день
+    месяца, и день недели, достаточно совпадения одного из них, как в cron.
+    """
+
+    dynamic = False
+
+    _FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+        self.expression = expression
+        values = [self._parse(part, low, high) for part, (_, low, high) in zip(parts, self._FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        self._any_day = parts[2] == '*'
+        self._any_weekday = parts[4] == '*'
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> frozenset:
+        values = set()
+        for item in field.split(','):
+            item, _, step = item.partition('/')
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start, end = (int(value) for value in item.split('-', 1))
+            else:
+                start = int(item)
+                end = high if step else start
+            step = int(step) if step else 1
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron field {field!r}")
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, ts: float) -> float:
+        moment = datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Несовпадающие месяцы, дни и часы пропускаются целиком, поэтому цикл короткий
+        for _ in range(100000):
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        raise ValueError(f"Cron expression never fires: {self.expression!r}")
+
+    def __repr__(self):
+        return f"cron '{self.expression}'"
+
+class DynamicTrigger:
+    """Время следующего запуска сообщает сама задача: func(now) -> epoch
+
+    Пока задача выполняется, следующий запуск не планируется; после
+    завершения (или Scheduler.wake()) время пересчитывается.
+    """
+
+    dynamic = True
+
+    def __init__(self, func: Callable[[float], float]):
+        self.func = func
+
+    def next_after(self, ts: float) -> float:
+        return self.func(ts)
+
+    def __repr__(self):
+        return "dynamic"
+
+class Job:
+    """Задача планировщика с метриками выполнения"""
+
+    def __init__(self, name: str, func: Callable[[], Awaitable], trigger, jitter: float = 0.0,
+                 catch_up: bool = True):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.jitter = jitter
+        self.catch_up = catch_up
+        self.next_run: Optional[float] = None
+        self.last_run: Optional[float] = None
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.max_duration = 0.0
+        self.max_lateness = 0.0
+        self.last_error: Optional[str] = None
+
+    def schedule_next(self, now: float):
+        """Следующий запуск по триггеру со случайным сдвигом до jitter секунд"""
+        self.next_run = self.trigger.next_after(now) + (random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def stats(self) -> Dict:
+        return {
+            'trigger': repr(self.trigger),
+            'running': self.running,
+            'next_run': self.next_run,
+            'last_run': self.last_run,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'avg_duration': self.total_duration / self.runs if self.runs else 0.0,
+            'max_duration': self.max_duration,
+            'max_lateness': self.max_lateness,
+            'last_error': self.last_error,
+        }
 
 class Scheduler:
-    def __init__(self, bot, database, wg_api, job_queue):
-        self.bot = bot
-        self.db = database
-        self.wg_api = wg_api
-        self.job_queue = job_queue
-        self.notification_days = [7, 3, 1]  # За сколько дней уведомлять
-        self.notification_sent = {}  # Для отслеживания отправленных уведомлений
-        self.last_check = None
-
-    def start(self):
-        """Запуск планировщика"""
-        logging.info("Starting scheduler...")
-        
-        # Проверка подписок каждый час
-        self.job_queue.run_repeating(
-            self.check_subscriptions,
-            interval=3600,  # каждый час
-            first=0  # запустить сразу
-        )
-        logging.info("Scheduled hourly subscription check")
-        
-        logging.info("Scheduler started successfully")
-
-    async def check_subscriptions(self, context):
-        """Проверка подписок и отправка уведомлений"""
-        current_time = datetime.now()
-        
-        # Пропускаем проверку если прошло меньше часа с последней проверки
-        if self.last_check and (current_time - self.last_check).total_seconds() < 3600:
-            logging.info("Пропускаем проверку - прошло меньше часа с последней проверки")
-            return
-            
-        self.last_check = current_time
-        logging.info(f"=== Новый цикл проверки подписок: {current_time} ===")
-        
+    """Планировщик фоновых задач бота на asyncio.
+
+    Задача-диспетчер спит до ближайшего запуска и стартует задачи отдельными
+    asyncio задачами, поэтому долгая задача не задерживает остальные. Задача
+    не запускается повторно, пока не завершился предыдущий запуск (пропуск
+    учитывается в skipped). Время последних запусков хранится в базе
+    (job_runs): после перезапуска бота задача с catch_up, пропустившая срок,
+    выполняется один раз сразу, а не ждет следующего.
+
+    С leader (LeaderElector) задачи по расписанию выполняет только лидер:
+    перед каждым запуском проверяется fencing-токен, при потере лидерства
+    выполняющиеся задачи отменяются. Новый лидер перечитывает job_runs и
+    догоняет запуски, пропущенные за время смены.
+    """
+
+    def __init__(self, db: Optional[Storage] = None, leader=None):
+        self.db = db
+        self.leader = leader
+        self.jobs: Dict[str, Job] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self._history: Optional[Dict[str, float]] = None
+        if leader is not None:
+            leader.add_listener(self._leadership_changed)
+
+    def add_job(self, name: str, func: Callable[[], Awaitable], trigger, jitter: float = 0.0,
+                catch_up: bool = True) -> Job:
+        """Регистрация задачи; имя уникально"""
+        if name in self.jobs:
+            raise ValueError(f"Job {name!r} is already registered")
+        job = Job(name, func, trigger, jitter, catch_up)
+        self.jobs[name] = job
+        self.wake()
+        return job
+
+    def remove_job(self, name: str):
+        self.jobs.pop(name, None)
+        self.wake()
+
+    def wake(self):
+        """Пересчитать время запусков (например, изменился срок DynamicTrigger)"""
+        self._wakeup.set()
+
+    def _leading(self) -> bool:
+        return self.leader is None or self.leader.is_leader
+
+    def _leadership_changed(self, leading: bool):
+        if leading:
+            # История могла измениться, пока задачи выполняла другая реплика
+            self._history = None
+            for job in self.jobs.values():
+                job.next_run = None
+                job.last_run = None
+        else:
+            for task in list(self._tasks):
+                task.cancel()
+        self.wake()
+
+    async def _load_history(self):
         try:
-            # Сначала проверяем истекшие подписки
-            expired_subscriptions = self.db.get_expired_subscriptions()
-            logging.info(f"Checking expired subscriptions: {expired_subscriptions}")
-            
-            if expired_subscriptions:
-                for sub in expired_subscriptions:
-                    try:
-                        user_id = sub.get('user_id')
-                        config_name = sub.get('config_name')
-                        is_active = sub.get('is_active')
-                        subscription_id = sub.get('id')
-                        
-                        if not all([user_id, config_name, is_active is not None, subscription_id]):
-                            logging.error(f"Missing required fields in subscription: {sub}")
-                            continue
-                            
-                        logging.info(f"Processing expired subscription: user_id={user_id}, config_name={config_name}, is_active={is_active}")
-                        
-                        # Проверяем, не отправляли ли уже уведомление об истечении
-                        notification_key = f"expired_{subscription_id}"
-                        if notification_key not in self.notification_sent and is_active == 1:
-                            # Отключаем пользователя
-                            if await self.wg_api.disable_client(config_name):
-                                logging.info(f"Disabled client {config_name}")
-                                
-                                # Отправляем уведомление об истечении
-                                await self.bot.send_message(
-                                    chat_id=user_id,
-                                    text="❌ Ваша подписка VPN истекла!\n\n"
-                                         "Для продолжения использования сервиса необходимо продлить подписку."
-                                )
-                                
-                                # Отмечаем что уведомление отправлено
-                                self.notification_sent[notification_key] = True
-                                logging.info(f"Sent expiration notification to user {user_id}")
-                                
-                                # Деактивируем подписку в базе
-                                self.db.deactivate_subscription(user_id)
-                                logging.info(f"Deactivated subscription for user {user_id}")
-                    
-                    except Exception as e:
-                        logging.error(f"Error processing expired subscription for user {user_id if 'user_id' in locals() else 'unknown'}: {e}")
-                        continue
-            
-            # Затем проверяем активные подписки на скорое истечение
-            active_subscriptions = self.db.get_active_subscriptions()
-            logging.info(f"Found {len(active_subscriptions)} active subscriptions")
-            
-            for sub in active_subscriptions:
-                try:
-                    user_id = sub.get('user_id')
-                    expiration = sub.get('expiration')
-                    subscription_id = sub.get('id')
-                    
-                    if not all([user_id, expiration, subscription_id]):
-                        logging.error(f"Missing required fields in active subscription: {sub}")
-                        continue
-                    
-                    # Обрезаем микросекунды и преобразуем в datetime
-                    expiration = datetime.strptime(str(expiration).split('.')[0], '%Y-%m-%d %H:%M:%S')
-                    time_left = expiration - current_time
-                    hours_left = time_left.total_seconds() / 3600
-                    
-                    # Проверяем, находится ли время до истечения в диапазоне 23-24 часов
-                    # и не было ли уже отправлено уведомление
-                    notification_key = f"24h_warning_{subscription_id}"
-                    if 23 <= hours_left <= 24 and notification_key not in self.notification_sent:
-                        await self.send_warning(user_id)
-                        self.notification_sent[notification_key] = True
-                        logging.info(f"Sent 24h warning to user {user_id}")
-                
-                except Exception as e:
-                    logging.error(f"Error processing active subscription for user {user_id if 'user_id' in locals() else 'unknown'}: {e}")
-                    continue
-                    
+            self._history = await self.db.get_job_runs()
         except Exception as e:
-            logging.error(f"Error in check_subscriptions: {e}")
+            logging.warning(f"Failed to load job history: {e}")
+            self._history = {}
+
+    def _first_run(self, job: Job, now: float):
+        if job.last_run is None and self._history:
+            job.last_run = self._history.get(job.name)
+        due = job.trigger.next_after(job.last_run) if job.last_run is not None else now
+        if due > now:
+            # Срок по истории еще не наступил
+            job.next_run = due
+        elif job.catch_up:
+            # Пропущенные запуски догоняем одним запуском сразу
+            job.next_run = now
+        else:
+            job.schedule_next(now)
 
-    async def send_warning(self, user_id: int):
-        """Отправка предупреждения пользователю"""
+    async def _execute(self, job: Job, scheduled: float, fenced: bool = False) -> bool:
+        """Выполнение задачи; False - пропущена (реплика не лидер)
+
+        job.running выставляет вызывающий до создания задачи: пока идет
+        проверка аренды, wake() не должен запустить задачу повторно.
+        """
+        if fenced and self.leader is not None:
+            try:
+                confirmed = await self.leader.confirm()
+            except BaseException:
+                job.running = False
+                raise
+            if not confirmed:
+                job.running = False
+                job.skipped += 1
+                logging.warning(f"Job {job.name} skipped: not the leader")
+                return False
+        started = time.time()
+        job.max_lateness = max(job.max_lateness, started - scheduled)
+        error = None
         try:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Продлить подписку", callback_data="extend_subscription")]
-            ])
-            
-            await self.bot.send_message(
-                chat_id=user_id,
-                text="⚠️ Внимание! Ваша подписка VPN истекает через 24 часа!\n\n"
-                     "Рекомендуем продлить подписку заранее, чтобы избежать отключения.",
-                reply_markup=keyboard
-            )
-            
-            logging.info(f"Sent warning to user {user_id}")
-            
+            await job.func()
         except Exception as e:
-            logging.error(f"Error sending warning to user {user_id}: {e}")
+            error = str(e) or type(e).__name__
+            job.failures += 1
+            logging.error(f"Job {job.name} failed: {e}", exc_info=True)
+        finally:
+            duration = time.time() - started
+            job.running = False
+            job.runs += 1
+            job.last_run = started
+            job.last_duration = duration
+            job.total_duration += duration
+            job.max_duration = max(job.max_duration, duration)
+            job.last_error = error
+            self.wake()
+        if self.db is not None:
+            try:
+                await self.db.record_job_run(job.name, started, duration, error)
+            except Exception as e:
+                logging.warning(f"Failed to record run of job {job.name}: {e}")
+        return True
+
+    def _launch(self, job: Job, scheduled: float):
+        job.running = True
+        task = asyncio.create_task(self._execute(job, scheduled, fenced=True), name=f"job:{job.name}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        # Задача, отмененная до первого шага, не дойдет до finally в _execute
+        task.add_done_callback(lambda _: setattr(job, 'running', False))
+
+    async def run_job(self, name: str):
+        """Внеочередной запуск задачи (если она сейчас не выполняется и реплика - лидер)"""
+        job = self.jobs[name]
+        if job.running:
+            raise RuntimeError(f"Job {name} is already running")
+        job.running = True
+        if not await self._execute(job, time.time(), fenced=True):
+            raise RuntimeError(f"Job {name} not run: this replica is not the leader")
+
+    def _dispatch(self, now: float) -> Optional[float]:
+        """Запуск подошедших задач; возвращает время ближайшего запуска"""
+        if not self._leading():
+            # Реплика не лидер: ждем смены роли
+            return None
+        for job in list(self.jobs.values()):
+            if job.trigger.dynamic:
+                job.next_run = None if job.running else job.trigger.next_after(now)
+            elif job.next_run is None:
+                self._first_run(job, now)
+            if job.next_run is None or job.next_run > now:
+                continue
+            if job.running:
+                job.skipped += 1
+                logging.warning(f"Job {job.name} is still running, skipping run")
+            else:
+                self._launch(job, job.next_run)
+            if job.trigger.dynamic:
+                job.next_run = None
+            else:
+                job.schedule_next(now)
+        pending = [job.next_run for job in self.jobs.values() if job.next_run is not None]
+        return min(pending) if pending else None
+
+    async def run(self):
+        """Задача-диспетчер; при отмене отменяет и выполняющиеся задачи"""
+        logging.info(f"Scheduler started with jobs: {', '.join(self.jobs)}")
+        try:
+            while True:
+                if self.db is not None and self._history is None and self._leading():
+                    await self._load_history()
+                next_run = self._dispatch(time.time())
+                self._wakeup.clear()
+                timeout = None if next_run is None else max(0.0, next_run - time.time())
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+
+    def stats(self) -> Dict[str, Dict]:
+        """Метрики всех задач"""
+        return {name: job.stats() for name, job in self.jobs.items()}
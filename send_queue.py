@@ -0,0 +1,251 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+# Полосы приоритета: меньше - раньше
+PRIORITY_CRITICAL = 0  # платежи, выдача конфигурации - пользователь ждет ответа
+PRIORITY_NORMAL = 1    # уведомления об истечении и предупреждения
+PRIORITY_BULK = 2      # рассылки
+
+PRIORITY_NAMES = {PRIORITY_CRITICAL: 'critical', PRIORITY_NORMAL: 'normal', PRIORITY_BULK: 'bulk'}
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 - токен есть)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class _Message:
+    __slots__ = ('priority', 'chat_id', 'method', 'args', 'kwargs', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, priority, chat_id, method, args, kwargs, future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+class SendQueue:
+    """Единая очередь исходящих сообщений Telegram с учетом лимитов.
+
+    Отправку ограничивают общее ведро токенов (global_rate сообщений в
+    секунду) и ведро на каждый чат (per_chat_rate). Сообщения лежат в полосах
+    приоритета, внутри полосы - в куче по (готовность, порядок): следующим
+    уходит самое приоритетное из тех, чей чат уже может принять сообщение,
+    поэтому подтверждение платежа обгоняет рассылку, а медленный чат не
+    задерживает остальные.
+    Порядок сообщений одного чата с одним приоритетом сохраняется.
+
+    TelegramRetryAfter приостанавливает всю отправку на указанное время,
+    сообщение возвращается в очередь (до max_retries раз). Прочие ошибки
+    передаются вызывающему.
+
+    send_message/send_photo/send_document повторяют сигнатуры Bot и
+    дожидаются результата отправки; priority задает полосу.
+    """
+
+    def __init__(self, bot, global_rate: float = 30.0, per_chat_rate: float = 1.0,
+                 per_chat_burst: float = 1.0, max_in_flight: int = 30, max_retries: int = 5):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._lanes = {priority: [] for priority in PRIORITY_NAMES}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._tasks = set()
+        self._paused_until = 0.0
+        self._recent = deque()
+        self.depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self.sent = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.max_wait = 0.0
+
+    # --- Постановка в очередь ---
+
+    def submit(self, method: str, chat_id: int, *args, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+        """Поставить вызов bot.<method>(chat_id, ...) в очередь; future с результатом
+
+        Без позиционных аргументов chat_id передается по имени - так можно
+        ставить и методы, где он не первый (edit_message_text).
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._push(_Message(priority, chat_id, method, args, kwargs, future), time.monotonic())
+        self.depth[priority] += 1
+        return future
+
+    async def send_message(self, chat_id: int, text: str, *, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.submit('send_message', chat_id, text, priority=priority, **kwargs)
+
+    async def send_photo(self, chat_id: int, photo, *, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.submit('send_photo', chat_id, photo, priority=priority, **kwargs)
+
+    async def send_document(self, chat_id: int, document, *, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.submit('send_document', chat_id, document, priority=priority, **kwargs)
+
+    def _push(self, message: _Message, ready: float):
+        heapq.heappush(self._lanes[message.priority], (ready, next(self._seq), message))
+        self._wakeup.set()
+
+    # --- Отправка ---
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Полные ведра ничего не ограничивают - их можно забыть
+                self._chats = {key: value for key, value in self._chats.items() if not value.is_full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst, now)
+        return bucket
+
+    def _next_message(self, now: float):
+        """Самое приоритетное готовое сообщение или время, когда появится готовое
+
+        Сообщение, чат которого еще не готов, переставляется в своей полосе
+        на время готовности чата.
+        """
+        for lane in self._lanes.values():
+            while lane and lane[0][0] <= now:
+                ready, seq, message = lane[0]
+                if message.future.cancelled():
+                    # Вызывающий больше не ждет
+                    heapq.heappop(lane)
+                    self.depth[message.priority] -= 1
+                    continue
+                wait = self._chat_bucket(message.chat_id, now).wait_time(now)
+                if wait == 0:
+                    heapq.heappop(lane)
+                    return message, None
+                heapq.heapreplace(lane, (now + wait, seq, message))
+        pending = [lane[0][0] for lane in self._lanes.values() if lane]
+        return None, min(pending) if pending else None
+
+    async def _deliver(self, message: _Message):
+        try:
+            method = getattr(self.bot, message.method)
+            if message.args:
+                result = await method(message.chat_id, *message.args, **message.kwargs)
+            else:
+                result = await method(chat_id=message.chat_id, **message.kwargs)
+        except TelegramRetryAfter as e:
+            self.retry_after += 1
+            message.attempts += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logging.warning(f"Telegram flood control: pausing sends for {e.retry_after}s")
+            if message.attempts <= self.max_retries:
+                self._push(message, self._paused_until)
+                return
+            self._finish(message, error=e)
+        except Exception as e:
+            self._finish(message, error=e)
+        else:
+            self._finish(message, result=result)
+        finally:
+            self._in_flight.release()
+
+    def _finish(self, message: _Message, result=None, error: Optional[BaseException] = None):
+        self.depth[message.priority] -= 1
+        if error is None:
+            now = time.monotonic()
+            self.sent += 1
+            self._recent.append(now)
+            while self._recent[0] < now - 60:
+                self._recent.popleft()
+            self.max_wait = max(self.max_wait, now - message.enqueued)
+        else:
+            self.failed += 1
+        if message.future.done():
+            return
+        if error is None:
+            message.future.set_result(result)
+        else:
+            message.future.set_exception(error)
+
+    async def run(self):
+        """Задача-диспетчер; при отмене незавершенные сообщения получают CancelledError"""
+        logging.info(f"Send queue started: {self.global_rate:g} msg/s, {self.per_chat_rate:g} msg/s per chat")
+        try:
+            while True:
+                now = time.monotonic()
+                timeout = None
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                else:
+                    wait = self._global.wait_time(now)
+                    if wait:
+                        timeout = wait
+                    else:
+                        message, ready = self._next_message(now)
+                        if message is not None:
+                            await self._in_flight.acquire()
+                            self._global.take(time.monotonic())
+                            self._chat_bucket(message.chat_id, now).take(now)
+                            task = asyncio.create_task(self._deliver(message))
+                            self._tasks.add(task)
+                            task.add_done_callback(self._tasks.discard)
+                            continue
+                        if ready is not None:
+                            timeout = ready - now
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in list(self._tasks):
+                task.cancel()
+            for lane in self._lanes.values():
+                for *_, message in lane:
+                    message.future.cancel()
+                lane.clear()
+
+    def stats(self) -> Dict:
+        """Метрики: доставлено/ошибки, отправок за последнюю минуту, глубина полос"""
+        now = time.monotonic()
+        while self._recent and self._recent[0] < now - 60:
+            self._recent.popleft()
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_after': self.retry_after,
+            'per_second': len(self._recent) / 60,
+            'max_wait': self.max_wait,
+            'paused_for': max(0.0, self._paused_until - now),
+            'depth': {PRIORITY_NAMES[priority]: depth for priority, depth in self.depth.items()},
+        }
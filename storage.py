@@ -0,0 +1,442 @@
+import functools
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+# Таблицы, холодные строки которых переносятся в архив (в порядке обхода)
+ARCHIVE_TABLES = ('payments', 'subscriptions', 'notifications')
+
+# Статусы оплаченного платежа
+PAID_STATUSES = ('confirmed', 'completed')
+
+# Сегменты рассылки: условие на строку users u; {now} - параметр текущего
+# времени в синтаксисе конкретной базы
+BROADCAST_SEGMENTS = {
+    'all': "TRUE",
+    'active': "EXISTS (SELECT 1 FROM subscriptions s "
+              "WHERE s.user_id = u.user_id AND s.is_active = 1 AND s.expiration > {now})",
+    'expired': "EXISTS (SELECT 1 FROM all_subscriptions s WHERE s.user_id = u.user_id) "
+               "AND NOT EXISTS (SELECT 1 FROM subscriptions s "
+               "WHERE s.user_id = u.user_id AND s.is_active = 1 AND s.expiration > {now})",
+    'never_paid': "NOT EXISTS (SELECT 1 FROM all_payments p WHERE p.user_id = u.user_id "
+                  f"AND p.status IN ({', '.join(repr(status) for status in PAID_STATUSES)}))",
+}
+
+def warning_type(tier: str, expiration) -> str:
+    """Тип записи журнала для предупреждения уровня tier ('7d', '24h', ...)
+
+    Срок входит в тип, поэтому после продления предупреждения придут снова.
+    """
+    return f"{tier}_warning:{expiration}"
+
+def notifies_subscriptions(scope: str):
+    """Оповещение слушателей подписок после записи
+
+    scope: 'one' - первый аргумент user_id, 'many' - итерируемое user_id
+    (материализуется в список до вызова), 'all' - изменились все подписки.
+    Слушатели вызываются и при ошибке записи: перечитать лишнее безопасно.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if scope == 'many':
+                args = (list(args[0]), *args[1:])
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                self._subscriptions_changed(
+                    None if scope == 'all' else args[0] if scope == 'many' else [args[0]]
+                )
+        return wrapper
+    return decorator
+
+class Storage(ABC):
+    """Асинхронный интерфейс хранилища бота.
+
+    Повторяет публичные методы Database с теми же аргументами и формой
+    результатов: записи из records.py (Subscription, Payment, User,
+    ClientConfig), ключ keyset пагинации - row.key.
+    Реализации: AsyncDatabase (SQLite, по умолчанию) и PostgresStorage
+    (PostgreSQL через asyncpg, общее состояние для нескольких реплик бота).
+    """
+
+    _subscription_listeners = ()
+
+    async def connect(self):
+        """Подготовка соединений и схемы; вызывается до первого запроса"""
+
+    def add_subscription_listener(self, callback):
+        """callback(user_ids) после записи подписок этим процессом (None - всех)"""
+        self._subscription_listeners = (*self._subscription_listeners, callback)
+
+    def _subscriptions_changed(self, user_ids):
+        for callback in self._subscription_listeners:
+            try:
+                callback(user_ids)
+            except Exception as e:
+                logging.error(f"Subscription listener failed: {e}")
+
+    @abstractmethod
+    async def close(self):
+        """Закрытие всех соединений"""
+
+    @abstractmethod
+    def cache_stats(self) -> Dict:
+        """Метрики кэша записей (см. LRUCache.stats)"""
+
+    # --- Пользователи ---
+
+    @abstractmethod
+    async def add_user(self, user_id, username=None):
+        """Добавление или замена пользователя"""
+
+    @abstractmethod
+    async def get_user(self, user_id):
+        """Запись User или None"""
+
+    # --- Платежи ---
+
+    @abstractmethod
+    async def create_payment(self, user_id, amount, status, duration_months=None, payment_method=None, screenshot_file_id=None):
+        """Создание платежа с payment_id = str(user_id)"""
+
+    @abstractmethod
+    async def verify_payment(self, payment_id, status):
+        """Подтверждение или отклонение платежа"""
+
+    @abstractmethod
+    async def add_payment(self, payment_id: str, user_id: int, amount: float, duration: int, status: str = 'pending'):
+        """Добавление платежа; True при успехе"""
+
+    @abstractmethod
+    async def update_payment_status(self, payment_id: str, status: str):
+        """Обновление статуса платежа"""
+
+    @abstractmethod
+    async def get_payment(self, payment_id: str):
+        """Запись Payment или None"""
+
+    @abstractmethod
+    async def get_user_payments(self, user_id):
+        """Платежи пользователя, новые первыми"""
+
+    # --- Подписки ---
+
+    @abstractmethod
+    async def add_subscription(self, user_id, duration_days):
+        """Новая подписка или продление активной на duration_days дней"""
+
+    @abstractmethod
+    async def create_subscription(self, user_id: int, expiration):
+        """Замена активных подписок пользователя новой до expiration"""
+
+    @abstractmethod
+    async def deactivate_subscription(self, user_id: int) -> bool:
+        """Деактивация подписки пользователя"""
+
+    @abstractmethod
+    async def deactivate_subscriptions(self, user_ids, outbox=None) -> int:
+        """Деактивация подписок нескольких пользователей; число строк
+
+        outbox - события (kind, dedup_key, payload), записываемые в той же транзакции.
+        """
+
+    @abstractmethod
+    async def expire_subscriptions(self, subscriptions, now: int, outbox=None) -> list:
+        """Деактивация истекших подписок по id; список деактивированных id
+
+        subscriptions - пары (id, user_id). Строка деактивируется, только если
+        она еще активна и ее срок не позже now: подписку, продленную после
+        чтения страницы, оставляем. outbox - {id подписки: [(kind, dedup_key,
+        payload)]}; события пишутся в той же транзакции и только для
+        деактивированных строк.
+        """
+
+    @abstractmethod
+    async def extend_subscriptions(self, user_ids, days) -> int:
+        """Продление активных подписок нескольких пользователей; число строк"""
+
+    @abstractmethod
+    async def get_subscription(self, user_id):
+        """Текущая активная подписка пользователя или None"""
+
+    async def check_subscription(self, user_id):
+        """Проверка активности подписки"""
+        subscription = await self.get_subscription(user_id)
+        if not subscription:
+            return False
+        return subscription.expiration_ts is not None and subscription.expiration_ts > time.time()
+
+    async def get_subscription_end_date(self, user_id):
+        """Дата окончания текущей подписки"""
+        subscription = await self.get_subscription(user_id)
+        return subscription.expiration if subscription else None
+
+    @abstractmethod
+    async def get_expired_subscriptions(self):
+        """Все истекшие активные подписки"""
+
+    @abstractmethod
+    async def get_active_subscriptions(self):
+        """Все действующие подписки"""
+
+    @abstractmethod
+    async def get_expired_subscriptions_page(self, after=None, limit: int = 500, now: Optional[int] = None):
+        """Страница истекших подписок после ключа after = (expiration, id)"""
+
+    @abstractmethod
+    async def get_active_subscriptions_page(self, after=None, limit: int = 500, now: Optional[int] = None):
+        """Страница действующих подписок после ключа after = (expiration, id)"""
+
+    async def _iter_pages(self, name, batch_size, after):
+        now = int(time.time())
+        page_method = getattr(self, name)
+        while True:
+            page = await page_method(after, batch_size, now)
+            for row in page:
+                yield row
+            if len(page) < batch_size:
+                return
+            after = page[-1].key
+
+    def iter_expired_subscriptions(self, batch_size: int = 500, after=None):
+        """Асинхронный потоковый обход истекших подписок (keyset пагинация)"""
+        return self._iter_pages('get_expired_subscriptions_page', batch_size, after)
+
+    def iter_active_subscriptions(self, batch_size: int = 500, after=None):
+        """Асинхронный потоковый обход действующих подписок (keyset пагинация)"""
+        return self._iter_pages('get_active_subscriptions_page', batch_size, after)
+
+    @abstractmethod
+    async def get_warning_due_page(self, tier: str, window: int, floor: int = 0, after=None,
+                                   limit: int = 500, now: Optional[int] = None):
+        """Страница подписок со сроком в (now + floor, now + window], существовавших
+        за window до срока и без записи warning_type(tier, expiration) в журнале"""
+
+    @abstractmethod
+    async def get_recent_subscriptions(self, limit: int = 5):
+        """Последние созданные подписки (user_id, expiration, is_active)"""
+
+    # --- Конфигурации клиентов ---
+
+    @abstractmethod
+    async def save_client_config(self, user_id: int, client_data: Dict[str, str]):
+        """Сохранение (замена) конфигурации клиента"""
+
+    @abstractmethod
+    async def get_client_config(self, user_id: int):
+        """Конфигурация клиента или None"""
+
+    @abstractmethod
+    async def get_file_id(self, user_id: int, kind: str, content_hash: str) -> Optional[str]:
+        """Сохраненный file_id Telegram для файла kind этой версии конфигурации или None"""
+
+    @abstractmethod
+    async def save_file_id(self, user_id: int, kind: str, content_hash: str, file_id: str):
+        """Запомнить file_id (заменяет запись для прежней версии)"""
+
+    # --- Уведомления ---
+
+    @abstractmethod
+    async def add_notification(self, user_id, subscription_id, notification_type):
+        """Запись об отправленном уведомлении (повтор игнорируется)"""
+
+    @abstractmethod
+    async def add_notifications(self, rows) -> int:
+        """Записи об уведомлениях пачкой; число новых строк"""
+
+    @abstractmethod
+    async def claim_notification(self, user_id, subscription_id, notification_type) -> bool:
+        """Атомарно занять отправку уведомления"""
+
+    @abstractmethod
+    async def claim_notifications(self, rows) -> list:
+        """Занять отправку нескольких уведомлений; занятые строки"""
+
+    @abstractmethod
+    async def release_notification(self, subscription_id, notification_type):
+        """Снять отметку о неудавшейся отправке"""
+
+    @abstractmethod
+    async def filter_unnotified(self, subscription_ids, notification_type) -> set:
+        """Подписки из списка, по которым уведомление еще не отправлялось"""
+
+    @abstractmethod
+    async def prune_notifications(self, older_than_days: int) -> int:
+        """Удаление записей журнала старше older_than_days дней"""
+
+    @abstractmethod
+    async def check_notification_sent(self, user_id, subscription_id, notification_type):
+        """Было ли отправлено уведомление"""
+
+    # --- Обслуживание ---
+
+    @abstractmethod
+    async def clear_all_data(self):
+        """Очистка пользователей, подписок, платежей и конфигураций"""
+
+    @abstractmethod
+    async def get_counters(self) -> Dict[str, int]:
+        """Счетчики строк, поддерживаемые триггерами (чтение без COUNT(*))"""
+
+    @abstractmethod
+    async def check_counters(self) -> Dict[str, tuple]:
+        """Расхождения счетчиков с COUNT(*): {имя: (сохранено, фактически)}"""
+
+    @abstractmethod
+    async def rebuild_counters(self) -> Dict[str, tuple]:
+        """Пересчет счетчиков; возвращает исправленные расхождения"""
+
+    # --- Архив холодных строк ---
+
+    @abstractmethod
+    async def archive_batch(self, table: str, cutoff: int, batch_size: int = 500, after=None):
+        """Перенос до batch_size строк table старше cutoff (epoch) в архив
+
+        Возвращает (перенесено, after для следующего вызова).
+        """
+
+    @abstractmethod
+    async def get_archive_stats(self) -> Dict[str, int]:
+        """Количество строк в архиве по таблицам"""
+
+    async def archive_old_rows(self, older_than_days: float, batch_size: int = 500) -> Dict[str, int]:
+        """Перенос в архив всех строк старше older_than_days пачками
+
+        Каждая пачка - отдельная короткая транзакция, между ними выполняются
+        обычные запросы бота. Возвращает число перенесенных строк по таблицам.
+        """
+        cutoff = int(time.time() - older_than_days * 86400)
+        moved = {}
+        for table in ARCHIVE_TABLES:
+            moved[table] = 0
+            after = None
+            while True:
+                count, after = await self.archive_batch(table, cutoff, batch_size, after)
+                moved[table] += count
+                if count < batch_size:
+                    break
+        return moved
+
+    # --- Планировщик ---
+
+    @abstractmethod
+    async def get_job_runs(self) -> Dict[str, float]:
+        """Время последнего запуска задач планировщика: {имя: epoch}"""
+
+    @abstractmethod
+    async def record_job_run(self, name: str, started_at: float, duration: float, error: Optional[str] = None):
+        """Сохранение результата запуска задачи"""
+
+    # --- Outbox ---
+
+    @abstractmethod
+    async def enqueue_outbox(self, events) -> int:
+        """Запись событий (kind, dedup_key, payload); повтор dedup_key пропускается"""
+
+    @abstractmethod
+    async def claim_outbox(self, limit: int = 100, lease: float = 60.0):
+        """Захват готовых событий на lease секунд; список OutboxEvent"""
+
+    @abstractmethod
+    async def complete_outbox(self, event_ids) -> int:
+        """Удаление выполненных событий"""
+
+    @abstractmethod
+    async def retry_outbox(self, event_id: int, delay: Optional[float], error: str):
+        """Отложить событие на delay секунд; delay None - попытки исчерпаны"""
+
+    @abstractmethod
+    async def get_outbox_stats(self) -> Dict:
+        """Ожидающие и неудавшиеся события: pending, dead, oldest_age"""
+
+    # --- Рассылки ---
+
+    @abstractmethod
+    async def count_broadcast_recipients(self, segment: str, now: Optional[int] = None) -> int:
+        """Число пользователей сегмента BROADCAST_SEGMENTS"""
+
+    @abstractmethod
+    async def get_broadcast_recipients_page(self, segment: str, after: int = 0, limit: int = 500,
+                                            now: Optional[int] = None) -> list:
+        """user_id сегмента больше after по возрастанию (keyset пагинация)"""
+
+    @abstractmethod
+    async def create_broadcast(self, segment: str, text: str, total: int, chat_id=None, message_id=None) -> int:
+        """Новая рассылка в статусе running; ее id"""
+
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id: int):
+        """Запись Broadcast или None"""
+
+    @abstractmethod
+    async def get_running_broadcasts(self) -> list:
+        """Незавершенные рассылки по порядку создания"""
+
+    @abstractmethod
+    async def update_broadcast(self, broadcast_id: int, cursor: int, sent: int, failed: int,
+                               status: Optional[str] = None) -> Optional[str]:
+        """Сохранение курсора и счетчиков (и статуса); текущий статус рассылки"""
+
+    @abstractmethod
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        """Отмена выполняющейся рассылки"""
+
+    # --- Аренда лидерства ---
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> Optional[int]:
+        """Захват или продление аренды; fencing-токен или None, если аренда занята"""
+
+    @abstractmethod
+    async def release_lease(self, name: str, holder: str):
+        """Досрочное освобождение аренды владельцем"""
+
+    @abstractmethod
+    async def check_lease(self, name: str, holder: str, token: int) -> bool:
+        """Аренда все еще у holder с тем же токеном и не истекла"""
+
+    async def checkpoint(self, mode: str = 'PASSIVE'):
+        """Checkpoint журнала; имеет смысл только для SQLite"""
+        return None
+
+    # Обслуживание файла базы имеет смысл только для SQLite: PostgreSQL
+    # делает это сам (autovacuum), резервные копии - pg_dump/реплики
+
+    # backup() копирует базу в файл (SQLite); иначе копии делаются снаружи
+    supports_file_backup = False
+
+    async def get_file_stats(self) -> Dict:
+        """Размер файла базы и число свободных страниц"""
+        return {}
+
+    async def enable_incremental_vacuum(self) -> bool:
+        """Перевод базы в auto_vacuum=INCREMENTAL"""
+        return False
+
+    async def incremental_vacuum(self, pages: int = 256) -> int:
+        """Возврат до pages свободных страниц; число освобожденных"""
+        return 0
+
+    async def optimize(self, analyze: bool = False):
+        """Обновление статистики планировщика запросов"""
+
+    async def backup(self, target: str, pages: int = 256, sleep: float = 0.005) -> Optional[int]:
+        """Горячая копия базы в файл target; число скопированных страниц (None - см. supports_file_backup)"""
+        return None
+
+def create_storage(url: str, archive_file: Optional[str] = None, shared: bool = False) -> Storage:
+    """Хранилище по адресу: postgres:// или postgresql:// - PostgreSQL, иначе путь к файлу SQLite
+
+    archive_file - файл архива для SQLite; PostgreSQL хранит архив в схеме archive.
+    shared - базу одновременно используют несколько процессов (реплики).
+    Кэш записей сбрасывается только записями своего процесса, поэтому в
+    этом режиме он отключен (у PostgreSQL он отключен по умолчанию).
+    """
+    if url.startswith(('postgres://', 'postgresql://')):
+        from postgres_storage import PostgresStorage
+        return PostgresStorage(url)
+    from async_database import AsyncDatabase
+    from database import LRUCache
+    return AsyncDatabase(url, archive_file=archive_file, cache=LRUCache(maxsize=0) if shared else None)
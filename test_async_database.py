@@ -0,0 +1,94 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from async_database import AsyncDatabase
+
+
+def test_failed_write_rolls_back_only_its_savepoint(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "batch.db"))
+        writer = db._writer
+
+        def broken():
+            writer.conn.execute("INSERT INTO users (user_id) VALUES (99)")
+            raise ValueError("boom")
+
+        writer.broken = broken
+        statements = []
+        # Соединение писателя привязано к его потоку
+        db._writer_executor.submit(writer.conn.set_trace_callback, statements.append).result()
+
+        # Все операции попадают в очередь до первого запуска писателя - одна пачка
+        results = await asyncio.gather(
+            db.add_user(1), db._write('broken'), db.add_user(2),
+            return_exceptions=True,
+        )
+        db._writer_executor.submit(writer.conn.set_trace_callback, None).result()
+
+        assert results[0] is None and results[2] is None
+        assert isinstance(results[1], ValueError)
+        assert statements.count('COMMIT') == 1
+        assert await db.get_user(1) is not None
+        assert await db.get_user(2) is not None
+        assert await db.get_user(99) is None
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_readers_are_read_only_and_see_commits(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "readers.db"), readers=2)
+        assert await db.get_user(1) is None
+        await db.add_user(1, "alice")
+        assert (await db.get_user(1))[1] == "alice"
+
+        def write_from_reader():
+            reader = db._reader()
+            assert reader.read_only
+            reader.conn.execute("INSERT INTO users (user_id) VALUES (2)")
+
+        loop = asyncio.get_running_loop()
+        with pytest.raises(sqlite3.OperationalError):
+            await loop.run_in_executor(db._reader_executor, write_from_reader)
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_close_drains_queued_writes(tmp_path):
+    path = str(tmp_path / "drain.db")
+
+    async def scenario():
+        db = AsyncDatabase(path)
+        writes = [asyncio.create_task(db.add_user(user_id)) for user_id in range(1, 51)]
+        # Операции уже в очереди, но писатель их еще не выполнил
+        await asyncio.sleep(0)
+        assert db._queue.qsize() == 50
+        await db.close()
+        assert all(task.done() and task.exception() is None for task in writes)
+
+    asyncio.run(scenario())
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 50
+    conn.close()
+
+
+def test_close_does_not_block_event_loop(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "close.db"))
+        ticks = []
+
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        # Долгое чтение еще выполняется, когда вызван close()
+        db._reader_executor.submit(time.sleep, 0.3)
+        task = asyncio.create_task(ticker())
+        await db.close()
+        task.cancel()
+        assert len(ticks) >= 10
+    asyncio.run(scenario())
@@ -0,0 +1,79 @@
+import asyncio
+
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.methods import SendMessage
+
+from async_database import AsyncDatabase
+from broadcast import BroadcastEngine
+from send_queue import SendQueue
+
+
+class FakeBot:
+    def __init__(self, blocked=()):
+        self.sent = []
+        self.blocked = set(blocked)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise TelegramForbiddenError(SendMessage(chat_id=chat_id, text=text), "bot was blocked by the user")
+        self.sent.append(chat_id)
+
+
+def test_broadcast_resumes_from_cursor(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "broadcast.db"))
+        for user_id in range(1, 8):
+            await db.add_user(user_id)
+        bot = FakeBot(blocked={4})
+        queue = SendQueue(bot, global_rate=1000, per_chat_rate=1000)
+        task = asyncio.create_task(queue.run())
+        progress = []
+
+        async def report(broadcast):
+            progress.append((broadcast.status, broadcast.sent))
+
+        engine = BroadcastEngine(db, queue, page_size=3, on_progress=report, progress_interval=0)
+        broadcast_id = await engine.start('all', "news")
+        # Реплика "упала" после первой страницы: курсор сохранен в базе
+        await db.update_broadcast(broadcast_id, 3, 3, 0)
+        bot.sent.clear()
+        try:
+            await engine.run_pending()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        assert bot.sent == [5, 6, 7]
+        broadcast = await db.get_broadcast(broadcast_id)
+        assert (broadcast.status, broadcast.cursor, broadcast.sent, broadcast.failed) == ('done', 7, 6, 1)
+        assert progress[-1] == ('done', 6)
+        assert await db.get_running_broadcasts() == []
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_cancelled_broadcast_stops_after_page(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "broadcast.db"))
+        for user_id in range(1, 10):
+            await db.add_user(user_id)
+        queue = SendQueue(FakeBot(), global_rate=1000, per_chat_rate=1000)
+        task = asyncio.create_task(queue.run())
+        engine = BroadcastEngine(db, queue, page_size=3)
+
+        async def cancel_on_first(broadcast):
+            await engine.cancel(broadcast.id)
+
+        engine.on_progress = cancel_on_first
+        engine.progress_interval = 0
+        broadcast_id = await engine.start('all', "news")
+        try:
+            await engine.run_pending()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        broadcast = await db.get_broadcast(broadcast_id)
+        assert (broadcast.status, broadcast.cursor, broadcast.sent) == ('cancelled', 6, 6)
+        await db.close()
+    asyncio.run(scenario())
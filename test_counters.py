@@ -0,0 +1,49 @@
+import logging
+import sqlite3
+
+import pytest
+
+import migrations
+from database import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    logging.disable(logging.INFO)
+    database = Database(str(tmp_path / 'counters.db'))
+    yield database
+    database.close()
+    logging.disable(logging.NOTSET)
+
+
+def test_migration_seeds_counters_from_existing_rows(tmp_path):
+    logging.disable(logging.INFO)
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn, migrations.MIGRATIONS[:4])
+    conn.executemany('INSERT INTO users (user_id) VALUES (?)', [(1,), (2,), (3,)])
+    conn.executemany('INSERT INTO payments (payment_id, user_id, status) VALUES (?, ?, ?)',
+                     [('a', 1, 'pending'), ('b', 2, 'confirmed'), ('c', 3, 'rejected')])
+    conn.commit()
+    conn.close()
+
+    database = Database(path)
+    counters = database.get_counters()
+    assert counters['users'] == 3
+    assert counters['pending_payments'] == 1 and counters['confirmed_payments'] == 1
+    database.add_user(4)
+    assert database.get_counters()['users'] == 4
+    database.close()
+    logging.disable(logging.NOTSET)
+
+
+def test_rebuild_counters_repairs_drift(db):
+    for user_id in range(10):
+        db.add_subscription(user_id, 30)
+    db.conn.execute("UPDATE counters SET value = value + 5 WHERE name = 'active_subscriptions'")
+    db.conn.commit()
+
+    assert db.check_counters() == {'active_subscriptions': (15, 10)}
+    assert db.rebuild_counters() == {'active_subscriptions': (15, 10)}
+    assert db.check_counters() == {}
+    assert db.get_counters()['active_subscriptions'] == 10
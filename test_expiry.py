@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+from async_database import AsyncDatabase
+from expiry import ExpiryEngine
+
+
+def run_with_engine(tmp_path, scenario, **options):
+    async def main():
+        db = AsyncDatabase(str(tmp_path / "expiry.db"))
+        expired = []
+
+        async def on_expire(page):
+            expired.append([(sub.user_id, time.time() - sub.expiration_ts) for sub in page])
+            await db.deactivate_subscriptions(sub.user_id for sub in page)
+
+        engine = ExpiryEngine(db, on_expire, **options)
+        try:
+            await scenario(db, engine, expired)
+        finally:
+            await db.close()
+    asyncio.run(main())
+
+
+def test_recovers_missed_and_sleeps_until_deadline(tmp_path):
+    async def scenario(db, engine, expired):
+        await db.create_subscription(1, int(time.time()) - 3600)
+        await db.create_subscription(2, int(time.time()) + 3600)
+        task = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.2)
+        assert [user_id for user_id, _ in expired[0]] == [1]
+
+        # Запись подписки сразу попадает в кучу и будит задачу
+        await db.create_subscription(3, time.time() + 1)
+        await db.create_subscription(4, time.time() + 1)
+        await asyncio.sleep(0.2)
+        assert engine.stats()['scheduled'] == 3
+        await asyncio.sleep(1.5)
+        task.cancel()
+
+        # Близкие сроки обработаны одной пачкой, с опозданием не больше coalesce
+        assert sorted(user_id for user_id, _ in expired[1]) == [3, 4]
+        assert all(lateness < 1.0 for _, lateness in expired[1])
+        assert engine.stats()['wakeups'] == 1
+        assert await db.check_subscription(2) is True
+        assert engine.stats()['scheduled'] == 1
+    run_with_engine(tmp_path, scenario, coalesce=0.5)
+
+
+def test_renewal_moves_deadline(tmp_path):
+    async def scenario(db, engine, expired):
+        await db.create_subscription(1, time.time() + 1)
+        task = asyncio.create_task(engine.run())
+        await asyncio.sleep(0.2)
+        await db.add_subscription(1, 1)
+        await asyncio.sleep(1.5)
+        task.cancel()
+        assert expired == []
+        assert engine.stats()['next_deadline'] > time.time() + 3600
+    run_with_engine(tmp_path, scenario, coalesce=0.1, horizon=2 * 86400)
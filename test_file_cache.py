@@ -0,0 +1,65 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import SendPhoto
+from aiogram.types import FSInputFile
+
+from async_database import AsyncDatabase
+from file_cache import FileIdCache, config_hash
+
+
+class FakeChat:
+    """Принимает файл или file_id, как send_photo, и запоминает загрузки"""
+
+    def __init__(self):
+        self.uploads = []
+        self.by_id = []
+        self.known = set()
+
+    async def send_photo(self, photo, caption=None):
+        if isinstance(photo, FSInputFile):
+            self.uploads.append(photo.path)
+            file_id = f"id-{len(self.uploads)}"
+            self.known.add(file_id)
+        elif photo in self.known:
+            self.by_id.append(photo)
+            file_id = photo
+        else:
+            raise TelegramBadRequest(SendPhoto(chat_id=1, photo=photo), "wrong file identifier")
+        return SimpleNamespace(document=None, photo=[SimpleNamespace(file_id=f"{file_id}-thumb"),
+                                                     SimpleNamespace(file_id=file_id)])
+
+
+def save_config(db, user_id, public_key, qr_path):
+    return db.save_client_config(user_id, {'private_key': 'k', 'public_key': public_key, 'pre_shared_key': 'p',
+                                           'config_path': f"{qr_path}.conf", 'qr_path': qr_path})
+
+
+def test_resend_by_file_id_until_config_changes(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "files.db"))
+        chat = FakeChat()
+        cache = FileIdCache(db)
+        await save_config(db, 1, 'pub-1', str(tmp_path / "1.png"))
+        config = await db.get_client_config(1)
+        for _ in range(3):
+            await cache.send(chat.send_photo, 1, config, 'qr', caption="qr")
+        assert chat.uploads == [str(tmp_path / "1.png")]
+        assert chat.by_id == ['id-1', 'id-1']
+
+        # Новые ключи - новая версия файла
+        await save_config(db, 1, 'pub-2', str(tmp_path / "1.png"))
+        config = await db.get_client_config(1)
+        assert config_hash(config, 'qr') != config_hash(config, 'config')
+        await cache.send(chat.send_photo, 1, config, 'qr')
+        assert len(chat.uploads) == 2
+
+        # Telegram больше не знает file_id - загрузка заново
+        chat.known.clear()
+        await cache.send(chat.send_photo, 1, config, 'qr')
+        assert len(chat.uploads) == 3
+        assert await db.get_file_id(1, 'qr', config_hash(config, 'qr')) == 'id-3'
+        assert cache.stats()['hits'] == 2
+        await db.close()
+    asyncio.run(scenario())
@@ -0,0 +1,58 @@
+import asyncio
+
+from async_database import AsyncDatabase
+from leader import LeaderElector
+from scheduler import IntervalTrigger, Scheduler
+
+
+def test_failover_after_crash_fences_old_leader(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "leader.db"))
+        first = LeaderElector(db, holder='a', ttl=0.6, heartbeat=0.1, margin=0.2)
+        second = LeaderElector(db, holder='b', ttl=0.6, heartbeat=0.1, margin=0.2)
+        assert await first.try_acquire() is True
+        assert await second.try_acquire() is False
+        assert await first.confirm() is True
+
+        # Первый перестал продлевать аренду (завис): через ttl ее забирает второй
+        await asyncio.sleep(0.7)
+        assert first.is_leader is False
+        assert await second.try_acquire() is True
+        assert second.token == first.token + 1
+        assert await first.confirm() is False
+        assert await first.try_acquire() is False
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_only_leader_runs_jobs_and_release_hands_over(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "leader.db"))
+        runs = {'a': 0, 'b': 0}
+        replicas = []
+        for holder in ('a', 'b'):
+            elector = LeaderElector(db, holder=holder, ttl=2, heartbeat=0.1, margin=0.5)
+            scheduler = Scheduler(db, elector)
+
+            async def job(holder=holder):
+                runs[holder] += 1
+            scheduler.add_job('tick', job, IntervalTrigger(0.1), catch_up=False)
+            replicas.append((elector, asyncio.create_task(elector.run()), asyncio.create_task(scheduler.run())))
+            await asyncio.sleep(0.05)
+
+        await asyncio.sleep(0.5)
+        assert runs['a'] >= 3 and runs['b'] == 0
+        assert (replicas[0][0].is_leader, replicas[1][0].is_leader) == (True, False)
+
+        # Штатная остановка лидера освобождает аренду - второй подхватывает за heartbeat
+        for task in replicas[0][1:]:
+            task.cancel()
+        await asyncio.gather(*replicas[0][1:], return_exceptions=True)
+        stopped = runs['a']
+        await asyncio.sleep(0.5)
+        assert runs['a'] == stopped and runs['b'] >= 2
+        for task in replicas[1][1:]:
+            task.cancel()
+        await asyncio.gather(*replicas[1][1:], return_exceptions=True)
+        await db.close()
+    asyncio.run(scenario())
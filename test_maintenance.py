@@ -0,0 +1,59 @@
+import asyncio
+import os
+import sqlite3
+
+from async_database import AsyncDatabase
+from database import Database, LEGACY_CONNECTION_PROFILE
+from maintenance import DatabaseMaintenance
+
+
+def test_legacy_database_switches_to_incremental_vacuum(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    Database(path, LEGACY_CONNECTION_PROFILE).close()
+    db = Database(path)
+    assert db.get_file_stats()['auto_vacuum'] == 'NONE'
+    assert db.enable_incremental_vacuum() is True
+    assert db.enable_incremental_vacuum() is False
+    assert db.get_file_stats()['auto_vacuum'] == 'INCREMENTAL'
+    db.close()
+
+
+def test_incremental_vacuum_releases_free_pages(tmp_path):
+    db = Database(str(tmp_path / "vacuum.db"))
+    with db.batch():
+        for user_id in range(3000):
+            db.add_user(user_id, 'x' * 200)
+    db.clear_all_data()
+    free = db.get_file_stats()['freelist_count']
+    assert free > 100
+    assert db.incremental_vacuum(100) == 100
+    assert db.get_file_stats()['freelist_count'] == free - 100
+    db.close()
+
+
+def test_backup_during_writes_and_retention(tmp_path):
+    path = str(tmp_path / "bot.db")
+    backup_dir = str(tmp_path / "backups")
+
+    async def scenario():
+        db = AsyncDatabase(path)
+        maintenance = DatabaseMaintenance(db, path, backup_dir=backup_dir, backups_keep=2, backup_pages=4)
+        await asyncio.gather(*(db.add_user(user_id, 'x' * 200) for user_id in range(1000)))
+
+        async def writer():
+            for user_id in range(1000, 1200):
+                await db.add_user(user_id)
+
+        reports = []
+        for _ in range(3):
+            report, _ = await asyncio.gather(maintenance.run_once(force=True), writer())
+            reports.append(report)
+        await db.close()
+        return reports
+
+    reports = asyncio.run(scenario())
+    assert sorted(os.listdir(backup_dir)) == sorted(os.path.basename(r['backup']) for r in reports[1:])
+    conn = sqlite3.connect(reports[-1]['backup'])
+    assert conn.execute("PRAGMA integrity_check").fetchone() == ('ok',)
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] >= 1000
+    conn.close()
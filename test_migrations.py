@@ -0,0 +1,89 @@
+import calendar
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import pytest
+
+import migrations
+from records import from_epoch, to_epoch
+
+
+@pytest.fixture
+def moscow_time():
+    """Часовой пояс процесса со смещением от UTC, чтобы различать локальное время и UTC"""
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'Europe/Moscow'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+def legacy_database(path):
+    """База до появления миграций: исходная схема, текстовые даты, user_version = 0"""
+    conn = sqlite3.connect(path)
+    for step in migrations.MIGRATIONS[0][2]:
+        conn.execute(step)
+    conn.executemany(
+        "INSERT INTO users (user_id, username, created_at) VALUES (?, ?, ?)",
+        [(1, 'alice', '2024-01-10 09:00:00'), (2, 'bob', '2024-01-11 09:00:00')],
+    )
+    conn.executemany(
+        "INSERT INTO subscriptions (user_id, expiration, created_at, is_active) VALUES (?, ?, ?, ?)",
+        [(1, '2024-02-15 12:00:00.123456', '2024-01-15 12:00:00', 1),
+         (2, '2024-01-20 08:30:00', '2023-12-20 08:30:00', 0)],
+    )
+    conn.executemany(
+        "INSERT INTO payments (payment_id, user_id, amount, duration_months, status, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [('p1', 1, 199.0, 1, 'confirmed', '2024-01-15 09:00:00'),
+         ('p2', 2, 199.0, 1, 'pending', '2024-01-16 10:00:00')],
+    )
+    conn.executemany(
+        "INSERT INTO notifications (user_id, subscription_id, notification_type) VALUES (?, ?, ?)",
+        [(2, 2, 'expired'), (2, 2, 'expired'), (2, 2, '24h_warning'), (1, 1, '24h_warning')],
+    )
+    conn.commit()
+    assert migrations.get_version(conn) == 0
+    return conn
+
+
+def test_migrate_pre_series_database(tmp_path, moscow_time):
+    conn = legacy_database(str(tmp_path / "legacy.db"))
+    assert migrations.migrate(conn) == migrations.LATEST_VERSION
+    assert migrations.get_version(conn) == len(migrations.MIGRATIONS)
+
+    # Миграция 3: даты стали целыми epoch секундами
+    rows = conn.execute(
+        "SELECT typeof(expiration), typeof(created_at) FROM subscriptions "
+        "UNION ALL SELECT typeof(created_at), typeof(created_at) FROM payments"
+    ).fetchall()
+    assert set(rows) == {('integer', 'integer')}
+    # Подписки записаны в локальном времени хоста (UTC+3), платежи - в UTC
+    expiration, created_at = conn.execute("SELECT expiration, created_at FROM subscriptions WHERE id = 1").fetchone()
+    assert expiration == calendar.timegm((2024, 2, 15, 9, 0, 0)) == to_epoch(datetime(2024, 2, 15, 12, 0))
+    assert created_at == calendar.timegm((2024, 1, 15, 9, 0, 0))
+    assert from_epoch(expiration) == datetime(2024, 2, 15, 12, 0)
+    paid_at = conn.execute("SELECT created_at FROM payments WHERE payment_id = 'p1'").fetchone()[0]
+    assert paid_at == calendar.timegm((2024, 1, 15, 9, 0, 0))
+
+    # Миграция 4: дубликаты журнала удалены, повтор запрещен индексом
+    assert conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0] == 3
+
+    # Миграция 5: счетчики посчитаны по уже существующим строкам
+    counters = dict(conn.execute("SELECT name, value FROM counters"))
+    assert counters == {'users': 2, 'active_subscriptions': 1, 'pending_payments': 1,
+                        'confirmed_payments': 1, 'client_configs': 0, 'notifications': 3}
+
+    # Повторный запуск - только чтение версии
+    statements = []
+    conn.set_trace_callback(statements.append)
+    assert migrations.migrate(conn) == migrations.LATEST_VERSION
+    conn.set_trace_callback(None)
+    assert statements == ['PRAGMA user_version']
+    conn.close()
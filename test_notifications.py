@@ -0,0 +1,77 @@
+import logging
+import sqlite3
+
+import pytest
+
+import migrations
+from database import Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    logging.disable(logging.CRITICAL)
+    database = Database(str(tmp_path / "notifications.db"))
+    for user_id in range(1, 4):
+        database.add_user(user_id)
+        database.add_subscription(user_id, 30)
+    yield database
+    database.close()
+    logging.disable(logging.NOTSET)
+
+
+def _subscription_ids(db):
+    return [row[0] for row in db.conn.execute("SELECT id FROM subscriptions ORDER BY id")]
+
+
+def test_claim_is_exclusive_across_connections(db, tmp_path):
+    sub_id = _subscription_ids(db)[0]
+    other = Database(str(tmp_path / "notifications.db"))
+    try:
+        assert db.claim_notification(1, sub_id, 'expired') is True
+        assert other.claim_notification(1, sub_id, 'expired') is False
+        assert other.check_notification_sent(1, sub_id, 'expired')
+    finally:
+        other.close()
+
+
+def test_release_allows_retry(db):
+    sub_id = _subscription_ids(db)[0]
+    assert db.claim_notification(1, sub_id, 'expired')
+    db.release_notification(sub_id, 'expired')
+    assert db.claim_notification(1, sub_id, 'expired')
+
+
+def test_filter_and_bulk_claim(db):
+    ids = _subscription_ids(db)
+    db.add_notification(1, ids[0], 'expired')
+    assert db.filter_unnotified(ids, 'expired') == set(ids[1:])
+    claimed = db.claim_notifications([(user_id, sub_id, 'expired') for user_id, sub_id in zip((1, 2, 3), ids)])
+    assert [row[1] for row in claimed] == ids[1:]
+    assert db.filter_unnotified(ids, 'expired') == set()
+    assert db.add_notifications([(1, ids[0], 'expired')]) == 0
+
+
+def test_prune_notifications(db):
+    ids = _subscription_ids(db)
+    db.add_notification(1, ids[0], 'expired')
+    db.add_notification(2, ids[1], 'expired')
+    db.conn.execute(
+        "UPDATE notifications SET created_at = datetime('now', '-100 days') WHERE subscription_id = ?", (ids[0],)
+    )
+    db.conn.commit()
+    assert db.prune_notifications(90) == 1
+    assert db.filter_unnotified(ids[:2], 'expired') == {ids[0]}
+
+
+def test_migration_deduplicates_existing_rows(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    migrations.migrate(conn, migrations.MIGRATIONS[:3])
+    conn.executemany(
+        "INSERT INTO notifications (user_id, subscription_id, notification_type) VALUES (?, ?, ?)",
+        [(1, 10, 'expired'), (1, 10, 'expired'), (1, 10, '24h_warning'), (2, 11, 'expired')],
+    )
+    conn.commit()
+    assert migrations.migrate(conn) == migrations.LATEST_VERSION
+    assert conn.execute("SELECT COUNT(*) FROM notifications").fetchone()[0] == 3
+    conn.close()
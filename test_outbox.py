@@ -0,0 +1,109 @@
+import asyncio
+import time
+
+from async_database import AsyncDatabase
+from jobs import SubscriptionJobs
+from outbox import OutboxWorker
+
+
+def test_deactivation_and_side_effects_commit_together(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "outbox.db"))
+        for user_id in (1, 2, 3):
+            await db.create_subscription(user_id, int(time.time()) - 60)
+        events = [('disable_peer', f"disable_peer:{user_id}", {'user_id': user_id}) for user_id in (1, 2, 3)]
+        events.append(('notify', 'notify:1', {'user_id': 1}))
+        assert await db.deactivate_subscriptions([1, 2, 3], outbox=events) == 3
+        # Повторный обход не дублирует события
+        await db.enqueue_outbox(events[:1])
+
+        flaky = {2}
+        disabled, notified = [], []
+
+        async def disable(batch):
+            errors = {event.id: "timeout" for event in batch if event.payload['user_id'] in flaky}
+            flaky.clear()
+            disabled.extend(event.payload['user_id'] for event in batch if event.id not in errors)
+            return errors
+
+        async def notify(payload):
+            notified.append(payload['user_id'])
+            raise RuntimeError("blocked by user")
+
+        worker = OutboxWorker(db, base_delay=0.01, max_delay=0.01, max_attempts=3)
+        worker.register('disable_peer', disable, batch=True)
+        worker.register('notify', notify)
+        assert await worker.drain_once() == 2
+        for _ in range(3):
+            await asyncio.sleep(0.02)
+            await worker.drain_once()
+
+        assert sorted(disabled) == [1, 2, 3]
+        assert notified == [1, 1, 1]
+        assert worker.stats() == {'completed': 3, 'retried': 3, 'dead': 1}
+        stats = await db.get_outbox_stats()
+        assert (stats['pending'], stats['dead']) == (0, 1)
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_renewed_user_is_left_alone(tmp_path):
+    """Событие истечения, выполненное уже после продления, ничего не делает"""
+    class Recorder:
+        def __init__(self):
+            self.calls = []
+
+        async def send_message(self, user_id, text, **kwargs):
+            self.calls.append(user_id)
+
+        async def disable_clients(self, names):
+            self.calls.extend(names)
+            return {'disabled': set(names), 'missing': set(), 'failed': set()}
+
+        def remove_configs(self, user_id, name):
+            self.calls.append(name)
+
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "renewed.db"))
+        for user_id in (1, 2):
+            await db.create_subscription(user_id, int(time.time()) - 60)
+        events = [(kind, f"{kind}:{user_id}", {'user_id': user_id, 'subscription_id': user_id})
+                  for user_id in (1, 2) for kind in ('disable_peer', 'notify_expired', 'cleanup_configs')]
+        assert await db.deactivate_subscriptions([1, 2], outbox=events) == 2
+        await db.add_subscription(1, 30)
+
+        sender, wg_api, configs = Recorder(), Recorder(), Recorder()
+        jobs = SubscriptionJobs(db, sender, wg_api, configs)
+        worker = OutboxWorker(db)
+        worker.register('disable_peer', jobs.disable_peers, batch=True)
+        worker.register('notify_expired', jobs.notify_expired)
+        worker.register('cleanup_configs', jobs.cleanup_configs)
+        assert await worker.drain_once() == 6
+
+        assert sender.calls == [2]
+        assert wg_api.calls == ['user_2']
+        assert configs.calls == ['user_2']
+        assert await db.filter_unnotified([1, 2], 'expired') == {1}
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_renewal_between_page_read_and_deactivation(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "race.db"))
+        for user_id in (1, 2):
+            await db.create_subscription(user_id, int(time.time()) - 60)
+        jobs = SubscriptionJobs(db, None, None, None)
+        jobs.outbox = OutboxWorker(db)
+
+        page = await db.get_expired_subscriptions_page(None, 10, int(time.time()))
+        assert [sub.user_id for sub in page] == [1, 2]
+        # Платеж подтвержден после чтения страницы обходом
+        await db.add_subscription(1, 30)
+        await jobs.process_expired(page)
+
+        assert await db.check_subscription(1) is True
+        assert await db.check_subscription(2) is False
+        assert {event.payload['user_id'] for event in await db.claim_outbox()} == {2}
+        await db.close()
+    asyncio.run(scenario())
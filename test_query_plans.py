@@ -0,0 +1,65 @@
+import logging
+
+import pytest
+
+from database import Database
+
+EXPIRY_INDEX = 'idx_subscriptions_active_expiration'
+
+
+@pytest.fixture
+def db(tmp_path):
+    logging.disable(logging.INFO)
+    database = Database(str(tmp_path / 'plans.db'))
+    for user_id in range(50):
+        database.add_subscription(user_id, user_id % 7)
+    yield database
+    database.close()
+    logging.disable(logging.NOTSET)
+
+
+def _query_plans(db, method):
+    """Планы всех SELECT из subscriptions, выполненных методом Database"""
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    try:
+        method()
+    finally:
+        db.conn.set_trace_callback(None)
+
+    plans = []
+    for sql in statements:
+        if sql.lstrip().upper().startswith('SELECT') and 'subscriptions' in sql:
+            rows = db.conn.execute(f'EXPLAIN QUERY PLAN {sql}').fetchall()
+            plans.append(' | '.join(row[-1] for row in rows))
+    assert plans, 'method did not query subscriptions'
+    return plans
+
+
+@pytest.mark.parametrize('method_name', [
+    'get_expired_subscriptions',
+    'get_active_subscriptions',
+    'get_expired_subscriptions_page',
+    'get_active_subscriptions_page',
+])
+def test_expiry_scans_use_covering_partial_index(db, method_name):
+    for plan in _query_plans(db, getattr(db, method_name)):
+        assert f'USING COVERING INDEX {EXPIRY_INDEX}' in plan, plan
+        assert 'SCAN subscriptions' not in plan, plan
+        assert 'TEMP B-TREE' not in plan, plan
+
+
+def test_warning_tier_query_uses_indexes(db):
+    for plan in _query_plans(db, lambda: db.get_warning_due_page('24h', 86400, 3600)):
+        assert f'USING COVERING INDEX {EXPIRY_INDEX}' in plan, plan
+        assert 'idx_notifications_subscription_type' in plan, plan
+        assert 'TEMP B-TREE' not in plan, plan
+
+
+def test_keyset_iteration_resumes_without_gaps(db):
+    rows = list(db.iter_active_subscriptions(batch_size=7))
+    keys = [row.key for row in rows]
+    assert keys == sorted(keys)
+
+    resumed = list(db.iter_active_subscriptions(batch_size=7, after=keys[9]))
+    assert [row.id for row in resumed] == [row.id for row in rows[10:]]
@@ -0,0 +1,87 @@
+import asyncio
+
+from database import Database, LRUCache
+from storage import create_storage
+
+
+def open_pair(tmp_path):
+    """Писатель и read-only читатель с общим кэшем, как в AsyncDatabase"""
+    cache = LRUCache()
+    path = str(tmp_path / "cache.db")
+    writer = Database(path, cache=cache)
+    reader = Database(path, read_only=True, cache=cache)
+    return cache, writer, reader
+
+
+def test_writes_invalidate_cached_subscriptions(tmp_path):
+    cache, writer, reader = open_pair(tmp_path)
+    for user_id in (1, 2):
+        writer.add_user(user_id)
+        writer.add_subscription(user_id, 10)
+
+    first = reader.get_subscription(1)
+    assert reader.get_subscription(1) is first
+    assert cache.stats()['hits'] == 1
+
+    writer.add_subscription(1, 5)
+    extended = reader.get_subscription(1)
+    assert (extended['expiration'] - first['expiration']).days == 5
+
+    reader.get_subscription(2)
+    assert writer.extend_subscriptions([1, 2], 3) == 2
+    assert (reader.get_subscription(1)['expiration'] - extended['expiration']).days == 3
+
+    assert writer.deactivate_subscriptions([1, 2]) == 2
+    assert reader.get_subscription(1) is None
+    assert reader.get_subscription(2) is None
+    writer.close()
+    reader.close()
+
+
+def test_write_inside_batch_invalidates_after_commit(tmp_path):
+    cache, writer, reader = open_pair(tmp_path)
+    writer.add_user(1)
+    writer.add_subscription(1, 10)
+    assert reader.get_subscription(1) is not None
+    with writer.batch():
+        writer.deactivate_subscriptions([1])
+        # До commit читатели видят прежнюю строку - кэш еще действителен
+        assert reader.get_subscription(1) is not None
+    assert reader.get_subscription(1) is None
+    writer.close()
+    reader.close()
+
+
+def test_stale_load_racing_a_write_is_not_cached(tmp_path):
+    cache, writer, reader = open_pair(tmp_path)
+    writer.add_user(1)
+    writer.add_subscription(1, 10)
+
+    def load_then_write(user_id):
+        # Читатель прочитал строку, и до записи в кэш писатель ее изменил
+        value = reader._load_subscription(user_id)
+        writer.deactivate_subscriptions([user_id])
+        return value
+
+    stale = reader._cached(('subscription', 1), load_then_write, 1)
+    assert stale is not None
+    assert cache.get(('subscription', 1)) == (False, None)
+    assert reader.get_subscription(1) is None
+    writer.close()
+    reader.close()
+
+
+def test_shared_storage_disables_cache(tmp_path):
+    """Реплики пишут в базу мимо кэша друг друга - для shared кэш отключен"""
+    async def scenario():
+        first = create_storage(str(tmp_path / "shared.db"), shared=True)
+        second = create_storage(str(tmp_path / "shared.db"), shared=True)
+        await first.add_user(1)
+        await first.add_subscription(1, 10)
+        assert await first.get_subscription(1) is not None
+        await second.deactivate_subscriptions([1])
+        assert await first.get_subscription(1) is None
+        assert first.cache_stats()['size'] == 0
+        await first.close()
+        await second.close()
+    asyncio.run(scenario())
@@ -0,0 +1,36 @@
+import pickle
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from records import ClientConfig, Payment, Subscription
+
+
+def test_subscription_from_row_factory():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = Subscription.row_factory
+    sub = conn.execute('SELECT 1, 42, 1700000000, 1600000000, 1').fetchone()
+
+    assert sub.id == 1 and sub.user_id == 42 and sub.is_active == 1
+    assert sub.expiration == datetime.fromtimestamp(1700000000)
+    assert sub.key == (1700000000, 1)
+    assert sub['expiration'] == sub.expiration and sub[1] == 42
+    sub_id, user_id, expiration, created_at, is_active = sub
+    assert created_at == datetime.fromtimestamp(1600000000)
+    assert not hasattr(sub, '__dict__')
+
+
+def test_records_are_immutable_values():
+    payment = Payment('p1', 1, 199.0, 1, 'pending', 1700000000)
+    with pytest.raises(AttributeError):
+        payment.status = 'confirmed'
+    with pytest.raises(KeyError):
+        payment['missing']
+    with pytest.raises(TypeError):
+        Payment('p1', 1)
+
+    assert payment == Payment._make(payment._raw())
+    assert hash(payment) == hash(pickle.loads(pickle.dumps(payment)))
+    assert payment[:5] == ('p1', 1, 199.0, 1, 'pending')
+    assert ClientConfig('a', 'b', 'c', '/tmp/1.conf', None)._asdict()['config_path'] == '/tmp/1.conf'
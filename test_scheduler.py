@@ -0,0 +1,127 @@
+import asyncio
+import time
+from datetime import datetime
+
+import pytest
+
+from async_database import AsyncDatabase
+from scheduler import CronTrigger, DynamicTrigger, IntervalTrigger, Scheduler
+
+
+def test_cron_trigger_next_run():
+    start = datetime(2024, 1, 31, 23, 59, 30).timestamp()
+    assert datetime.fromtimestamp(CronTrigger('*/15 * * * *').next_after(start)) == datetime(2024, 2, 1, 0, 0)
+    assert datetime.fromtimestamp(CronTrigger('30 3 * * *').next_after(start)) == datetime(2024, 2, 1, 3, 30)
+    # 1 февраля 2024 - четверг, ближайшее воскресенье - 4 февраля
+    assert datetime.fromtimestamp(CronTrigger('0 12 * * 0').next_after(start)) == datetime(2024, 2, 4, 12, 0)
+    assert datetime.fromtimestamp(CronTrigger('0 0 29 2 *').next_after(start)) == datetime(2024, 2, 29, 0, 0)
+    with pytest.raises(ValueError):
+        CronTrigger('61 * * * *')
+
+
+def test_overlap_prevention_and_dynamic_trigger():
+    async def scenario():
+        scheduler = Scheduler()
+        calls = {'slow': 0, 'dynamic': 0}
+        deadline = [time.time() + 0.2]
+
+        async def slow():
+            calls['slow'] += 1
+            await asyncio.sleep(0.35)
+
+        async def dynamic():
+            calls['dynamic'] += 1
+            deadline[0] = float('inf')
+
+        scheduler.add_job('slow', slow, IntervalTrigger(0.1))
+        scheduler.add_job('dynamic', dynamic, DynamicTrigger(lambda now: deadline[0]))
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.5)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        stats = scheduler.stats()
+        assert calls == {'slow': 2, 'dynamic': 1}
+        assert stats['slow']['skipped'] >= 2
+        assert stats['dynamic']['max_lateness'] < 0.1
+    asyncio.run(scenario())
+
+
+def test_missed_runs_catch_up_from_history(tmp_path):
+    async def scenario():
+        db = AsyncDatabase(str(tmp_path / "jobs.db"))
+        now = time.time()
+        await db.record_job_run('missed', now - 7200, 0.5)
+        await db.record_job_run('recent', now - 60, 0.5)
+
+        scheduler = Scheduler(db)
+        ran = []
+        for name in ('missed', 'recent', 'new'):
+            scheduler.add_job(name, lambda name=name: asyncio.sleep(0, ran.append(name)), IntervalTrigger(3600))
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        assert sorted(ran) == ['missed', 'new']
+        assert scheduler.jobs['recent'].next_run == pytest.approx(now - 60 + 3600)
+        assert (await db.get_job_runs())['missed'] > now
+        await db.close()
+    asyncio.run(scenario())
+
+
+def test_wake_during_lease_check_does_not_start_job_twice():
+    class SlowLeader:
+        is_leader = True
+
+        def add_listener(self, listener):
+            pass
+
+        async def confirm(self):
+            await asyncio.sleep(0.05)
+            return True
+
+    async def scenario():
+        scheduler = Scheduler(leader=SlowLeader())
+        active, peak, runs = [0], [0], []
+
+        async def dynamic():
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+            runs.append(time.time())
+            await asyncio.sleep(0.1)
+            active[0] -= 1
+
+        scheduler.add_job('dynamic', dynamic, DynamicTrigger(lambda now: now if not runs else float('inf')))
+        task = asyncio.create_task(scheduler.run())
+        # wake() от записей и outbox, пока идет confirm() и сама задача
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            scheduler.wake()
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        assert len(runs) == 1 and peak[0] == 1
+        assert scheduler.jobs['dynamic'].running is False
+    asyncio.run(scenario())
+
+
+def test_run_job_is_fenced():
+    class Follower:
+        is_leader = False
+
+        def add_listener(self, listener):
+            pass
+
+        async def confirm(self):
+            return False
+
+    async def scenario():
+        scheduler = Scheduler(leader=Follower())
+        ran = []
+        scheduler.add_job('manual', lambda: asyncio.sleep(0, ran.append(1)), IntervalTrigger(3600))
+        with pytest.raises(RuntimeError, match="not the leader"):
+            await scheduler.run_job('manual')
+        assert ran == [] and scheduler.jobs['manual'].running is False
+    asyncio.run(scenario())
@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from send_queue import PRIORITY_BULK, PRIORITY_CRITICAL, SendQueue
+
+
+class FakeBot:
+    def __init__(self, flood=0):
+        self.sent = []
+        self.flood = flood
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.flood:
+            self.flood -= 1
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Flood control", 1)
+        self.sent.append((time.monotonic(), chat_id, text))
+        return text
+
+
+def run_queue(bot, scenario, **options):
+    async def main():
+        queue = SendQueue(bot, **options)
+        task = asyncio.create_task(queue.run())
+        try:
+            await scenario(queue)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(main())
+
+
+def test_priority_lanes_and_per_chat_pacing():
+    bot = FakeBot()
+
+    async def scenario(queue):
+        bulk = [queue.submit('send_message', 1, f"bulk {i}", priority=PRIORITY_BULK) for i in range(4)]
+        bulk += [queue.submit('send_message', 2, "bulk other", priority=PRIORITY_BULK)]
+        critical = queue.send_message(1, "payment", priority=PRIORITY_CRITICAL)
+        assert await critical == "payment"
+        await asyncio.gather(*bulk)
+        assert queue.stats()['depth'] == {'critical': 0, 'normal': 0, 'bulk': 0}
+
+    run_queue(bot, scenario, global_rate=100, per_chat_rate=10)
+    chat_1 = [(at, text) for at, chat_id, text in bot.sent if chat_id == 1]
+    # Подтверждение платежа обгоняет рассылку в тот же чат, порядок рассылки сохранен
+    assert [text for _, text in chat_1] == ["payment"] + [f"bulk {i}" for i in range(4)]
+    gaps = [b[0] - a[0] for a, b in zip(chat_1, chat_1[1:])]
+    assert min(gaps) >= 0.09
+    # Другой чат не ждет медленный
+    assert [chat_id for _, chat_id, _ in bot.sent][:2] == [1, 2]
+
+
+def test_global_rate_and_retry_after():
+    bot = FakeBot(flood=1)
+
+    async def scenario(queue):
+        started = time.monotonic()
+        results = await asyncio.gather(*(queue.send_message(chat_id, "hi") for chat_id in range(15)))
+        assert results == ["hi"] * 15
+        # 10 сообщений сразу, пауза flood control на 1 с, остальные по 10 в секунду
+        assert time.monotonic() - started >= 1.0
+        stats = queue.stats()
+        assert (stats['sent'], stats['failed'], stats['retry_after']) == (15, 0, 1)
+
+    run_queue(bot, scenario, global_rate=10)
+
+
+def test_chat_id_by_name_without_positional_args():
+    class EditingBot(FakeBot):
+        async def edit_message_text(self, text, chat_id=None, message_id=None):
+            self.sent.append((time.monotonic(), chat_id, (message_id, text)))
+            return True
+
+    bot = EditingBot()
+
+    async def scenario(queue):
+        # У edit_message_text первый параметр - text, chat_id идет по имени
+        assert await queue.submit('edit_message_text', 7, text="50%", message_id=3) is True
+        assert await queue.send_message(7, "done") == "done"
+
+    run_queue(bot, scenario, global_rate=100, per_chat_rate=100)
+    assert [(chat_id, payload) for _, chat_id, payload in bot.sent] == [(7, (3, "50%")), (7, "done")]
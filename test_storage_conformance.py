@@ -0,0 +1,383 @@
+import asyncio
+import contextlib
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, urlunsplit
+
+import pytest
+
+from async_database import AsyncDatabase
+from storage import Storage, warning_type
+
+
+@pytest.fixture(scope="session")
+def postgres_dsn():
+    """DSN из TEST_POSTGRES_DSN или локально запущенный кластер"""
+    pytest.importorskip("asyncpg")
+    dsn = os.getenv("TEST_POSTGRES_DSN")
+    if dsn:
+        yield dsn
+        return
+    if not shutil.which("initdb") or not shutil.which("pg_ctl"):
+        pytest.skip("PostgreSQL binaries (initdb, pg_ctl) are not available")
+    from bench_storage import local_postgres
+    with local_postgres() as dsn:
+        yield dsn
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def make_storage(request, tmp_path):
+    logging.disable(logging.CRITICAL)
+    if request.param == "sqlite":
+        yield lambda: AsyncDatabase(str(tmp_path / "conformance.db"), archive_file=str(tmp_path / "archive.db"))
+    else:
+        from postgres_storage import PostgresStorage
+        dsn = request.getfixturevalue("postgres_dsn")
+        with fresh_postgres_database(dsn) as test_dsn:
+            yield lambda: PostgresStorage(test_dsn, min_size=1, max_size=4)
+    logging.disable(logging.NOTSET)
+
+
+@contextlib.contextmanager
+def fresh_postgres_database(dsn):
+    """Отдельная пустая база на каждый тест"""
+    import asyncpg
+    name = f"conformance_{uuid.uuid4().hex}"
+
+    async def admin(statement):
+        conn = await asyncpg.connect(dsn)
+        try:
+            await conn.execute(statement)
+        finally:
+            await conn.close()
+
+    asyncio.run(admin(f'CREATE DATABASE "{name}"'))
+    try:
+        yield urlunsplit(urlsplit(dsn)._replace(path=f"/{name}"))
+    finally:
+        asyncio.run(admin(f'DROP DATABASE "{name}"'))
+
+
+def run(make_storage, scenario):
+    async def main():
+        storage = make_storage()
+        assert isinstance(storage, Storage)
+        await storage.connect()
+        await storage.clear_all_data()
+        try:
+            await scenario(storage)
+        finally:
+            await storage.close()
+    asyncio.run(main())
+
+
+def test_users_and_payments(make_storage):
+    async def scenario(storage):
+        await storage.add_user(1, "alice")
+        await storage.add_user(1, "alice2")
+        user = await storage.get_user(1)
+        assert user[0] == 1 and user[1] == "alice2"
+        assert await storage.get_user(2) is None
+
+        assert await storage.add_payment("p1", 1, 199.0, 1) is True
+        assert await storage.add_payment("p1", 1, 199.0, 1) is False
+        await storage.update_payment_status("p1", "confirmed")
+        payment = await storage.get_payment("p1")
+        assert payment[:5] == ("p1", 1, 199.0, 1, "confirmed")
+        assert isinstance(payment[5], datetime)
+        assert [p[0] for p in await storage.get_user_payments(1)] == ["p1"]
+
+        await storage.add_user(2)
+        assert await storage.create_payment(2, 99.0, "pending", 1) == "2"
+    run(make_storage, scenario)
+
+
+def test_subscription_lifecycle(make_storage):
+    async def scenario(storage):
+        await storage.add_user(1)
+        assert await storage.get_subscription(1) is None
+        assert await storage.check_subscription(1) is False
+
+        await storage.add_subscription(1, 30)
+        first = await storage.get_subscription(1)
+        assert first['is_active'] == 1
+        assert first['expiration'] - datetime.now() > timedelta(days=29)
+        assert await storage.check_subscription(1) is True
+
+        await storage.add_subscription(1, 30)
+        extended = await storage.get_subscription(1)
+        assert extended['id'] == first['id']
+        assert extended['expiration'] - first['expiration'] == timedelta(days=30)
+        assert await storage.get_subscription_end_date(1) == extended['expiration']
+
+        assert await storage.deactivate_subscription(1) is True
+        assert await storage.get_subscription(1) is None
+
+        target = datetime.now().replace(microsecond=0) + timedelta(days=3)
+        assert await storage.create_subscription(1, target) is True
+        assert (await storage.get_subscription(1))['expiration'] == target
+        assert [row[0] for row in await storage.get_recent_subscriptions(5)] == [1, 1]
+
+        # Параллельные первые покупки дают одну активную подписку
+        await storage.add_user(2)
+        await asyncio.gather(*(storage.add_subscription(2, 30) for _ in range(4)))
+        assert (await storage.get_counters())["active_subscriptions"] == 2
+        assert (await storage.get_subscription(2))['expiration'] - datetime.now() > timedelta(days=119)
+    run(make_storage, scenario)
+
+
+def test_sweeps_and_batch_writes(make_storage):
+    async def scenario(storage):
+        for user_id in range(1, 11):
+            await storage.add_user(user_id)
+            await storage.add_subscription(user_id, 1 if user_id % 2 else -1)
+
+        expired = await storage.get_expired_subscriptions()
+        active = await storage.get_active_subscriptions()
+        assert sorted(sub['user_id'] for sub in expired) == [2, 4, 6, 8, 10]
+        assert sorted(sub['user_id'] for sub in active) == [1, 3, 5, 7, 9]
+
+        page = await storage.get_expired_subscriptions_page(limit=2)
+        assert len(page) == 2
+        rest = await storage.get_expired_subscriptions_page(page[-1].key, 10)
+        streamed = [row['user_id'] async for row in storage.iter_expired_subscriptions(2)]
+        assert streamed == [row['user_id'] for row in list(page) + list(rest)]
+
+        assert await storage.extend_subscriptions([2, 4], 2) == 2
+        assert await storage.check_subscription(2) is True
+        assert await storage.deactivate_subscriptions([1, 3, 3, 99]) == 2
+        assert [row['user_id'] async for row in storage.iter_active_subscriptions(3)] == [5, 7, 9, 2, 4]
+
+        # Истечение по id: продленная (2) и не истекшая (5) подписки остаются
+        stale = [(sub['id'], sub['user_id']) for sub in active + expired if sub['user_id'] in (2, 5, 6)]
+        events = {subscription_id: [('notify', f"notify:{subscription_id}", {'user_id': user_id})]
+                  for subscription_id, user_id in stale}
+        sub_6 = (await storage.get_subscription(6))['id']
+        assert await storage.expire_subscriptions(stale, int(time.time()), outbox=events) == [sub_6]
+        assert await storage.check_subscription(2) is True
+        assert await storage.check_subscription(5) is True
+        assert await storage.get_subscription(6) is None
+        assert [event.payload['user_id'] for event in await storage.claim_outbox()] == [6]
+    run(make_storage, scenario)
+
+
+def test_client_configs(make_storage):
+    async def scenario(storage):
+        config = {'private_key': 'a', 'public_key': 'b', 'pre_shared_key': 'c',
+                  'config_path': '/tmp/1.conf', 'qr_path': '/tmp/1.png'}
+        await storage.save_client_config(1, config)
+        assert (await storage.get_client_config(1))._asdict() == config
+        await storage.save_client_config(1, {**config, 'public_key': 'd'})
+        assert (await storage.get_client_config(1)).public_key == 'd'
+        assert await storage.get_client_config(2) is None
+    run(make_storage, scenario)
+
+
+def test_file_id_cache(make_storage):
+    async def scenario(storage):
+        config = {'private_key': 'a', 'public_key': 'b', 'pre_shared_key': 'c',
+                  'config_path': '/tmp/1.conf', 'qr_path': '/tmp/1.png'}
+        await storage.save_client_config(1, config)
+        assert await storage.get_file_id(1, 'qr', 'h1') is None
+        await storage.save_file_id(1, 'qr', 'h1', 'photo-1')
+        await storage.save_file_id(1, 'config', 'h1', 'doc-1')
+        assert await storage.get_file_id(1, 'qr', 'h1') == 'photo-1'
+        # Другая версия конфигурации не совпадает с сохраненной
+        assert await storage.get_file_id(1, 'qr', 'h2') is None
+        await storage.save_file_id(1, 'qr', 'h2', 'photo-2')
+        assert await storage.get_file_id(1, 'qr', 'h1') is None
+        assert await storage.get_file_id(1, 'qr', 'h2') == 'photo-2'
+        # Новая конфигурация сбрасывает все file_id пользователя
+        await storage.save_client_config(1, config)
+        assert await storage.get_file_id(1, 'qr', 'h2') is None
+        assert await storage.get_file_id(1, 'config', 'h1') is None
+    run(make_storage, scenario)
+
+
+def test_notification_ledger(make_storage):
+    async def scenario(storage):
+        assert await storage.claim_notification(1, 10, 'expired') is True
+        assert await storage.claim_notification(1, 10, 'expired') is False
+        assert await storage.check_notification_sent(1, 10, 'expired') is True
+        await storage.release_notification(10, 'expired')
+        assert await storage.check_notification_sent(1, 10, 'expired') is False
+
+        await storage.add_notification(1, 10, 'expired')
+        assert await storage.filter_unnotified([10, 11, 12], 'expired') == {11, 12}
+        claimed = await storage.claim_notifications([(1, 10, 'expired'), (2, 11, 'expired'), (2, 11, 'expired')])
+        assert [tuple(row) for row in claimed] == [(2, 11, 'expired')]
+        assert await storage.add_notifications([(3, 12, 'expired'), (3, 12, 'expired')]) == 1
+        assert await storage.prune_notifications(30) == 0
+    run(make_storage, scenario)
+
+
+def test_warning_tiers_range_query(make_storage):
+    async def scenario(storage):
+        day = 86400
+        now = int(time.time())
+        await storage.create_subscription(1, now + 10 * day)
+        await storage.create_subscription(2, now + 2 * day)
+
+        async def due(tier, window, floor, at):
+            return [sub.user_id for sub in await storage.get_warning_due_page(tier, window, floor, now=at)]
+
+        # За 6 дней до срока подходит уровень 7d; подписка 2 куплена позже его окна
+        assert await due('7d', 7 * day, 3 * day, now + 4 * day) == [1]
+        assert await due('7d', 7 * day, 3 * day, now - day) == []
+        sub = await storage.get_subscription(1)
+        await storage.add_notification(1, sub.id, warning_type('7d', sub.expiration_ts))
+        assert await due('7d', 7 * day, 3 * day, now + 4 * day) == []
+        # За 2 дня до срока окно 7d уже позади, подходит 3d
+        assert await due('7d', 7 * day, 3 * day, now + 8 * day) == []
+        assert await due('3d', 3 * day, day, now + 8 * day) == [1]
+        assert await due('24h', day, 3600, now + day + 3600) == [2]
+        # После продления срок другой - предупреждения приходят снова
+        await storage.create_subscription(1, now + 20 * day)
+        assert await due('7d', 7 * day, 3 * day, now + 14 * day) == [1]
+    run(make_storage, scenario)
+
+
+def test_outbox_claims(make_storage):
+    async def scenario(storage):
+        events = [('notify', f"notify:{i}", {'user_id': i}) for i in range(3)]
+        assert await storage.enqueue_outbox(events + events[:1]) == 3
+        claimed = await storage.claim_outbox(limit=2, lease=60)
+        assert sorted(event.payload['user_id'] for event in claimed) == [0, 1]
+        # Захваченные события недоступны другим воркерам до истечения lease
+        rest = await storage.claim_outbox(limit=10, lease=60)
+        assert [event.payload for event in rest] == [{'user_id': 2}]
+        assert await storage.complete_outbox([claimed[0].id, rest[0].id]) == 2
+        await storage.retry_outbox(claimed[1].id, 0, "boom")
+        retried = await storage.claim_outbox()
+        assert [(event.id, event.attempts) for event in retried] == [(claimed[1].id, 1)]
+        await storage.retry_outbox(claimed[1].id, None, "boom")
+        assert await storage.claim_outbox() == []
+        stats = await storage.get_outbox_stats()
+        assert (stats['pending'], stats['dead']) == (0, 1)
+    run(make_storage, scenario)
+
+
+def test_leases(make_storage):
+    async def scenario(storage):
+        assert await storage.acquire_lease('scheduler', 'a', 30) == 1
+        assert await storage.acquire_lease('scheduler', 'a', 30) == 1
+        assert await storage.acquire_lease('scheduler', 'b', 30) is None
+        assert await storage.check_lease('scheduler', 'a', 1) is True
+        await storage.release_lease('scheduler', 'a')
+        assert await storage.check_lease('scheduler', 'a', 1) is False
+        assert await storage.acquire_lease('scheduler', 'b', 30) == 2
+        assert await storage.acquire_lease('other', 'a', 30) == 1
+    run(make_storage, scenario)
+
+
+def test_broadcast_segments_and_progress(make_storage):
+    async def scenario(storage):
+        now = int(time.time())
+        for user_id in range(1, 6):
+            await storage.add_user(user_id)
+        await storage.create_subscription(1, now + 3600)
+        await storage.create_subscription(2, now - 3600)
+        await storage.add_payment("p1", 1, 199.0, 1)
+        await storage.update_payment_status("p1", "confirmed")
+        await storage.add_payment("p3", 3, 199.0, 1)
+        expected = {'all': [1, 2, 3, 4, 5], 'active': [1], 'expired': [2], 'never_paid': [2, 3, 4, 5]}
+        for segment, user_ids in expected.items():
+            assert await storage.count_broadcast_recipients(segment) == len(user_ids)
+            assert await storage.get_broadcast_recipients_page(segment, 0, 100) == user_ids
+        assert await storage.get_broadcast_recipients_page('all', 2, 2) == [3, 4]
+
+        broadcast_id = await storage.create_broadcast('all', "hello", 5, chat_id=10, message_id=20)
+        assert await storage.update_broadcast(broadcast_id, 2, 2, 0) == 'running'
+        broadcast = (await storage.get_running_broadcasts())[0]
+        assert (broadcast.id, broadcast.cursor, broadcast.sent, broadcast.message_id) == (broadcast_id, 2, 2, 20)
+        assert await storage.cancel_broadcast(broadcast_id) is True
+        assert await storage.cancel_broadcast(broadcast_id) is False
+        # Отмену не перезаписывает завершение последней страницы
+        assert await storage.update_broadcast(broadcast_id, 4, 3, 1, 'done') == 'cancelled'
+        broadcast = await storage.get_broadcast(broadcast_id)
+        assert (broadcast.status, broadcast.cursor, broadcast.failed) == ('cancelled', 4, 1)
+        assert await storage.get_running_broadcasts() == []
+    run(make_storage, scenario)
+
+
+def test_clear_all_data(make_storage):
+    async def scenario(storage):
+        await storage.add_user(1)
+        await storage.add_subscription(1, 30)
+        subscription_id = (await storage.get_subscription(1))['id']
+        assert await storage.claim_notification(1, subscription_id, 'expired') is True
+        counters = await storage.get_counters()
+        assert counters['users'] == 1 and counters['active_subscriptions'] == 1
+        await storage.clear_all_data()
+        assert await storage.get_subscription(1) is None
+        assert (await storage.get_counters())['notifications'] == 0
+        # id подписок начинаются заново - журнал не должен блокировать уведомления
+        await storage.add_subscription(1, 30)
+        assert (await storage.get_subscription(1))['id'] == subscription_id
+        assert await storage.claim_notification(1, subscription_id, 'expired') is True
+        event = ('notify_expired', f"notify_expired:{subscription_id}", {'user_id': 1})
+        assert await storage.enqueue_outbox([event]) == 1
+        await storage.clear_all_data()
+        assert (await storage.get_counters())['users'] == 0
+        # Ключ дедупликации outbox с тем же id подписки снова свободен
+        assert await storage.enqueue_outbox([event]) == 1
+        assert set(storage.cache_stats()) >= {'size', 'hits', 'misses', 'hit_rate'}
+    run(make_storage, scenario)
+
+
+def test_counters_follow_writes(make_storage):
+    async def scenario(storage):
+        await storage.add_user(1)
+        await storage.add_user(1, "renamed")
+        await storage.add_user(2)
+        await storage.add_subscription(1, 30)
+        await storage.add_subscription(2, 30)
+        await storage.deactivate_subscription(2)
+        await storage.add_payment("p1", 1, 199.0, 1)
+        await storage.add_payment("p2", 2, 199.0, 1)
+        await storage.update_payment_status("p2", "confirmed")
+        config = {'private_key': 'a', 'public_key': 'b', 'pre_shared_key': 'c',
+                  'config_path': '/tmp/1.conf', 'qr_path': '/tmp/1.png'}
+        await storage.save_client_config(1, config)
+        await storage.save_client_config(1, config)
+        await storage.claim_notification(1, 1, 'expired')
+
+        assert await storage.get_counters() == {
+            'users': 2, 'active_subscriptions': 1, 'pending_payments': 1,
+            'confirmed_payments': 1, 'client_configs': 1, 'notifications': 1,
+        }
+        assert await storage.check_counters() == {}
+        assert await storage.rebuild_counters() == {}
+
+        await storage.clear_all_data()
+        assert (await storage.get_counters())['users'] == 0
+        assert await storage.check_counters() == {}
+    run(make_storage, scenario)
+
+
+def test_archive_moves_cold_rows(make_storage):
+    async def scenario(storage):
+        await storage.add_user(1)
+        await storage.add_payment("p1", 1, 199.0, 1)
+        await storage.update_payment_status("p1", "confirmed")
+        await storage.add_payment("p2", 1, 199.0, 1)
+        await storage.add_subscription(1, 30)
+        await storage.deactivate_subscription(1)
+        await storage.add_subscription(1, 30)
+        await storage.claim_notification(1, 1, 'expired')
+
+        # Отрицательный возраст сдвигает границу в будущее, за срок подписок
+        moved = await storage.archive_old_rows(-40, batch_size=1)
+        assert moved == {'payments': 1, 'subscriptions': 1, 'notifications': 1}
+        assert await storage.archive_old_rows(-40) == {'payments': 0, 'subscriptions': 0, 'notifications': 0}
+        assert await storage.get_archive_stats() == moved
+
+        assert sorted(p.payment_id for p in await storage.get_user_payments(1)) == ["p1", "p2"]
+        assert await storage.check_subscription(1) is True
+        assert (await storage.get_counters())['confirmed_payments'] == 0
+        assert await storage.check_counters() == {}
+    run(make_storage, scenario)
@@ -0,0 +1,56 @@
+import asyncio
+import socket
+
+from aiogram import Bot, Dispatcher
+from aiohttp import ClientSession
+
+from webhook import SECRET_HEADER, WebhookServer
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def update(update_id):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': str(update_id),
+        'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'u'},
+    }}
+
+
+def test_secret_token_and_graceful_drain():
+    async def scenario():
+        handled = []
+        dp = Dispatcher()
+
+        @dp.message()
+        async def handle(message):
+            await asyncio.sleep(0.05)
+            handled.append(int(message.text))
+
+        bot = Bot('123:abc')
+        server = WebhookServer(dp, bot, path='/hook', secret_token='s3cret', workers=2)
+        port = free_port()
+        await server.start('127.0.0.1', port)
+        url = f'http://127.0.0.1:{port}/hook'
+        async with ClientSession() as http:
+            async with http.post(url, json=update(1)) as response:
+                assert response.status == 401
+            async with http.post(url, json=update(2), headers={SECRET_HEADER: 'wrong'}) as response:
+                assert response.status == 401
+            async with http.post(url, data=b'not json', headers={SECRET_HEADER: 's3cret'}) as response:
+                assert response.status == 400
+            for update_id in range(3, 8):
+                # Ответ приходит до выполнения хэндлера
+                async with http.post(url, json=update(update_id), headers={SECRET_HEADER: 's3cret'}) as response:
+                    assert response.status == 200
+        assert len(handled) < 5
+        # Остановка дожидается уже принятых обновлений
+        await server.stop()
+        assert sorted(handled) == [3, 4, 5, 6, 7]
+        stats = server.stats()
+        assert (stats['received'], stats['rejected'], stats['processed'], stats['queued']) == (5, 3, 5, 0)
+        await bot.session.close()
+    asyncio.run(scenario())
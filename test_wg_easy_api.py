@@ -0,0 +1,59 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from wg_easy_api import WGEasyAPI
+
+
+def fake_wg_easy(clients, flaky=()):
+    """Минимальный wg-easy: сессия, список клиентов и включение/отключение"""
+    flaky = set(flaky)
+
+    async def login(request):
+        response = web.Response(status=204)
+        response.set_cookie('connect.sid', 'test')
+        return response
+
+    async def list_clients(request):
+        return web.json_response(list(clients.values()))
+
+    async def enable(request):
+        client_id = request.match_info['id']
+        if client_id in flaky:
+            # Первая попытка не проходит
+            flaky.discard(client_id)
+            return web.Response(status=500)
+        clients[client_id]['enabled'] = (await request.json())['enabled']
+        return web.Response(status=204)
+
+    app = web.Application()
+    app.router.add_post('/api/session', login)
+    app.router.add_get('/api/wireguard/client', list_clients)
+    app.router.add_post('/api/wireguard/client/{id}/enable', enable)
+    return app
+
+
+def test_disable_sweep_uses_one_snapshot(tmp_path):
+    async def scenario():
+        clients = {str(i): {'id': str(i), 'name': f"user_{i}", 'enabled': i != 3} for i in range(20)}
+        server = TestServer(fake_wg_easy(clients, flaky={'4'}))
+        await server.start_server()
+        api = WGEasyAPI(server.host, server.port, 'secret')
+        try:
+            names = [f"user_{i}" for i in (1, 2, 3, 4, 5)] + ['user_404']
+            result = await api.disable_clients(names)
+        finally:
+            await api.close()
+            await server.close()
+
+        assert result == {
+            'disabled': {'user_1', 'user_2', 'user_3', 'user_4', 'user_5'},
+            'missing': {'user_404'},
+            'failed': set(),
+        }
+        assert [i for i, client in clients.items() if not client['enabled']] == ['1', '2', '3', '4', '5']
+        # Снимок, 4 отключения, проверка, повтор для user_4 и еще одна проверка
+        assert api.requests['get_clients'] == 3
+        assert api.requests['set_enabled'] == 5
+    asyncio.run(scenario())
@@ -0,0 +1,148 @@
+import asyncio
+import hmac
+import logging
+import signal
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+class WebhookServer:
+    """Прием обновлений Telegram через webhook на встроенном сервере aiohttp.
+
+    start() поднимает сервер и, если задан url, регистрирует webhook в
+    Telegram (set_webhook с secret_token и используемыми типами
+    обновлений, без сброса накопившихся). Обработчик POST path проверяет
+    заголовок X-Telegram-Bot-Api-Secret-Token (secret_token из
+    set_webhook), кладет обновление в очередь и сразу отвечает 200, не
+    дожидаясь хэндлеров. Обновления выполняют workers
+    задач через Dispatcher.feed_update. Очередь ограничена queue_size:
+    когда она заполнена, ответ задерживается и Telegram сам снижает темп
+    (не больше max_connections одновременных запросов).
+
+    stop() сначала закрывает прием, затем дожидается уже принятых
+    обновлений (не дольше drain_timeout секунд). Webhook в Telegram при
+    остановке не удаляется: обновления копятся у Telegram до следующего
+    запуска. При переходе на long polling его удаляет bot.py без сброса
+    очереди.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = '/webhook', secret_token: Optional[str] = None,
+                 url: Optional[str] = None, workers: int = 16, queue_size: int = 1000, max_connections: int = 40,
+                 drain_timeout: float = 30.0, **kwargs):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.url = url
+        self.max_connections = max_connections
+        self.workers = workers
+        self.drain_timeout = drain_timeout
+        self.kwargs = kwargs
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._tasks = []
+        self._runner: Optional[web.AppRunner] = None
+        self._latencies = deque(maxlen=1000)
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None:
+            token = request.headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                self.rejected += 1
+                return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={'bot': self.bot})
+        except Exception as e:
+            logging.warning(f"Malformed webhook update: {e}")
+            self.rejected += 1
+            return web.Response(status=400)
+        self.received += 1
+        await self._queue.put((time.monotonic(), update))
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            received, update = await self._queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update, **self.kwargs)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                self._latencies.append(time.monotonic() - received)
+                self._queue.task_done()
+
+    async def start(self, host: str = '0.0.0.0', port: int = 8080):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Webhook server listening on {host}:{port}{self.path} with {self.workers} workers")
+        if self.url:
+            await self.bot.set_webhook(
+                self.url,
+                secret_token=self.secret_token,
+                allowed_updates=self.dp.resolve_used_update_types(),
+                max_connections=self.max_connections,
+                drop_pending_updates=False,
+            )
+            logging.info(f"Webhook set to {self.url}")
+
+    async def stop(self):
+        if self._runner is not None:
+            # Новые запросы больше не принимаются
+            for site in list(self._runner.sites):
+                await site.stop()
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Webhook stopped with {self._queue.qsize()} unprocessed updates")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def serve(self, host: str = '0.0.0.0', port: int = 8080):
+        """start(), ожидание SIGINT/SIGTERM или отмены, затем stop()"""
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopped.set)
+        try:
+            await self.start(host, port)
+            await stopped.wait()
+        finally:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            await self.stop()
+
+    def stats(self) -> Dict:
+        """Счетчики и задержка от приема запроса до завершения хэндлеров (по последним 1000)"""
+        latencies = sorted(self._latencies)
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'queued': self._queue.qsize(),
+            'p50': latencies[len(latencies) // 2] if latencies else 0.0,
+            'max': latencies[-1] if latencies else 0.0,
+        }
@@ -3,7 +3,8 @@ import logging
 import json
 import asyncio
 import os
-from typing import Optional
+from collections import Counter
+from typing import Dict, Iterable, Optional
 
 class WGEasyAPI:
     def __init__(self, host: str, port: str, password: str):
@@ -12,6 +13,8 @@ class WGEasyAPI:
         self.password = password
         self.session = None
         self.cookies = None
+        # Счетчики HTTP запросов к API по видам, для логов массовых операций
+        self.requests = Counter()
         logging.info(f"Initialized WireGuard API with base URL: {self.base_url}")
 
     async def _ensure_session(self):
@@ -38,6 +41,7 @@ class WGEasyAPI:
             logging.info(f"Attempting to login to WireGuard API at {self.base_url}/api/session")
             
             try:
+                self.requests['login'] += 1
                 async with self.session.post(
                     f"{self.base_url}/api/session", 
                     json=data,
@@ -83,6 +87,7 @@ class WGEasyAPI:
         logging.info("Getting clients with cookies: %s", self.cookies)
         
         try:
+            self.requests['get_clients'] += 1
             async with self.session.get(
                 f"{self.base_url}/api/wireguard/client",
                 cookies=self.cookies,
@@ -116,6 +121,7 @@ class WGEasyAPI:
         logging.info("Creating new client with name: %s", name)
         
         try:
+            self.requests['create_client'] += 1
             async with self.session.post(
                 f"{self.base_url}/api/wireguard/client",
                 json={'name': name},
@@ -159,6 +165,32 @@ class WGEasyAPI:
         logging.warning("Client '%s' not found", name)
         return None
 
+    async def set_client_enabled(self, client_id: str, enable: bool) -> bool:
+        """Включение/отключение клиента по ID одним запросом, без получения списка"""
+        await self._ensure_session()
+        if not self.cookies and not await self._login():
+            logging.error("Failed to login")
+            return False
+
+        # Используем единый endpoint для включения/отключения
+        url = f"{self.base_url}/api/wireguard/client/{client_id}/enable"
+        try:
+            self.requests['set_enabled'] += 1
+            async with self.session.post(url, json={"enabled": enable}, cookies=self.cookies,
+                                         timeout=10) as response:
+                # 204 означает успешное выполнение без тела ответа
+                if response.status in [200, 204]:
+                    return True
+                logging.error("Failed to set client %s enabled=%s, status: %d, response: %s",
+                              client_id, enable, response.status, await response.text())
+                return False
+        except asyncio.TimeoutError:
+            logging.error("Update client request timed out after 10 seconds")
+            return False
+        except aiohttp.ClientError as e:
+            logging.error(f"Network error during update client: {str(e)}")
+            return False
+
     async def update_client(self, client_name: str, enable: bool = True) -> bool:
         """Update client status"""
         try:
@@ -170,45 +202,20 @@ class WGEasyAPI:
             client = next((c for c in clients if c['name'] == client_name), None)
             if client:
                 logging.info("Found client: %s", json.dumps(client, indent=2))
-                
-                # Получаем ID клиента
-                client_id = client['id']
-                
-                # Используем единый endpoint для включения/отключения
-                url = f"{self.base_url}/api/wireguard/client/{client_id}/enable"
-                method = self.session.post
-                data = {"enabled": enable}
-                    
-                logging.info("Updating client with URL: %s, method: %s, enabled: %s", url, method.__name__, enable)
-                
-                # Отправляем запрос на обновление
-                try:
-                    async with method(url, json=data, cookies=self.cookies, timeout=10) as response:
-                        response_text = await response.text()
-                        # 204 означает успешное выполнение без тела ответа
-                        if response.status in [200, 204]:
-                            logging.info("Successfully updated client %s status to %s", client_name, enable)
-                            
-                            # Проверяем, что статус действительно обновился
-                            updated_clients = await self.get_clients()
-                            updated_client = next((c for c in updated_clients if c['name'] == client_name), None)
-                            
-                            if updated_client and updated_client.get('enabled') == enable:
-                                logging.info("Verified client status update: %s", json.dumps(updated_client, indent=2))
-                                return True
-                            else:
-                                logging.error("Client status verification failed. Expected enabled=%s, got: %s", 
-                                            enable, updated_client)
-                                return False
-                        else:
-                            logging.error("Failed to update client '%s', status: %d, response: %s",
-                                        client_name, response.status, response_text)
-                            return False
-                except asyncio.TimeoutError:
-                    logging.error("Update client request timed out after 10 seconds")
+                if not await self.set_client_enabled(client['id'], enable):
                     return False
-                except aiohttp.ClientError as e:
-                    logging.error(f"Network error during update client: {str(e)}")
+                logging.info("Successfully updated client %s status to %s", client_name, enable)
+
+                # Проверяем, что статус действительно обновился
+                updated_clients = await self.get_clients()
+                updated_client = next((c for c in updated_clients if c['name'] == client_name), None)
+
+                if updated_client and updated_client.get('enabled') == enable:
+                    logging.info("Verified client status update: %s", json.dumps(updated_client, indent=2))
+                    return True
+                else:
+                    logging.error("Client status verification failed. Expected enabled=%s, got: %s", 
+                                enable, updated_client)
                     return False
                     
             else:
@@ -219,11 +226,56 @@ class WGEasyAPI:
             logging.error(f"Error updating client '%s': %s", client_name, e)
             return False
 
+    async def disable_clients(self, names: Iterable[str], concurrency: int = 10,
+                              attempts: int = 3) -> Dict[str, set]:
+        """Массовое отключение клиентов по именам.
+
+        Один снимок списка клиентов: нужные ID находятся пересечением
+        множеств имен, отключения идут параллельно (не больше concurrency
+        запросов одновременно), затем еще один снимок для проверки. Не
+        отключившиеся клиенты повторяются по проверочному снимку, всего до
+        attempts повторов. Обычно это N + 2 запроса вместо ~3N.
+
+        Возвращает множества имен: disabled (отключены, в том числе заранее),
+        missing (клиента нет на сервере) и failed (остались включенными или
+        список клиентов недоступен).
+        """
+        wanted = set(names)
+        result = {'disabled': set(), 'missing': set(), 'failed': set()}
+        if not wanted:
+            return result
+        before = sum(self.requests.values())
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def disable(client_id):
+            async with semaphore:
+                return await self.set_client_enabled(client_id, False)
+
+        pending = wanted
+        for attempt in range(attempts + 1):
+            snapshot = await self.get_clients()
+            if snapshot is None:
+                break
+            by_name = {client['name']: client for client in snapshot}
+            result['missing'] |= pending - by_name.keys()
+            present = pending & by_name.keys()
+            pending = {name for name in present if by_name[name].get('enabled', False)}
+            result['disabled'] |= present - pending
+            if not pending or attempt == attempts:
+                break
+            await asyncio.gather(*(disable(by_name[name]['id']) for name in pending))
+        result['failed'] = pending
+        logging.info(f"Disable sweep on {self.base_url}: {len(wanted)} requested, "
+                     f"{len(result['disabled'])} disabled, {len(result['missing'])} missing, "
+                     f"{len(result['failed'])} failed, {sum(self.requests.values()) - before} API requests")
+        return result
+
     async def get_server_config(self) -> dict:
         """Получение конфигурации сервера"""
         try:
             # Сначала пробуем получить список клиентов, чтобы получить публичный ключ сервера
             clients_url = f"{self.base_url}/api/wireguard/client"
+            self.requests['get_clients'] += 1
             async with self.session.get(clients_url, cookies=self.cookies) as response:
                 if response.status == 200:
                     # В ответе должен быть объект с информацией о сервере
@@ -234,6 +286,7 @@ class WGEasyAPI:
             
             # Если не получилось через clients, пробуем прямой endpoint
             url = f"{self.base_url}/api/wireguard/server"
+            self.requests['get_server'] += 1
             async with self.session.get(url, cookies=self.cookies) as response:
                 if response.status == 200:
                     data = await response.json()
@@ -281,6 +334,7 @@ class WGEasyAPI:
             
             # Получаем QR-код из API
             url = f"{self.base_url}/api/wireguard/client/{client['name']}/qrcode"
+            self.requests['qrcode'] += 1
             async with self.session.get(url, cookies=self.cookies) as response:
                 if response.status == 200:
                     qr_code = await response.text()
@@ -301,6 +355,7 @@ class WGEasyAPI:
         """Удаление клиента WireGuard"""
         try:
             url = f"{self.base_url}/api/wireguard/client/{client_id}"
+            self.requests['remove_client'] += 1
             async with self.session.delete(url, cookies=self.cookies) as response:
                 # 204 означает успешное удаление без контента
                 if response.status in [200, 204]:
@@ -1,5 +1,6 @@
+import asyncio
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional
 from wg_easy_api import WGEasyAPI
 import os
 from dotenv import load_dotenv
@@ -85,3 +86,16 @@ class WGServerManager:
         if server:
             return await server.create_client(name)
         return None
+
+    async def disable_clients(self, names: Iterable[str]) -> Dict[str, set]:
+        """Массовое отключение клиентов на всех серверах: по снимку на сервер, серверы параллельно"""
+        wanted = set(names)
+        results = await asyncio.gather(*(server.disable_clients(wanted) for server in self.servers.values()))
+        # Клиент отсутствует, только если его нет ни на одном сервере
+        disabled = set().union(*(result['disabled'] for result in results))
+        failed = set().union(*(result['failed'] for result in results))
+        return {
+            'disabled': disabled - failed,
+            'missing': wanted - disabled - failed,
+            'failed': failed,
+        }